@@ -0,0 +1,562 @@
+"""Compact encoding of large task results.
+
+When running on a cluster, task results are pickled whenever they are sent
+to another worker or spilled to disk. A :class:`ResultCodec` encodes large
+results as soon as a task returns them instead: the result is pickled with
+protocol 5 so that the data of NumPy arrays (including those within xarray
+and ``TimeSeries`` objects) is kept in separate out-of-band buffers, and the
+buffers of floating point arrays are byte-shuffled and compressed. The
+:class:`EncodedResult` passes its buffers on out-of-band again so that they
+are neither copied nor compressed a second time when distributed frames it
+for transfer. Tasks decode their inputs before running.
+
+Compressors are chosen from :data:`COMPRESSORS` (``"blosc"`` or ``"lz4"``
+when installed, otherwise ``"zlib"``). Compression is skipped for buffers
+which don't compress well, e.g., random noise.
+
+"""
+
+from collections import defaultdict, namedtuple
+import io
+import logging
+import pickle
+from threading import Lock
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+from uuid import uuid4
+import zlib
+
+from dask.delayed import Delayed
+import numpy as np
+
+from .graph import (
+    TaskWrapper, dependencies, is_task, task_graph, task_name, to_delayed,
+    wrap_tasks
+)
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+logger = logging.getLogger("cml.pipelines")
+
+Compressor = namedtuple("Compressor", "name,compress,decompress")
+Compressor.__doc__ = """A compression method. ``compress(data, itemsize)``
+and ``decompress(data, itemsize)`` take a buffer of bytes and the size of
+the array items it holds and return a buffer. Decompressed buffers must be
+writable.
+
+"""
+
+
+def _shuffle(data: memoryview, itemsize: int) -> memoryview:
+    """Group the bytes of array items by significance. Floating point
+    exponents and high bytes are similar between neighbouring samples, so
+    this makes signals much more compressible.
+
+    """
+    if itemsize == 1:
+        return data
+    items = np.frombuffer(data, np.uint8).reshape(-1, itemsize)
+    return memoryview(np.ascontiguousarray(items.T)).cast("B")
+
+
+def _unshuffle(data: Any, itemsize: int) -> memoryview:
+    if itemsize == 1:
+        return memoryview(bytearray(data))
+    planes = np.frombuffer(data, np.uint8).reshape(itemsize, -1)
+    return memoryview(np.ascontiguousarray(planes.T)).cast("B")
+
+
+def _zlib_compress(data, itemsize):
+    return zlib.compress(_shuffle(data, itemsize), 1)
+
+
+def _zlib_decompress(data, itemsize):
+    return _unshuffle(zlib.decompress(data), itemsize)
+
+
+def _lz4_compress(data, itemsize):
+    return lz4.frame.compress(_shuffle(data, itemsize))
+
+
+def _lz4_decompress(data, itemsize):
+    return _unshuffle(lz4.frame.decompress(data), itemsize)
+
+
+def _blosc_compress(data, itemsize):
+    return blosc.compress(data, typesize=itemsize, cname="lz4",
+                          shuffle=blosc.SHUFFLE)
+
+
+def _blosc_decompress(data, itemsize):
+    return blosc.decompress(data, as_bytearray=True)
+
+
+#: Available compressors by name
+COMPRESSORS = {
+    "zlib": Compressor("zlib", _zlib_compress, _zlib_decompress),
+}  # type: Dict[str, Compressor]
+
+if lz4 is not None:
+    COMPRESSORS["lz4"] = Compressor("lz4", _lz4_compress, _lz4_decompress)
+
+if blosc is not None:
+    COMPRESSORS["blosc"] = Compressor("blosc", _blosc_compress,
+                                      _blosc_decompress)
+
+
+# bits of the mantissa of floating point numbers by item size
+_MANTISSA_BITS = {2: 10, 4: 23, 8: 52}
+
+
+def round_mantissa(values: np.ndarray, keep_bits: int) -> np.ndarray:
+    """Return a copy of a floating point or complex array with all but the
+    ``keep_bits`` most significant bits of the mantissa of each finite value
+    set to zero by rounding to nearest. The relative error is at most
+    ``2 ** -(keep_bits + 1)``. Zeroed bits compress very well.
+
+    """
+    values = np.array(values, copy=True)
+    floats = values.reshape(-1)
+    if values.dtype.kind == "c":
+        floats = floats.view(values.real.dtype)
+
+    itemsize = floats.dtype.itemsize
+    drop = _MANTISSA_BITS.get(itemsize, 0) - keep_bits
+    if floats.dtype.kind != "f" or drop <= 0:
+        return values
+
+    uint = np.dtype("u{}".format(itemsize))
+    bits = floats.view(uint)
+    finite = np.isfinite(floats)
+    half = uint.type(1 << (drop - 1))
+    mask = ~uint.type((1 << drop) - 1)
+    bits[finite] = (bits[finite] + half) & mask
+    return values
+
+
+def default_compressor() -> str:
+    """Return the name of the fastest available compressor."""
+    for name in ("blosc", "lz4", "zlib"):
+        if name in COMPRESSORS:
+            return name
+
+
+class _Pickler(pickle.Pickler):
+    """Pickler which copies non-contiguous arrays (e.g., slices along the
+    channel axis) so that their data is also kept out-of-band rather than
+    copied into the pickle.
+
+    """
+    def reducer_override(self, obj):
+        if type(obj) is np.ndarray and not obj.dtype.hasobject and not (
+                obj.flags.c_contiguous or obj.flags.f_contiguous):
+            return np.ascontiguousarray(obj).__reduce_ex__(5)
+        return NotImplemented
+
+
+def _dumps(obj: Any, buffer_callback: Callable) -> bytes:
+    f = io.BytesIO()
+    _Pickler(f, protocol=5, buffer_callback=buffer_callback).dump(obj)
+    return f.getvalue()
+
+
+class CodecStats(object):
+    """Amount of data encoded and decoded and the time taken.
+
+    Attributes
+    ----------
+    encoded
+        Number of results encoded.
+    raw_bytes
+        Size of encoded results before encoding.
+    encoded_bytes
+        Size of encoded results after encoding.
+    encode_time
+        Seconds spent encoding.
+    decoded
+        Number of results decoded.
+    decoded_bytes
+        Size of decoded results after decoding.
+    decode_time
+        Seconds spent decoding.
+
+    """
+    def __init__(self):
+        self.encoded = 0
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.encode_time = 0.
+        self.decoded = 0
+        self.decoded_bytes = 0
+        self.decode_time = 0.
+
+    def update(self, other: "CodecStats"):
+        """Add the counts of another instance."""
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def ratio(self) -> Optional[float]:
+        """Compression ratio (raw size over encoded size)."""
+        if not self.encoded_bytes:
+            return None
+        return self.raw_bytes / self.encoded_bytes
+
+    @property
+    def encode_throughput(self) -> Optional[float]:
+        """Raw bytes encoded per second."""
+        if not self.encode_time:
+            return None
+        return self.raw_bytes / self.encode_time
+
+    @property
+    def decode_throughput(self) -> Optional[float]:
+        """Raw bytes decoded per second."""
+        if not self.decode_time:
+            return None
+        return self.decoded_bytes / self.decode_time
+
+
+# run ID -> task name -> statistics of results encoded and decoded in this
+# process
+_stats = defaultdict(lambda: defaultdict(CodecStats))
+_lock = Lock()
+
+
+class EncodedResult(object):
+    """An encoded task result.
+
+    Parameters
+    ----------
+    header
+        The result pickled with its buffers out-of-band.
+    frames
+        Buffers, compressed or not.
+    meta
+        ``(compressor, itemsize)`` of each frame. ``compressor`` is None for
+        frames which aren't compressed.
+    raw_nbytes
+        Size of the header and buffers before compression.
+
+    """
+    def __init__(self, header: bytes, frames: List[Any],
+                 meta: List[Tuple[Optional[str], int]], raw_nbytes: int):
+        self.header = header
+        self.frames = frames
+        self.meta = meta
+        self.raw_nbytes = raw_nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.header) + sum(memoryview(frame).nbytes
+                                      for frame in self.frames)
+
+    def __sizeof__(self) -> int:
+        return self.nbytes
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            frames = [pickle.PickleBuffer(frame) for frame in self.frames]
+        else:
+            frames = [bytes(frame) for frame in self.frames]
+        return type(self), (self.header, frames, list(self.meta),
+                            self.raw_nbytes)
+
+
+class ResultCodec(object):
+    """Encode large task results compactly (see :mod:`cml_pipelines.codec`).
+    Subclass and override :meth:`compressor` to choose compression
+    differently.
+
+    Parameters
+    ----------
+    compression
+        Name of a compressor in :data:`COMPRESSORS`, ``"auto"`` for the
+        fastest available or None to only pickle.
+    kinds
+        NumPy dtype kinds of arrays to compress (floating point and complex
+        by default).
+    min_size
+        Results whose out-of-band buffers total fewer bytes are returned
+        unchanged.
+    min_ratio
+        Buffers which don't compress by at least this factor are kept
+        uncompressed.
+    precision
+        When given, keep only this many bits of the mantissa of floating
+        point values before compressing (see :func:`round_mantissa`). This
+        is lossy: 12 bits keep about 4 significant digits. Noisy signals
+        barely compress otherwise.
+
+    """
+    def __init__(self, compression: Optional[str] = "auto",
+                 kinds: str = "fc", min_size: int = 1 << 16,
+                 min_ratio: float = 1.1, precision: Optional[int] = None):
+        if compression == "auto":
+            compression = default_compressor()
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError("unknown compressor: {}".format(compression))
+
+        self.compression = compression
+        self.kinds = kinds
+        self.min_size = min_size
+        self.min_ratio = min_ratio
+        self.precision = precision
+
+    def compressor(self, buffer: memoryview) -> Optional[str]:
+        """Return the name of the compressor to use for an out-of-band
+        buffer or None to leave it uncompressed.
+
+        """
+        if self.compression is None:
+            return None
+        try:
+            kind = np.asarray(buffer).dtype.kind
+        except (TypeError, ValueError):  # pragma: nocover
+            return None
+        return self.compression if kind in self.kinds else None
+
+    def encode(self, obj: Any) -> Any:
+        """Encode ``obj`` or return it unchanged if it is small."""
+        buffers = []  # type: List[pickle.PickleBuffer]
+        header = _dumps(obj, buffers.append)
+        if sum(memoryview(b).nbytes for b in buffers) < self.min_size:
+            return obj
+
+        frames = []
+        meta = []
+        raw_nbytes = len(header)
+        for buffer in buffers:
+            view = memoryview(buffer)
+            raw = buffer.raw()
+            raw_nbytes += raw.nbytes
+            name = self.compressor(view)
+            if name is not None:
+                data = raw
+                if self.precision is not None:
+                    rounded = round_mantissa(np.asarray(view), self.precision)
+                    data = memoryview(rounded.reshape(-1)).cast("B")
+                compressed = COMPRESSORS[name].compress(data, view.itemsize)
+                if len(compressed) * self.min_ratio <= raw.nbytes:
+                    frames.append(compressed)
+                    meta.append((name, view.itemsize))
+                    continue
+            frames.append(raw)
+            meta.append((None, view.itemsize))
+
+        return EncodedResult(header, frames, meta, raw_nbytes)
+
+    def decode(self, encoded: EncodedResult) -> Any:
+        """Decode an :class:`EncodedResult`."""
+        buffers = []
+        for frame, (name, itemsize) in zip(encoded.frames, encoded.meta):
+            if name is not None:
+                buffers.append(COMPRESSORS[name].decompress(frame, itemsize))
+            elif memoryview(frame).readonly:
+                # arrays should be writable as when unpickled normally
+                buffers.append(bytearray(frame))
+            else:
+                buffers.append(frame)
+        return pickle.loads(encoded.header, buffers=buffers)
+
+
+def _map_encoded(obj: Any, func: Callable[[EncodedResult], Any]) -> Any:
+    """Apply ``func`` to every :class:`EncodedResult` in (nested) lists,
+    tuples and dicts.
+
+    """
+    if isinstance(obj, EncodedResult):
+        return func(obj)
+    if type(obj) in (list, tuple):
+        return type(obj)(_map_encoded(item, func) for item in obj)
+    if type(obj) is dict:
+        return {k: _map_encoded(v, func) for k, v in obj.items()}
+    return obj
+
+
+class EncodingTask(TaskWrapper):
+    """Wrap a task function to decode its inputs and encode its result.
+
+    Parameters
+    ----------
+    run_id
+        Unique ID of the current run.
+    key
+        Task key.
+    func
+        The task function.
+    codec
+        The codec.
+    encode
+        When False, only decode inputs (for the tasks producing the final
+        result).
+
+    """
+    def __init__(self, run_id: str, key: Hashable, func,
+                 codec: ResultCodec, encode: bool = True):
+        super(EncodingTask, self).__init__(key, func)
+        self.run_id = run_id
+        self.name = task_name(key)
+        self.codec = codec
+        self.encode = encode
+
+    def _decode(self, encoded: EncodedResult, stats: CodecStats) -> Any:
+        start = time.time()
+        result = self.codec.decode(encoded)
+        stats.decode_time += time.time() - start
+        stats.decoded += 1
+        stats.decoded_bytes += encoded.raw_nbytes
+        return result
+
+    def __call__(self, *args, **kwargs):
+        stats = CodecStats()
+        args = _map_encoded(args, lambda e: self._decode(e, stats))
+        kwargs = _map_encoded(kwargs, lambda e: self._decode(e, stats))
+
+        result = self.func(*args, **kwargs)
+
+        if self.encode:
+            start = time.time()
+            encoded = self.codec.encode(result)
+            if encoded is not result:
+                stats.encode_time += time.time() - start
+                stats.encoded += 1
+                stats.raw_bytes += encoded.raw_nbytes
+                stats.encoded_bytes += encoded.nbytes
+            result = encoded
+
+        if stats.encoded or stats.decoded:
+            with _lock:
+                _stats[self.run_id][self.name].update(stats)
+        return result
+
+
+def drain_codec_stats(run_id: str) -> Dict[str, CodecStats]:
+    """Remove and return the codec statistics for the given run from this
+    process' buffer.
+
+    """
+    with _lock:
+        return dict(_stats.pop(run_id, {}))
+
+
+def collect_codec_stats(run_id: str) -> Dict[str, CodecStats]:
+    """Collect codec statistics for a run by task function from this process
+    and, if a distributed client is active, from all of its workers.
+
+    """
+    results = [drain_codec_stats(run_id)]
+
+    try:
+        from distributed import default_client
+        client = default_client()
+    except (ImportError, ValueError):
+        pass
+    else:
+        results.extend(client.run(drain_codec_stats, run_id).values())
+
+    stats = defaultdict(CodecStats)
+    for process_stats in results:
+        for name, s in process_stats.items():
+            stats[name].update(s)
+    return dict(stats)
+
+
+def _format_rate(rate: Optional[float]) -> str:
+    if rate is None:
+        return "-"
+    return "{:.0f} MiB/s".format(rate / 1024. ** 2)
+
+
+def format_codec_stats(stats: Dict[str, CodecStats]) -> str:
+    """Format codec statistics by task function as a table."""
+    lines = ["{:<30} {:>7} {:>12} {:>12} {:>6} {:>12} {:>14}".format(
+        "task", "encoded", "raw", "encoded", "ratio", "encode",
+        "decode inputs")]
+    row = "{:<30} {:>7} {:>8.1f} MiB {:>8.1f} MiB {:>6} {:>12} {:>14}"
+    for name, s in sorted(stats.items()):
+        lines.append(
+            row.format(
+                name, s.encoded, s.raw_bytes / 1024. ** 2,
+                s.encoded_bytes / 1024. ** 2,
+                "-" if s.ratio is None else "{:.1f}x".format(s.ratio),
+                _format_rate(s.encode_throughput),
+                _format_rate(s.decode_throughput)))
+    return "\n".join(lines)
+
+
+class CodecRecorder(object):
+    """Encode the results of every task of a pipeline with a
+    :class:`ResultCodec` and collect statistics when the run finishes. Use
+    as a context manager around computing the instrumented collection::
+
+        recorder = CodecRecorder(ResultCodec())
+        collection = recorder.instrument(pipeline.build())
+        with recorder:
+            collection.compute()
+
+    The final result and any results it is made up of are not encoded.
+
+    Parameters
+    ----------
+    codec
+        The codec to use.
+
+    Attributes
+    ----------
+    stats
+        Statistics of encoded results and decoded inputs by task function
+        once the run has finished.
+
+    """
+    def __init__(self, codec: ResultCodec):
+        self.codec = codec
+        self.run_id = uuid4().hex
+        self.stats = {}  # type: Dict[str, CodecStats]
+
+    def instrument(self, collection: Delayed) -> Delayed:
+        """Return a copy of ``collection`` with every task wrapped in an
+        :class:`EncodingTask`.
+
+        """
+        dsk = task_graph(collection)
+        deps = dependencies(dsk)
+
+        # the final result, following aliases and containers
+        final = set()
+        stack = [collection.key]
+        while stack:
+            key = stack.pop()
+            if key not in final:
+                final.add(key)
+                if not is_task(dsk[key]):
+                    stack.extend(deps[key])
+
+        dsk = wrap_tasks(
+            dsk,
+            lambda key, func: EncodingTask(self.run_id, key, func, self.codec,
+                                           encode=key not in final)
+        )
+        return to_delayed(dsk, collection.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stats = collect_codec_stats(self.run_id)
+        if any(s.encoded for s in self.stats.values()):
+            total = CodecStats()
+            for s in self.stats.values():
+                total.update(s)
+            logger.info("Encoded %.1f MiB of results to %.1f MiB (%.1fx):\n%s",
+                        total.raw_bytes / 1024. ** 2,
+                        total.encoded_bytes / 1024. ** 2, total.ratio,
+                        format_codec_stats(self.stats))
@@ -0,0 +1,195 @@
+"""Estimating the resources needed to run a pipeline without running it.
+
+The task graph is simulated on a given number of workers using expected task
+costs (see :func:`cml_pipelines.scheduling.task_costs`): whenever a worker is
+free it starts the ready task with the largest upward rank, i.e., the same
+order used by the ``prioritize`` option of :meth:`Pipeline.run`. Scheduling
+and data transfer overheads are ignored so estimates are lower bounds on the
+wall-clock time.
+
+"""
+
+from collections import Counter, defaultdict, namedtuple
+import heapq
+from typing import Any, Dict, Hashable, Iterable, List, Mapping, Optional, Tuple
+
+from .graph import dependencies, is_task, task_name
+from .scheduling import upward_ranks
+
+Schedule = namedtuple("Schedule", "duration,max_width,peak_memory,timeline")
+Schedule.__doc__ = """Result of simulating a graph on a number of workers.
+
+``timeline`` is a list of ``(time, running tasks, memory)`` tuples giving the
+state after every change.
+
+"""
+
+Estimate = namedtuple("Estimate", "tasks,n_tasks,depth,max_width,workers,"
+                                  "wall_time,critical_path,peak_memory,"
+                                  "worker_memory,unknown")
+Estimate.__doc__ = """Estimated resource requirements of a pipeline.
+
+``tasks`` maps task function names to the number of tasks, ``depth`` is the
+largest number of tasks on any chain, ``max_width`` is the largest number of
+tasks which can run at once given unlimited workers and ``wall_time`` is the
+estimated time in seconds to run on ``workers`` workers (``critical_path`` is
+the time with unlimited workers). ``peak_memory`` is the largest total memory
+of tasks running at once on ``workers`` workers and ``worker_memory`` the
+largest memory needed by a single task, both in bytes or None when no memory
+use has been recorded. ``unknown`` lists task functions with no cost
+information.
+
+"""
+
+
+def simulate(dsk: Dict[Hashable, Any], costs: Mapping[Hashable, float],
+             workers: int = None,
+             memory: Mapping[Hashable, int] = None) -> Schedule:
+    """Simulate running a graph.
+
+    Parameters
+    ----------
+    dsk
+        Task graph.
+    costs
+        Expected cost in seconds of each key.
+    workers
+        Number of tasks which can run at once (unlimited when not given).
+    memory
+        Expected memory use in bytes of each key while it is running.
+
+    """
+    memory = memory or {}
+    deps = dependencies(dsk)
+    dependents = defaultdict(list)
+    for key, key_deps in deps.items():
+        for dep in key_deps:
+            dependents[dep].append(key)
+
+    ranks = upward_ranks(dsk, costs)
+    waiting = {key: len(key_deps) for key, key_deps in deps.items()}
+    ready = []  # type: List[Tuple[float, int, Hashable]]
+    running = []  # type: List[Tuple[float, int, Hashable]]
+    order = 0
+
+    def make_ready(key):
+        nonlocal order
+        heapq.heappush(ready, (-ranks[key], order, key))
+        order += 1
+
+    def complete(key):
+        for dependent in dependents[key]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                make_ready(dependent)
+
+    for key, count in waiting.items():
+        if count == 0:
+            make_ready(key)
+
+    now = 0.
+    in_use = 0
+    max_width = 0
+    peak_memory = 0
+    timeline = []
+
+    while ready or running:
+        while ready and (workers is None or len(running) < workers):
+            _, _, key = heapq.heappop(ready)
+            if not is_task(dsk[key]):
+                complete(key)
+                continue
+            heapq.heappush(running, (now + costs.get(key, 0.), order, key))
+            order += 1
+            in_use += memory.get(key, 0)
+
+        if not running:
+            break
+
+        max_width = max(max_width, len(running))
+        peak_memory = max(peak_memory, in_use)
+        timeline.append((now, len(running), in_use))
+
+        now, _, key = heapq.heappop(running)
+        in_use -= memory.get(key, 0)
+        complete(key)
+
+    timeline.append((now, 0, 0))
+    return Schedule(now, max_width, peak_memory, timeline)
+
+
+def estimate(dsk: Dict[Hashable, Any], costs: Mapping[Hashable, float],
+             workers: int = 8, memory: Mapping[Hashable, int] = None,
+             unknown: Iterable[str] = ()) -> Estimate:
+    """Estimate the resources needed to run a graph.
+
+    Parameters
+    ----------
+    dsk
+        Task graph.
+    costs
+        Expected cost in seconds of each key.
+    workers
+        Number of workers to estimate the wall-clock time for.
+    memory
+        Expected memory use in bytes of each key while it is running. Memory
+        estimates are None when not given.
+    unknown
+        Names of task functions with no cost information.
+
+    """
+    tasks = Counter(task_name(key) for key, node in dsk.items()
+                    if is_task(node))
+    depths = upward_ranks(dsk, {key: 1. if is_task(node) else 0.
+                                for key, node in dsk.items()})
+
+    scheduled = simulate(dsk, costs, workers, memory)
+    unlimited = simulate(dsk, costs)
+
+    peak_memory = worker_memory = None  # type: Optional[int]
+    if memory:
+        peak_memory = scheduled.peak_memory
+        worker_memory = max(memory.values())
+
+    return Estimate(
+        tasks=dict(tasks),
+        n_tasks=sum(tasks.values()),
+        depth=int(max(depths.values(), default=0)),
+        max_width=unlimited.max_width,
+        workers=workers,
+        wall_time=scheduled.duration,
+        critical_path=unlimited.duration,
+        peak_memory=peak_memory,
+        worker_memory=worker_memory,
+        unknown=sorted(unknown),
+    )
+
+
+def _format_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return "unknown"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024.
+    return "{:.1f} TiB".format(n)
+
+
+def format_estimate(estimate: Estimate) -> str:
+    """Format an :class:`Estimate` as a human readable report."""
+    lines = ["{} tasks:".format(estimate.n_tasks)]
+    for name, count in sorted(estimate.tasks.items()):
+        lines.append("  {:<30} {:>8}".format(name, count))
+    lines += [
+        "depth: {}".format(estimate.depth),
+        "maximum width: {}".format(estimate.max_width),
+        "critical path: {:.1f} s".format(estimate.critical_path),
+        "wall-clock time on {} workers: {:.1f} s".format(
+            estimate.workers, estimate.wall_time),
+        "peak memory: {}".format(_format_bytes(estimate.peak_memory)),
+        "memory per worker: {}".format(_format_bytes(estimate.worker_memory)),
+    ]
+    if estimate.unknown:
+        lines.append("no cost information for: {}".format(
+            ", ".join(estimate.unknown)))
+    return "\n".join(lines)
@@ -0,0 +1,375 @@
+"""Sharing a cluster fairly between concurrently running pipelines.
+
+When several pipelines are computed on the same distributed cluster at once,
+the tasks of graphs submitted earlier (by more than the client's
+``fifo_timeout``) take precedence, so a single wide pipeline can occupy every
+worker until it is done. A
+:class:`FairShareScheduler` instead holds the graphs of all submitted
+pipelines and only submits as many tasks to the cluster as there are worker
+threads. Whenever a thread is free, the next task is taken from the pipeline
+with the fewest running tasks relative to its weight, so each pipeline with
+work to do gets a share of the workers proportional to its weight and a newly
+submitted pipeline starts as soon as any task finishes.
+
+"""
+
+from concurrent.futures import Future
+from contextlib import ExitStack
+import heapq
+from itertools import count
+import logging
+from threading import Event, Lock, Thread
+import time
+from typing import Any, Dict, Hashable, List, Mapping
+
+from .graph import NodeBox, dependencies, run_node, task_graph, wrap_tasks
+from .hooks import StatusTask
+from .scheduling import upward_ranks
+
+logger = logging.getLogger("cml.pipelines")
+
+
+class _Job(object):
+    """State of a single pipeline being computed."""
+    def __init__(self, pipeline_id: str, dsk: Dict[Hashable, Any],
+                 key: Hashable, ranks: Mapping[Hashable, float],
+                 weight: float, priority: int, order: int):
+        self.pipeline_id = pipeline_id
+        self.dsk = dsk
+        self.key = key
+        self.ranks = ranks
+        self.weight = weight
+        self.priority = priority
+        self.order = order
+        self.future = Future()
+        self.stack = ExitStack()
+        self.submitted = time.time()
+
+        self.deps = dependencies(dsk)
+        self.dependents = {k: set() for k in dsk}
+        for k, deps in self.deps.items():
+            for dep in deps:
+                self.dependents[dep].add(k)
+        self.waiting = {k: set(deps) for k, deps in self.deps.items()}
+
+        self.ready = []  # heap of (-rank, order, key)
+        self.results = {}  # key -> finished future
+        self.finished = set()
+        self.running = 0
+        self.dispatched = 0
+        self._count = count()
+
+        for k, deps in self.waiting.items():
+            if not deps:
+                self.push(k)
+
+    def push(self, key: Hashable):
+        heapq.heappush(self.ready,
+                       (-self.ranks.get(key, 0.), next(self._count), key))
+
+    def pop(self) -> Hashable:
+        return heapq.heappop(self.ready)[2]
+
+    def share_key(self):
+        """Sort key to choose the pipeline to run the next task from."""
+        return (self.running / self.weight, -self.priority,
+                self.dispatched / self.weight, self.order)
+
+
+class FairShareScheduler(object):
+    """Interleave the tasks of concurrently running pipelines on a shared
+    distributed cluster. Use as a context manager or call :meth:`close` when
+    done::
+
+        with FairShareScheduler(client) as scheduler:
+            small = scheduler.submit(SmallPipeline(), weight=1)
+            large = scheduler.submit(LargePipeline(), weight=2)
+            small.result()
+
+    Parameters
+    ----------
+    client
+        Distributed client. Defaults to the default client.
+    slots
+        Maximum number of tasks to run at once. Defaults to the total number
+        of worker threads (updated as workers come and go).
+    interval
+        Maximum number of seconds to wait before starting the tasks of a newly
+        submitted pipeline.
+
+    """
+    def __init__(self, client=None, slots: int = None, interval: float = 0.1):
+        if client is None:
+            from distributed import default_client
+            client = default_client()
+
+        self.client = client
+        self.slots = slots
+        self.interval = interval
+
+        self._jobs = []  # type: List[_Job]
+        self._running = {}  # future key -> (job, task key, future)
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._closed = False
+        self._order = count()
+        self._thread = Thread(target=self._loop, daemon=True,
+                              name="cml-pipelines-fair-share")
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def capacity(self) -> int:
+        """Number of tasks to run at once."""
+        if self.slots is not None:
+            return self.slots
+        return max(1, sum(self.client.nthreads().values()))
+
+    def submit(self, pipeline, pipeline_id: str = None, weight: float = 1.,
+               priority: int = 0, callback=None, history=None,
+               profile=None, force: bool = False) -> Future:
+        """Submit a pipeline to run.
+
+        Parameters
+        ----------
+        pipeline
+            The :class:`Pipeline` to run.
+        pipeline_id
+            Identifier of the pipeline, e.g., for log messages. Defaults to the
+            ID of ``callback`` or the class name.
+        weight
+            Relative share of workers for this pipeline.
+        priority
+            When pipelines have used the same share of workers, tasks of
+            pipelines with higher priority run first.
+        callback
+            A :class:`PipelineCallback` to publish status messages for this
+            pipeline with.
+        history, profile, force
+            See :meth:`Pipeline.run`.
+
+        Returns
+        -------
+        A future which resolves to the result of the pipeline.
+
+        """
+        from .pipeline import _get_history
+
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        if pipeline_id is None:
+            pipeline_id = (callback._pipeline_id if callback is not None
+                           else type(pipeline).__name__)
+
+        publisher = callback.publisher() if callback is not None else None
+        options = {
+            "history": _get_history(history),
+            "profile": profile,
+            "force": force,
+            "publisher": publisher,
+        }
+        # the pipeline keeps the options of this run until it finishes
+        state = ExitStack()
+        state.enter_context(pipeline._run_state(options))
+        try:
+            collection, contexts = pipeline._prepare()
+            dsk = task_graph(collection)
+            if callback is not None:
+                dsk = wrap_tasks(
+                    dsk, lambda key, func: StatusTask(key, func, publisher))
+                contexts.append(callback.relay(self.client, dsk, publisher))
+            ranks = upward_ranks(dsk, pipeline.task_costs(dsk))
+        except BaseException:
+            state.close()
+            raise
+
+        job = _Job(pipeline_id, dsk, collection.key, ranks, weight, priority,
+                   next(self._order))
+        job.stack.enter_context(state)
+        try:
+            for context in contexts:
+                job.stack.enter_context(context)
+        except BaseException:
+            job.stack.close()
+            raise
+
+        with self._lock:
+            if self._closed:
+                job.stack.close()
+                raise RuntimeError("scheduler is closed")
+            self._jobs.append(job)
+
+        logger.info("Submitted %s with %d tasks (weight %s)", pipeline_id,
+                    len(dsk), weight)
+        self._wakeup.set()
+        return job.future
+
+    def _dispatch(self):
+        with self._lock:
+            if not any(job.ready for job in self._jobs):
+                return
+
+        # contacts the cluster so must be called without holding the lock
+        capacity = self.capacity()
+        failed = []
+        with self._lock:
+            while len(self._running) < capacity:
+                candidates = [job for job in self._jobs if job.ready]
+                if not candidates:
+                    break
+                job = min(candidates, key=_Job.share_key)
+                key = job.pop()
+
+                values = {dep: job.results[dep] for dep in job.deps[key]}
+                try:
+                    future = self.client.submit(run_node,
+                                                NodeBox(job.dsk[key]),
+                                                values, pure=False)
+                except Exception as e:
+                    self._remove(job)
+                    failed.append((job, e))
+                    continue
+                self._running[future.key] = (job, key, future)
+                job.running += 1
+                job.dispatched += 1
+
+        for job, error in failed:
+            self._resolve(job, None, error)
+
+    def _remove(self, job: _Job):
+        """Stop scheduling a job and cancel its running tasks. Must be called
+        while holding the lock.
+
+        """
+        self._jobs.remove(job)
+        for future_key, (other, _, future) in list(self._running.items()):
+            if other is job:
+                future.cancel()
+                del self._running[future_key]
+
+    def _finish(self, job: _Job, future):
+        """Clean up after a removed job and resolve its future with the
+        result of ``future`` (of its final or a failed task). Must be called
+        without holding the lock since this contacts the cluster and callbacks
+        of the job's future may submit pipelines.
+
+        """
+        result, error = None, None
+        try:
+            result = future.result()
+        except BaseException as e:
+            error = e
+        self._resolve(job, result, error)
+
+    def _resolve(self, job: _Job, result, error: BaseException = None):
+        """Clean up after a removed job and resolve its future with
+        ``result`` or ``error``. Must be called without holding the lock.
+
+        """
+        try:
+            job.stack.__exit__(type(error) if error else None, error,
+                               error.__traceback__ if error else None)
+        except Exception:  # pragma: nocover
+            logger.exception("Error cleaning up after %s", job.pipeline_id)
+
+        elapsed = time.time() - job.submitted
+        if error is not None:
+            logger.error("%s failed after %.1f s", job.pipeline_id, elapsed)
+            job.future.set_exception(error)
+        else:
+            logger.info("%s finished in %.1f s", job.pipeline_id, elapsed)
+            job.future.set_result(result)
+
+    def _handle_done(self, future):
+        finished = self._update(future)
+        if finished is not None:
+            self._finish(*finished)
+
+    def _update(self, future):
+        """Record a finished task and schedule its dependents.
+
+        Returns
+        -------
+        The job and the future of its final or failed task if the job is
+        done, otherwise None.
+
+        """
+        with self._lock:
+            if future.key not in self._running:
+                return None
+            job, key, _ = self._running.pop(future.key)
+            job.running -= 1
+
+            if future.status != "finished":
+                self._remove(job)
+                return job, future
+
+            job.results[key] = future
+            job.finished.add(key)
+
+            if key == job.key:
+                self._remove(job)
+                return job, future
+
+            for dependent in job.dependents[key]:
+                job.waiting[dependent].discard(key)
+                if not job.waiting[dependent]:
+                    job.push(dependent)
+
+            # release inputs which are no longer needed
+            for dep in job.deps[key]:
+                if job.dependents[dep] <= job.finished:
+                    job.results.pop(dep, None)
+        return None
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if self._closed and not self._jobs:
+                    return
+
+            try:
+                self._step()
+            except Exception as e:
+                # fail the jobs rather than leaving their futures pending
+                logger.exception("Error scheduling pipelines")
+                with self._lock:
+                    jobs = list(self._jobs)
+                    for job in jobs:
+                        self._remove(job)
+                for job in jobs:
+                    self._resolve(job, None, e)
+
+    def _step(self):
+        """Submit ready tasks and handle those which finished."""
+        from distributed import TimeoutError as WaitTimeout, wait
+
+        self._dispatch()
+
+        with self._lock:
+            futures = [future for _, _, future in self._running.values()]
+
+        if not futures:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            return
+
+        try:
+            done = wait(futures, timeout=self.interval,
+                        return_when="FIRST_COMPLETED").done
+        except WaitTimeout:
+            done = set()
+
+        for future in done:
+            self._handle_done(future)
+
+    def close(self):
+        """Wait for all submitted pipelines to finish and stop."""
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
@@ -0,0 +1,212 @@
+"""Skipping tasks whose output files are up to date.
+
+Tasks which write files can declare the files they read and write (see
+:meth:`Pipeline.declare_files`). Before running, a task is considered up to
+date, as with ``make``, when all of its outputs exist and are newer than all
+of its inputs. An input which is newer than the outputs but whose content is
+unchanged since the outputs were last written (e.g., a file which was copied
+or touched) does not make a task out of date if content stamps were recorded
+in a :class:`cml_pipelines.history.TaskHistory`.
+
+Up-to-date tasks are replaced by their known result (usually the paths of
+their outputs) and any upstream tasks which were only needed by them are
+removed from the graph. Tasks downstream of a task which has to run are
+always run.
+
+"""
+
+from collections import namedtuple
+import hashlib
+import os
+import time
+from typing import Any, Dict, Hashable, List, Mapping, Set, Tuple
+
+from .graph import data_node, dependencies, is_task
+from .paths import FilePaths
+
+FileDeps = namedtuple("FileDeps", "inputs,outputs,result")
+FileDeps.__doc__ = """Files read (``inputs``) and written (``outputs``) by a
+task as lists of absolute paths and the value to use as the task's
+``result`` when it is up to date.
+
+"""
+
+
+def expand_paths(paths: Any) -> List[str]:
+    """Convert a path, a :class:`FilePaths` instance (all of its entries) or
+    an iterable of either to a list of absolute paths.
+
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, FilePaths):
+        return [os.path.abspath(getattr(paths, key)) for key in paths.keys()]
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        return [os.path.abspath(os.fsdecode(paths))]
+    return [path for item in paths for path in expand_paths(item)]
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return a digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_up_to_date(deps: FileDeps,
+                  stamps: Mapping[Tuple[str, str], str] = None) -> bool:
+    """Check if the outputs of a task are up to date.
+
+    Parameters
+    ----------
+    deps
+        Files of the task.
+    stamps
+        Digests of inputs by ``(output, input)`` recorded when the outputs
+        were last written (see :meth:`TaskHistory.file_stamps`).
+
+    """
+    stamps = stamps or {}
+
+    if not deps.outputs:
+        return False
+    try:
+        oldest_output = min(os.path.getmtime(path) for path in deps.outputs)
+    except OSError:
+        return False
+
+    for path in deps.inputs:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            # missing inputs are expected to be created by upstream tasks
+            return False
+        if mtime <= oldest_output:
+            continue
+
+        recorded = {stamps.get((output, path)) for output in deps.outputs}
+        if None in recorded or len(recorded) != 1:
+            return False
+        if recorded.pop() != file_digest(path):
+            return False
+
+    return True
+
+
+def _topological_order(
+        deps: Mapping[Hashable, Set[Hashable]]) -> List[Hashable]:
+    order = []
+    visited = set()
+    for root in deps:
+        stack = [(root, False)]
+        while stack:
+            key, done = stack.pop()
+            if done:
+                order.append(key)
+                continue
+            if key in visited:
+                continue
+            visited.add(key)
+            stack.append((key, True))
+            stack.extend((dep, False) for dep in deps[key]
+                         if dep not in visited)
+    return order
+
+
+def out_of_date(dsk: Dict[Hashable, Any], files: Mapping[Hashable, FileDeps],
+                stamps: Mapping[Tuple[str, str], str] = None
+                ) -> Set[Hashable]:
+    """Determine which tasks with declared files have to run: those which
+    are not up to date and those downstream of them.
+
+    """
+    deps = dependencies(dsk)
+    dirty = {}  # type: Dict[Hashable, bool]
+    for key in _topological_order(deps):
+        upstream = any(dirty[dep] for dep in deps[key])
+        if key in files and is_task(dsk[key]):
+            dirty[key] = upstream or not is_up_to_date(files[key], stamps)
+        else:
+            dirty[key] = upstream
+    return {key for key in files if dirty.get(key)}
+
+
+def prune_up_to_date(dsk: Dict[Hashable, Any], key: Hashable,
+                     files: Mapping[Hashable, FileDeps],
+                     stamps: Mapping[Tuple[str, str], str] = None
+                     ) -> Tuple[Dict[Hashable, Any], Set[Hashable]]:
+    """Replace up-to-date tasks with their results and remove tasks which are
+    no longer needed to compute ``key``.
+
+    Returns
+    -------
+    dsk
+        The pruned graph.
+    skipped
+        Keys of the up-to-date tasks.
+
+    """
+    stale = out_of_date(dsk, files, stamps)
+    skipped = {k for k in files if k in dsk and k not in stale}
+
+    pruned = dict(dsk)
+    for k in skipped:
+        pruned[k] = data_node(k, files[k].result)
+
+    deps = dependencies(pruned)
+    needed = set()
+    stack = [key]
+    while stack:
+        k = stack.pop()
+        if k not in needed:
+            needed.add(k)
+            stack.extend(deps[k])
+
+    return {k: node for k, node in pruned.items() if k in needed}, skipped
+
+
+class FileStampRecorder(object):
+    """Record content stamps of the inputs of tasks whose outputs were
+    written during a run in a :class:`TaskHistory`. Use as a context manager
+    around computing the collection.
+
+    Parameters
+    ----------
+    history
+        Where to store stamps.
+    files
+        Declared files of the tasks which will run.
+
+    """
+    def __init__(self, history, files: Mapping[Hashable, FileDeps]):
+        self.history = history
+        self.files = files
+        self.start = None
+
+    def __enter__(self):
+        # allow for file systems with coarse timestamps
+        self.start = time.time() - 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        stamps = {}
+        for deps in self.files.values():
+            try:
+                written = all(os.path.getmtime(path) >= self.start
+                              for path in deps.outputs)
+            except OSError:
+                continue
+            if not written:
+                continue
+            for path in deps.inputs:
+                try:
+                    digest = file_digest(path)
+                except OSError:
+                    continue
+                for output in deps.outputs:
+                    stamps[(output, path)] = digest
+
+        if stamps:
+            self.history.add_file_stamps(stamps)
@@ -0,0 +1,134 @@
+"""Utilities for inspecting and transforming the task graphs returned by
+:meth:`Pipeline.build`.
+
+"""
+
+from typing import Any, Callable, Dict, Hashable, Set
+
+try:
+    # the only place the task specification is imported from
+    from dask._task_spec import DataNode, Task, convert_legacy_graph
+except ImportError:  # pragma: nocover
+    raise ImportError("cml_pipelines requires dask 2024.12.0 or newer")
+from dask.delayed import Delayed
+from dask.utils import key_split
+
+
+def task_graph(collection: Delayed) -> Dict[Hashable, Any]:
+    """Return the low-level task graph of a collection as a plain dict.
+
+    Parameters
+    ----------
+    collection
+        Usually the result of :meth:`Pipeline.build`.
+
+    """
+    return convert_legacy_graph(dict(collection.__dask_graph__()))
+
+
+def task_name(key: Hashable) -> str:
+    """Return the name of the function which produces ``key``. For tasks
+    created by calling a function decorated with ``delayed`` this is the
+    function's name.
+
+    """
+    return key_split(key)
+
+
+def is_task(node: Any) -> bool:
+    """Check if a graph node is a function call (as opposed to literal data,
+    an alias or a container).
+
+    """
+    return type(node) is Task
+
+
+def dependencies(dsk: Dict[Hashable, Any]) -> Dict[Hashable, Set[Hashable]]:
+    """Map each key to the set of keys it depends on."""
+    return {key: set(node.dependencies) & dsk.keys()
+            for key, node in dsk.items()}
+
+
+class TaskWrapper(object):
+    """Base class for callables which wrap a task function in a graph (see
+    :func:`wrap_tasks`). Subclasses should override :meth:`__call__`.
+
+    Parameters
+    ----------
+    key
+        Task key.
+    func
+        The wrapped task function.
+
+    """
+    def __init__(self, key: Hashable, func: Callable):
+        self.key = key
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+
+def unwrap(func: Callable) -> Callable:
+    """Return the original task function wrapped by any number of
+    :class:`TaskWrapper` instances.
+
+    """
+    while isinstance(func, TaskWrapper):
+        func = func.func
+    return func
+
+
+def wrap_tasks(dsk: Dict[Hashable, Any],
+               wrapper: Callable[[Hashable, Callable], Callable]) -> Dict[Hashable, Any]:
+    """Replace the function of every task in a graph.
+
+    Parameters
+    ----------
+    dsk
+        Task graph as returned by :func:`task_graph`.
+    wrapper
+        Called as ``wrapper(key, func)`` for each task and returns the function
+        to call instead of ``func``. Since the wrapped functions may be sent to
+        remote workers, they must be serializable.
+
+    Returns
+    -------
+    A new graph.
+
+    """
+    wrapped = {}
+    for key, node in dsk.items():
+        if is_task(node):
+            node = Task(key, wrapper(key, node.func), *node.args, **node.kwargs)
+        wrapped[key] = node
+    return wrapped
+
+
+def data_node(key: Hashable, value: Any) -> Any:
+    """Return a graph node which produces ``value`` as is."""
+    return DataNode(key, value)
+
+
+def to_delayed(dsk: Dict[Hashable, Any], key: Hashable) -> Delayed:
+    """Create a :class:`Delayed` instance from a low-level graph."""
+    return Delayed(key, dsk)
+
+
+class NodeBox(object):
+    """Opaque container for a graph node so that it is passed to a function
+    submitted to a distributed client as is rather than being interpreted as
+    part of the graph (see :func:`run_node`).
+
+    """
+    def __init__(self, node: Any):
+        self.node = node
+
+
+def run_node(box: NodeBox, values: Dict[Hashable, Any]) -> Any:
+    """Run a single task of a graph given the results of its dependencies by
+    key. This is submitted to a distributed client to run tasks one at a
+    time.
+
+    """
+    return box.node(values)
@@ -0,0 +1,417 @@
+"""Persistent history of task execution statistics.
+
+Each task of an instrumented pipeline run records its duration, input size
+and the peak resident memory of the process executing it while it ran (see
+:mod:`cml_pipelines.memory`). Records are collected into a per-process buffer
+(on the workers when running on the cluster), gathered when the run finishes
+and stored in a SQLite database so that later runs can use them to predict
+run times and detect regressions.
+
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import chain
+import logging
+import os
+import socket
+import sqlite3
+from threading import Lock
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from dask.delayed import Delayed
+from dask.sizeof import sizeof
+
+from .graph import TaskWrapper, task_graph, task_name, to_delayed, wrap_tasks
+from .memory import PeakMemory
+
+logger = logging.getLogger("cml.pipelines")
+
+#: Default name of the history database file
+HISTORY_FILENAME = "task_history.sqlite"
+
+TaskRecord = namedtuple("TaskRecord", "run_id,key,name,start,duration,"
+                                      "peak_memory,input_size,worker")
+TaskSummary = namedtuple("TaskSummary", "name,count,mean_duration,"
+                                        "max_duration,max_peak_memory,"
+                                        "mean_input_size")
+Regression = namedtuple("Regression", "name,duration,baseline,ratio")
+
+_records = []  # type: List[TaskRecord]
+_records_lock = Lock()
+
+
+class RecordingTask(TaskWrapper):
+    """Wrap a task function to record its execution statistics.
+
+    Parameters
+    ----------
+    run_id
+        Unique ID of the current run.
+    key
+        Task key.
+    name
+        Task function name.
+    func
+        The task function.
+
+    """
+    def __init__(self, run_id: str, key: Hashable, name: str, func):
+        super(RecordingTask, self).__init__(key, func)
+        self.run_id = run_id
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        input_size = sum(sizeof(arg) for arg in chain(args, kwargs.values()))
+        start = time.time()
+        with PeakMemory() as memory:
+            result = self.func(*args, **kwargs)
+        duration = time.time() - start
+        record = TaskRecord(self.run_id, str(self.key), self.name, start,
+                            duration, memory.peak, input_size,
+                            "{}:{}".format(socket.gethostname(), os.getpid()))
+        with _records_lock:
+            _records.append(record)
+        return result
+
+
+def _format_bytes(n: Optional[float]) -> str:
+    if n is None:
+        return "-"
+    return "{:.1f} MiB".format(n / 1024. ** 2)
+
+
+def format_summary(summary: Dict[str, TaskSummary]) -> str:
+    """Format task summaries (see :meth:`TaskHistory.summary`) as a table."""
+    lines = ["{:<30} {:>6} {:>10} {:>10} {:>14} {:>14}".format(
+        "task", "count", "mean", "max", "peak memory", "mean input")]
+    for name, s in sorted(summary.items()):
+        lines.append("{:<30} {:>6} {:>9.2f}s {:>9.2f}s {:>14} {:>14}".format(
+            name, s.count, s.mean_duration, s.max_duration,
+            _format_bytes(s.max_peak_memory),
+            _format_bytes(s.mean_input_size)))
+    return "\n".join(lines)
+
+
+def drain_records(run_id: str) -> List[TaskRecord]:
+    """Remove and return all records for the given run from this process'
+    buffer.
+
+    """
+    with _records_lock:
+        drained = [r for r in _records if r.run_id == run_id]
+        _records[:] = [r for r in _records if r.run_id != run_id]
+    return drained
+
+
+def collect_records(run_id: str) -> List[TaskRecord]:
+    """Collect records for a run from this process and, if a distributed
+    client is active, from all of its workers.
+
+    """
+    records = drain_records(run_id)
+
+    try:
+        from distributed import default_client
+        client = default_client()
+    except (ImportError, ValueError):
+        return records
+
+    for worker_records in client.run(drain_records, run_id).values():
+        records.extend(TaskRecord(*r) for r in worker_records)
+
+    return records
+
+
+class HistoryRecorder(object):
+    """Instrument a pipeline so that statistics of all of its tasks are stored
+    in a :class:`TaskHistory` when the run finishes. Use as a context manager
+    around computing the instrumented collection::
+
+        recorder = HistoryRecorder(TaskHistory(), "MyPipeline")
+        collection = recorder.instrument(pipeline.build())
+        with recorder:
+            collection.compute()
+
+    Parameters
+    ----------
+    history
+        Where to store records.
+    pipeline
+        Pipeline name.
+    regression_threshold
+        Log a warning for any task function whose mean duration exceeds its
+        historical mean by this factor.
+
+    Attributes
+    ----------
+    summary
+        Statistics of the run by task function once it has finished.
+
+    """
+    def __init__(self, history: "TaskHistory", pipeline: str = None,
+                 regression_threshold: float = 1.5):
+        self.history = history
+        self.pipeline = pipeline
+        self.regression_threshold = regression_threshold
+        self.run_id = uuid4().hex
+        self.summary = {}  # type: Dict[str, TaskSummary]
+
+    def instrument(self, collection: Delayed) -> Delayed:
+        """Return a copy of ``collection`` with every task wrapped in a
+        :class:`RecordingTask`.
+
+        """
+        dsk = wrap_tasks(
+            task_graph(collection),
+            lambda key, func: RecordingTask(self.run_id, key, task_name(key),
+                                            func)
+        )
+        return to_delayed(dsk, collection.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        records = collect_records(self.run_id)
+        self.history.add(self.run_id, records, self.pipeline)
+        self.summary = self.history.summary(run_id=self.run_id)
+        if self.summary:
+            logger.info("Task statistics for %s:\n%s",
+                        self.pipeline or "run " + self.run_id,
+                        format_summary(self.summary))
+
+        if type is None:
+            for reg in self.history.regressions(self.run_id,
+                                                self.regression_threshold):
+                logger.warning("%s took %.2f s on average (%.1fx the "
+                               "historical mean of %.2f s)", reg.name,
+                               reg.duration, reg.ratio, reg.baseline)
+
+
+class TaskHistory(object):
+    """SQLite store of task execution statistics across runs.
+
+    Parameters
+    ----------
+    path
+        Path to the database file. Defaults to a file in the
+        ``local_directory`` of ``CLUSTER_DEFAULTS``.
+
+    """
+    def __init__(self, path: str = None):
+        if path is None:
+            from .pipeline import CLUSTER_DEFAULTS
+            path = os.path.join(CLUSTER_DEFAULTS["local_directory"],
+                                HISTORY_FILENAME)
+
+        self.path = os.path.expanduser(path)
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    pipeline TEXT,
+                    start REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    run_id TEXT,
+                    key TEXT,
+                    name TEXT,
+                    start REAL,
+                    duration REAL,
+                    peak_memory INTEGER,
+                    input_size INTEGER,
+                    worker TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_name "
+                         "ON tasks (name)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_run_id "
+                         "ON tasks (run_id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_stamps (
+                    output TEXT,
+                    input TEXT,
+                    digest TEXT,
+                    PRIMARY KEY (output, input)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, run_id: str, records: Iterable[TaskRecord],
+            pipeline: str = None):
+        """Store the records of a run.
+
+        Parameters
+        ----------
+        run_id
+            Unique ID of the run.
+        records
+            Task records.
+        pipeline
+            Name of the pipeline (usually its class name).
+
+        """
+        records = list(records)
+        start = min((r.start for r in records), default=time.time())
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                         (run_id, pipeline, start))
+            conn.executemany("INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [tuple(r) for r in records])
+
+    def runs(self, pipeline: str = None) -> List[str]:
+        """Return run IDs from oldest to newest."""
+        query = "SELECT run_id FROM runs"
+        params = ()
+        if pipeline is not None:
+            query += " WHERE pipeline = ?"
+            params = (pipeline,)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY start", params).fetchall()
+        return [row[0] for row in rows]
+
+    def records(self, run_id: str) -> List[TaskRecord]:
+        """Return all task records for a run."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM tasks WHERE run_id = ?",
+                                (run_id,)).fetchall()
+        return [TaskRecord(*row) for row in rows]
+
+    def summary(self, pipeline: str = None, run_id: str = None,
+                exclude_run: str = None,
+                last_runs: int = None) -> Dict[str, TaskSummary]:
+        """Summarize task statistics by task function name.
+
+        Parameters
+        ----------
+        pipeline
+            Only consider runs of this pipeline.
+        run_id
+            Only consider this run.
+        exclude_run
+            Ignore this run (useful for comparing a run to the ones before).
+        last_runs
+            Only consider this many of the most recent runs.
+
+        """
+        run_query = "SELECT run_id FROM runs WHERE 1"
+        params = []
+        if pipeline is not None:
+            run_query += " AND pipeline = ?"
+            params.append(pipeline)
+        if run_id is not None:
+            run_query += " AND run_id = ?"
+            params.append(run_id)
+        if exclude_run is not None:
+            run_query += " AND run_id != ?"
+            params.append(exclude_run)
+        run_query += " ORDER BY start DESC"
+        if last_runs is not None:
+            run_query += " LIMIT ?"
+            params.append(last_runs)
+
+        query = """
+            SELECT name, COUNT(*), AVG(duration), MAX(duration),
+                   MAX(peak_memory), AVG(input_size)
+            FROM tasks WHERE run_id IN ({})
+            GROUP BY name
+        """.format(run_query)
+
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return {row[0]: TaskSummary(*row) for row in rows}
+
+    def mean_durations(self, pipeline: str = None,
+                       last_runs: int = None) -> Dict[str, float]:
+        """Return the mean duration in seconds of each task function."""
+        return {
+            name: s.mean_duration for name, s in
+            self.summary(pipeline=pipeline, last_runs=last_runs).items()
+        }
+
+    def add_file_stamps(self, stamps: Dict[Tuple[str, str], str]):
+        """Store digests of input files by ``(output, input)`` path pairs
+        taken when the outputs were written (see :mod:`cml_pipelines.files`).
+
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_stamps VALUES (?, ?, ?)",
+                [(output, input, digest)
+                 for (output, input), digest in stamps.items()]
+            )
+
+    def file_stamps(self,
+                    outputs: Iterable[str]) -> Dict[Tuple[str, str], str]:
+        """Return the stored digests of the inputs of the given output
+        files by ``(output, input)``.
+
+        """
+        outputs = list(outputs)
+        stamps = {}
+        with self._connect() as conn:
+            # stay below SQLite's limit on the number of parameters
+            for i in range(0, len(outputs), 500):
+                chunk = outputs[i:i + 500]
+                rows = conn.execute(
+                    "SELECT output, input, digest FROM file_stamps "
+                    "WHERE output IN ({})".format(",".join("?" * len(chunk))),
+                    chunk
+                ).fetchall()
+                stamps.update({(row[0], row[1]): row[2] for row in rows})
+        return stamps
+
+    def regressions(self, run_id: str, threshold: float = 1.5,
+                    last_runs: int = 10) -> List[Regression]:
+        """Find task functions which took significantly longer in the given
+        run than on average in previous runs of the same pipeline.
+
+        Parameters
+        ----------
+        run_id
+            Run to check.
+        threshold
+            Minimum ratio of the run's mean duration to the historical mean
+            duration to count as a regression.
+        last_runs
+            Number of previous runs to use as the baseline.
+
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT pipeline FROM runs WHERE run_id = ?",
+                               (run_id,)).fetchone()
+        pipeline = row[0] if row is not None else None
+
+        current = self.summary(run_id=run_id)
+        baseline = self.summary(pipeline=pipeline, exclude_run=run_id,
+                                last_runs=last_runs)
+
+        regressions = []
+        for name, stats in sorted(current.items()):
+            if name not in baseline or baseline[name].mean_duration <= 0:
+                continue
+            ratio = stats.mean_duration / baseline[name].mean_duration
+            if ratio >= threshold:
+                regressions.append(Regression(name, stats.mean_duration,
+                                              baseline[name].mean_duration,
+                                              ratio))
+        return regressions
@@ -1,28 +1,110 @@
+from collections import defaultdict
 import json
 import logging
 from logging.handlers import DatagramHandler
 import pickle
+import socket
 from socketserver import DatagramRequestHandler, UDPServer
-from threading import Thread
+import sys
+from threading import Lock, Thread
+import time
 from uuid import uuid4
 
 from dask.callbacks import Callback
 
+from .graph import TaskWrapper, is_task, task_name
+
+
+def _current_worker():
+    """Return the distributed worker running the current task or None."""
+    if "distributed" not in sys.modules:
+        return None
+    from distributed import get_worker
+    try:
+        return get_worker()
+    except ValueError:
+        return None
+
+
+class StatusPublisher(object):
+    """Publishes status messages for a pipeline in the same format as
+    :class:`PipelineCallback`. Unlike the callback, a publisher can be sent
+    to worker processes so that tasks can publish messages (e.g., retries)
+    wherever they run.
+
+    Messages published on a distributed worker are logged as events on the
+    scheduler under a :attr:`topic` unique to the publisher and sent on from
+    the submitting host by a :class:`StatusRelay` since the listener usually
+    can't be reached from worker nodes.
+
+    Parameters
+    ----------
+    pipeline_id : str
+        Pipeline ID.
+    host : str
+        UDP host address.
+    port : int
+        UDP host port.
+
+    """
+    def __init__(self, pipeline_id, host='127.0.0.1', port=50001):
+        self.pipeline_id = pipeline_id
+        self.host = host
+        self.port = port
+        self.topic = "cml-pipelines-status-{}-{}".format(pipeline_id,
+                                                          uuid4().hex)
+        self._handler = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handler'] = None
+        return state
+
+    def publish(self, msg_type, **kwargs):
+        """Publish a message of the given type with additional data."""
+        worker = _current_worker()
+        if worker is not None:
+            worker.log_event(self.topic, dict(kwargs, type=msg_type))
+            return
+
+        data = {
+            'pipeline': self.pipeline_id,
+            'type': msg_type,
+            'time': time.time(),
+        }
+        data.update(kwargs)
+
+        if self._handler is None:
+            self._handler = DatagramHandler(self.host, self.port)
+        self._handler.handle(logging.makeLogRecord({
+            'name': self.pipeline_id,
+            'msg': json.dumps(data),
+            'levelno': logging.INFO,
+            'levelname': 'INFO',
+        }))
+
 
 class PipelineCallback(Callback):
     """Hooks for updating progress in a dask DAG. This uses a UDP socket to
     publish progress messages.
 
     Messages are JSON encoded and always have the keys ``pipeline`` which
-    specifies the pipeline ID and ``type`` which specifies which hook is
-    executed (with additional data depending on this). Note that ``type`` is
-    specified by the dask callback naming convention.
+    specifies the pipeline ID, ``type`` which specifies which hook is
+    executed (with additional data depending on this) and ``time`` which gives
+    the UNIX timestamp at which the message was sent. Note that ``type`` is
+    specified by the dask callback naming convention. Tasks with a retry
+    policy additionally publish ``retry`` messages for each failed attempt and
+    a ``task-failed`` message when giving up.
 
     Usage::
 
         with PipelineCallback('my-totally-unique-pipeline-name'):
             delayed_stuff.compute()
 
+    Pass the callback to :meth:`Pipeline.run` instead to receive messages
+    published by tasks and to receive progress when running on a distributed
+    cluster, where dask callbacks aren't called (see :class:`StatusRelay`).
+
     Parameters
     ----------
     pipeline_id : str
@@ -32,12 +114,27 @@ class PipelineCallback(Callback):
         UDP host address (default: ``'127.0.0.1'``)
     port : int
         UDP host port (default: ``50001``)
+    history : TaskHistory or None
+        Task history used to weight the estimated time remaining (``eta`` in
+        the ``progress`` data) by how long each task function took in
+        previous runs. Without a history (or for task functions with no
+        history), durations observed so far in the current run are used.
 
     """
 
-    def __init__(self, pipeline_id=None, host='127.0.0.1', port=50001):
+    def __init__(self, pipeline_id=None, host='127.0.0.1', port=50001,
+                 history=None):
         super(PipelineCallback, self).__init__()
         self._pipeline_id = pipeline_id if pipeline_id is not None else uuid4().hex
+        self.host = host
+        self.port = port
+        self.history = history
+        self._expected = {}
+        self._observed = {}
+        self._task_keys = set()
+        self._task_started = {}
+        self._finished = set()
+        self._started = None
         self.logger = logging.getLogger(pipeline_id)
 
         handler = DatagramHandler(host, port)
@@ -48,44 +145,274 @@ class PipelineCallback(Callback):
         self.logger.addHandler(handler)
         self.logger.setLevel(logging.INFO)
 
-    def _start(self, dsk):
-        data = json.dumps({
+    def _publish(self, msg_type, **kwargs):
+        data = {
             'pipeline': self._pipeline_id,
-            'type': 'start',
-        })
-        self.logger.info(data)
+            'type': msg_type,
+            'time': time.time(),
+        }
+        data.update(kwargs)
+        self.logger.info(json.dumps(data))
+
+    def publisher(self):
+        """Return a :class:`StatusPublisher` for this callback's pipeline
+        which can be sent to workers.
+
+        """
+        return StatusPublisher(self._pipeline_id, self.host, self.port)
+
+    def relay(self, client, dsk, publisher):
+        """Return a :class:`StatusRelay` to publish the status of computing
+        ``dsk`` on a distributed cluster with this callback.
+
+        """
+        return StatusRelay(self, client, dsk, publisher)
+
+    def _start(self, dsk):
+        self._started = time.time()
+        self._task_keys = {key for key, node in dsk.items() if is_task(node)}
+        self._task_started = {}
+        self._finished = set()
+        self._observed = {}
+
+        durations = self.history.mean_durations() if self.history else {}
+        self._expected = {
+            key: durations[task_name(key)] for key in self._task_keys
+            if task_name(key) in durations
+        }
+
+        # Expected work done and remaining is tracked incrementally so that
+        # each message takes constant time. Tasks with a recorded history
+        # are weighted by it, other tasks by the mean duration observed for
+        # their function so far or, before any are observed, by the mean of
+        # all known durations.
+        self._mean_total = sum(self._expected.values())
+        self._mean_count = len(self._expected)
+        self._work = {"expected": [0., self._mean_total],
+                      "observed": [0., 0.], "default": [0, 0]}
+        self._counts = defaultdict(lambda: [0, 0])
+        for key in self._task_keys - self._expected.keys():
+            self._counts[task_name(key)][1] += 1
+            self._work["default"][1] += 1
+        self._remaining = len(self._task_keys)
+
+        self._publish('start')
+
+    def _mark_finished(self, key):
+        """Move the expected work of a task from remaining to done."""
+        if key not in self._task_keys or key in self._finished:
+            return
+        self._remaining -= 1
+
+        if key in self._expected:
+            group, weight = "expected", self._expected[key]
+        else:
+            self._counts[task_name(key)][0] += 1
+            self._counts[task_name(key)][1] -= 1
+            observed = self._observed.get(task_name(key))
+            if observed is None:
+                group, weight = "default", 1
+            else:
+                group, weight = "observed", observed[0] / observed[1]
+        self._work[group][0] += weight
+        self._work[group][1] -= weight
+
+    def _observe(self, name, duration):
+        """Record the duration of a task and update the expected work of
+        tasks weighted by the mean observed duration of its function.
+
+        """
+        total, count = self._observed.get(name, (0., 0))
+        self._observed[name] = (total + duration, count + 1)
+        mean = (total + duration) / (count + 1)
+
+        if count:
+            old_mean = total / count
+            self._mean_total += mean - old_mean
+        else:
+            old_mean = None
+            self._mean_total += mean
+            self._mean_count += 1
+
+        done, remaining = self._counts.get(name, (0, 0))
+        if old_mean is None:
+            self._work["default"][0] -= done
+            self._work["default"][1] -= remaining
+            old_mean = 0.
+        self._work["observed"][0] += done * (mean - old_mean)
+        self._work["observed"][1] += remaining * (mean - old_mean)
+
+    def _eta(self):
+        """Estimate the time remaining by weighting each task by its
+        expected duration and scaling by the rate at which expected work has
+        been completed so far.
+
+        """
+        if not self._mean_count:
+            return None
+        default = self._mean_total / self._mean_count
+
+        work = self._work
+        done = (work["expected"][0] + work["observed"][0] +
+                work["default"][0] * default)
+        if done <= 0:
+            return None
+        if not self._remaining:
+            return 0.
+        remaining = (work["expected"][1] + work["observed"][1] +
+                     work["default"][1] * default)
+        return max(remaining, 0.) * (time.time() - self._started) / done
+
+    def _progress(self, complete, total):
+        return {
+            'complete': complete,
+            'total': total,
+            'eta': self._eta(),
+        }
+
+    def _task_finished(self, key, duration=None):
+        """Record that a task finished and return the data to publish."""
+        data = {}
+        self._mark_finished(key)
+        if duration is None and key in self._task_started:
+            duration = time.time() - self._task_started.pop(key)
+        if duration is not None:
+            self._observe(task_name(key), duration)
+            data['duration'] = duration
+        self._finished.add(key)
+        return data
 
     def _pretask(self, key, dsk, state):
-        data = json.dumps({
-            'pipeline': self._pipeline_id,
-            'type': 'pretask',
-            'progress': {
-                'complete': len(state['finished']),
-                'total': len(state['dependencies']),
-            },
-            'task': key,
-        })
-        self.logger.info(data)
+        self._task_started[key] = time.time()
+        progress = self._progress(len(state['finished']),
+                                  len(state['dependencies']))
+        self._publish('pretask', progress=progress, task=key)
 
     def _posttask(self, key, result, dsk, state, id):
-        data = json.dumps({
-            'pipeline': self._pipeline_id,
-            'type': 'posttask',
-            'progress': {
-                'complete': len(state['finished']),
-                'total': len(state['dependencies']),
-            },
-            'task': key,
-        })
-        self.logger.info(data)
+        data = self._task_finished(key)
+        progress = self._progress(len(state['finished']),
+                                  len(state['dependencies']))
+        self._publish('posttask', progress=progress, task=key, **data)
 
     def _finish(self, dsk, state, errored):
-        data = json.dumps({
-            'pipeline': self._pipeline_id,
-            'type': 'finish',
-            'errored': errored,
-        })
-        self.logger.info(data)
+        self._publish('finish', errored=errored)
+
+
+class StatusTask(TaskWrapper):
+    """Wrap a task function to publish ``pretask`` and ``posttask`` messages
+    (see :class:`StatusRelay`).
+
+    Parameters
+    ----------
+    key
+        Task key.
+    func
+        The task function.
+    publisher
+        :class:`StatusPublisher` of the pipeline.
+
+    """
+    def __init__(self, key, func, publisher):
+        super(StatusTask, self).__init__(key, func)
+        self.publisher = publisher
+
+    def __call__(self, *args, **kwargs):
+        self.publisher.publish('pretask', task=str(self.key))
+        start = time.time()
+        result = self.func(*args, **kwargs)
+        self.publisher.publish('posttask', task=str(self.key),
+                               duration=time.time() - start)
+        return result
+
+
+class StatusRelay(object):
+    """Publish the status of a graph computed on a distributed cluster with a
+    :class:`PipelineCallback`. Use as a context manager around computing the
+    graph.
+
+    Tasks should be wrapped in :class:`StatusTask` to report their progress.
+    Messages published by tasks on workers are logged as events on the
+    scheduler, received by the client and published from this process along
+    with ``start`` and ``finish`` messages and progress estimates.
+
+    Parameters
+    ----------
+    callback
+        Callback to publish messages with.
+    client
+        Distributed client computing the graph.
+    dsk
+        Task graph (see :func:`cml_pipelines.graph.task_graph`).
+    publisher
+        The :class:`StatusPublisher` given to the graph's tasks.
+
+    """
+    def __init__(self, callback, client, dsk, publisher):
+        self.callback = callback
+        self.client = client
+        self.dsk = dsk
+        self.topic = publisher.topic
+        self._keys = {str(key): key for key, node in dsk.items()
+                      if is_task(node)}
+        self._seen = set()
+        self._lock = Lock()
+
+    def _progress(self):
+        return self.callback._progress(len(self.callback._finished),
+                                       len(self._keys))
+
+    def _handle(self, event):
+        with self._lock:
+            seen = (event[0], repr(sorted(event[1].items())))
+            if seen in self._seen:
+                return
+            self._seen.add(seen)
+            self._relay(dict(event[1]))
+
+    def _relay(self, msg):
+        msg_type = msg.pop('type')
+        key = self._keys.get(msg.get('task'))
+
+        if msg_type in ('pretask', 'posttask'):
+            # speculative copies of a task may report finishing again
+            if key is None or key in self.callback._finished:
+                return
+            if msg_type == 'posttask':
+                duration = msg.pop('duration')
+                msg.update(self.callback._task_finished(key, duration))
+            msg['progress'] = self._progress()
+        self.callback._publish(msg_type, **msg)
+
+    def __enter__(self):
+        self.callback._start(self.dsk)
+        self.client.subscribe_topic(self.topic, self._handle)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # events which haven't reached the client yet are already logged on
+        # the scheduler once the results have been received
+        self.client.unsubscribe_topic(self.topic)
+        for event in self.client.get_events(self.topic):
+            self._handle(event)
+        self.callback._finish(self.dsk, None, type is not None)
+
+
+class _StatusServer(UDPServer):
+    """UDP server which accepts full-sized datagrams and optionally requests a
+    larger receive buffer from the kernel.
+
+    """
+    max_packet_size = 65507
+
+    def __init__(self, server_address, handler_class, recv_buffer_size=None):
+        self.recv_buffer_size = recv_buffer_size
+        super(_StatusServer, self).__init__(server_address, handler_class)
+
+    def server_bind(self):
+        if self.recv_buffer_size is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   self.recv_buffer_size)
+        super(_StatusServer, self).server_bind()
 
 
 class PipelineStatusListener(object):
@@ -106,6 +433,11 @@ class PipelineStatusListener(object):
         Pipeline ID to filter on or None to listen to all.
     port : int
         Port number to listen on
+    recv_buffer_size : int or None
+        Size in bytes to request for the socket's receive buffer. Increasing
+        this allows absorbing bursts of messages from many concurrent
+        pipelines without the kernel dropping datagrams. When None, the system
+        default is used.
 
     Notes
     -----
@@ -113,7 +445,8 @@ class PipelineStatusListener(object):
     method.
 
     """
-    def __init__(self, callback, pipeline_id=None, port=50001):
+    def __init__(self, callback, pipeline_id=None, port=50001,
+                 recv_buffer_size=None):
         class Handler(DatagramRequestHandler):
             def handle(self):
                 data = self.request[0]
@@ -129,13 +462,18 @@ class PipelineStatusListener(object):
         self._handler_class = Handler
         self.host = '127.0.0.1'
         self.port = port
+        self.recv_buffer_size = recv_buffer_size
         self.server = None
         self._server_thread = None  # type: Thread
 
     def __enter__(self):
-        self.server = UDPServer(('127.0.0.1', self.port), self._handler_class)
+        self.server = _StatusServer(('127.0.0.1', self.port),
+                                    self._handler_class,
+                                    recv_buffer_size=self.recv_buffer_size)
         self._server_thread = Thread(target=self.server.serve_forever)
         self._server_thread.start()
+        return self
 
     def __exit__(self, type, value, traceback):
         self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,229 @@
+"""Placing tasks on workers which already hold their input files.
+
+Input files which were staged to a node's local scratch space can only be read
+there, or have to be read again over the network file system from anywhere
+else. Before running, every worker reports which of the input files of the
+pipeline's tasks (see :meth:`Pipeline.declare_files` and
+:meth:`Pipeline.hint_locality`) it can read from a local file system, and each
+task is restricted to the workers holding the largest share of its inputs.
+Files on network file systems are visible to every worker and don't affect
+placement.
+
+Unless placement is strict, the restrictions are loose
+(``allow_other_workers``): a task runs on any worker when none of its
+preferred workers is connected and may be stolen by idle workers when its
+preferred workers are busy.
+
+"""
+
+from collections import defaultdict
+import os
+from typing import Any, Dict, Hashable, Iterable, List, Mapping, Optional
+
+import dask
+
+from .scheduling import KeyLookup
+
+#: File system types which are shared between nodes
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "beegfs",
+    "panfs", "afs", "ceph", "glusterfs", "fuse.glusterfs", "fuse.sshfs",
+}
+
+
+def _unescape_mount(path: str) -> str:
+    # spaces and some other characters are escaped as octal in /proc/mounts
+    return path.encode().decode("unicode_escape")
+
+
+def mount_points(mounts: str = "/proc/self/mounts") -> Dict[str, str]:
+    """Return the file system type by mount point or an empty dict if mount
+    points can't be determined on this platform.
+
+    """
+    try:
+        with open(mounts) as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+
+    result = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 3:
+            result[_unescape_mount(fields[1])] = fields[2]
+    return result
+
+
+def filesystem_type(path: str,
+                    mounts: Mapping[str, str] = None) -> Optional[str]:
+    """Return the type of the file system ``path`` is on or None if unknown.
+
+    Parameters
+    ----------
+    path
+        Path to look up.
+    mounts
+        File system type by mount point (see :func:`mount_points`).
+
+    """
+    if mounts is None:
+        mounts = mount_points()
+
+    path = os.path.realpath(path)
+    while True:
+        if path in mounts:
+            return mounts[path]
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def local_files(paths: Iterable[str],
+                mounts: Mapping[str, str] = None) -> Dict[str, int]:
+    """Return the size in bytes of each of ``paths`` which exists on a local
+    (not network) file system of this machine. This is run on every worker.
+
+    """
+    if mounts is None:
+        mounts = mount_points()
+
+    sizes = {}
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if filesystem_type(path, mounts) not in NETWORK_FILESYSTEMS:
+            sizes[path] = size
+    return sizes
+
+
+def locate_files(client, paths: Iterable[str]) -> Dict[str, Dict[str, int]]:
+    """Ask all connected workers which of ``paths`` they hold locally.
+
+    Returns
+    -------
+    Size in bytes by worker address by path for each path found locally on
+    at least one worker.
+
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        return {}
+
+    located = defaultdict(dict)
+    for worker, sizes in client.run(local_files, paths).items():
+        for path, size in sizes.items():
+            located[path][worker] = size
+    return dict(located)
+
+
+def preferred_workers(paths: Iterable[str],
+                      located: Mapping[str, Mapping[str, int]],
+                      workers: Iterable[str]) -> List[str]:
+    """Determine the workers holding the most bytes of ``paths`` locally.
+
+    Parameters
+    ----------
+    paths
+        Input files of a task.
+    located
+        Where files are held (see :func:`locate_files`).
+    workers
+        Addresses of all workers.
+
+    Returns
+    -------
+    Sorted addresses of the preferred workers or an empty list if there is no
+    preference, i.e., no worker holds any of the files or all workers hold
+    the same amount.
+
+    """
+    workers = set(workers)
+    held = dict.fromkeys(workers, 0)
+    for path in set(paths):
+        for worker, size in located.get(path, {}).items():
+            if worker in held:
+                # count empty files so that holding them is still preferred
+                held[worker] += max(size, 1)
+
+    if not held:
+        return []
+    most = max(held.values())
+    preferred = sorted(worker for worker, size in held.items()
+                       if size == most)
+    if most == 0 or len(preferred) == len(workers):
+        return []
+    return preferred
+
+
+class LocalityPlacement(object):
+    """Restrict tasks to their preferred workers while computing a
+    collection. Use as a context manager around computing it.
+
+    Parameters
+    ----------
+    client
+        Distributed client.
+    hints
+        Preferred worker addresses or hostnames by task key.
+    strict
+        When True, tasks only ever run on preferred workers. Otherwise they
+        may run on other workers when no preferred worker is connected or
+        through work stealing when the preferred workers are busy.
+
+    """
+    def __init__(self, client, hints: Mapping[Hashable, List[str]],
+                 strict: bool = False):
+        self.client = client
+        self.hints = dict(hints)
+        self.strict = strict
+        self._annotate = None  # type: Any
+
+    def __enter__(self):
+        self._annotate = dask.annotate(
+            workers=KeyLookup(self.hints, ()),
+            allow_other_workers=not self.strict)
+        self._annotate.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._annotate.__exit__(type, value, traceback)
+
+
+def locality_hints(client, task_paths: Mapping[Hashable, Iterable[str]],
+                   task_workers: Mapping[Hashable, Iterable[str]] = None
+                   ) -> Dict[Hashable, List[str]]:
+    """Determine the preferred workers of tasks.
+
+    Parameters
+    ----------
+    client
+        Distributed client whose workers are asked for the files they hold.
+    task_paths
+        Input files by task key.
+    task_workers
+        Explicitly preferred worker addresses or hostnames by task key. These
+        take precedence over files.
+
+    Returns
+    -------
+    Preferred workers by key for tasks with a preference.
+
+    """
+    task_workers = task_workers or {}
+    located = locate_files(
+        client, (path for paths in task_paths.values() for path in paths))
+    workers = list(client.scheduler_info(n_workers=-1)["workers"])
+
+    hints = {}
+    for key, paths in task_paths.items():
+        preferred = preferred_workers(paths, located, workers)
+        if preferred:
+            hints[key] = preferred
+    for key, preferred in task_workers.items():
+        hints[key] = list(preferred)
+    return hints
+
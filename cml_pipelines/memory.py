@@ -0,0 +1,139 @@
+"""Measuring the memory used by tasks.
+
+While a task runs, a thread samples the resident set size (RSS) of the
+process running it so that the peak memory of each task can be recorded
+(see :class:`cml_pipelines.history.TaskHistory`). RSS is a property of the
+whole process so when several tasks run at once in threads of the same
+process, each task's peak includes the memory used by the others. This is
+still what matters when sizing workers.
+
+"""
+
+import math
+import os
+import sys
+from threading import Lock, Thread
+import time
+from typing import Dict, Optional
+
+try:
+    import resource
+except ImportError:  # pragma: nocover
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # pragma: nocover
+    psutil = None
+
+#: Seconds between memory samples while tasks are running
+SAMPLE_INTERVAL = 0.05
+
+# id of tracker -> tracker for tasks currently running in this process
+_active = {}  # type: Dict[int, PeakMemory]
+_lock = Lock()
+_sampler = None  # type: Optional[Thread]
+
+
+def current_rss() -> Optional[int]:
+    """Return the resident memory of this process in bytes or None if it
+    can't be determined.
+
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if psutil is not None:  # pragma: nocover
+        return psutil.Process().memory_info().rss
+    return None  # pragma: nocover
+
+
+def max_rss() -> Optional[int]:
+    """High-water mark of the resident memory of this process in bytes."""
+    if resource is None:  # pragma: nocover
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in KiB elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _sample():
+    global _sampler
+
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        rss = current_rss()
+        with _lock:
+            if not _active:
+                _sampler = None
+                return
+            for tracker in _active.values():
+                tracker.update(rss)
+
+
+class PeakMemory(object):
+    """Context manager which tracks the peak resident memory of the process
+    while it is active::
+
+        with PeakMemory() as memory:
+            result = func()
+        print(memory.peak)
+
+    Attributes
+    ----------
+    start
+        Resident memory in bytes on entering.
+    peak
+        Highest resident memory in bytes seen while active. Short spikes
+        between samples are only caught if they exceed the previous
+        high-water mark of the process. If the current resident memory can't
+        be determined, this is the high-water mark of the process instead.
+
+    """
+    def __init__(self):
+        self.start = None  # type: Optional[int]
+        self.peak = None  # type: Optional[int]
+        self._start_max = None  # type: Optional[int]
+
+    def update(self, rss: Optional[int]):
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def __enter__(self):
+        global _sampler
+
+        self.start = current_rss()
+        self._start_max = max_rss()
+        self.update(self.start)
+
+        with _lock:
+            _active[id(self)] = self
+            if _sampler is None:
+                _sampler = Thread(target=_sample, daemon=True,
+                                  name="cml-pipelines-memory")
+                _sampler.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with _lock:
+            _active.pop(id(self), None)
+        self.update(current_rss())
+
+        # catch spikes between samples which set a new high-water mark
+        high_water = max_rss()
+        if high_water is not None and (self.peak is None or
+                                       high_water > self._start_max):
+            self.peak = max(self.peak or 0, high_water)
+
+
+def memory_request(peak: int, headroom: float = 0.25) -> str:
+    """Return a memory request for a job scheduler (e.g., ``"12G"``) which
+    leaves ``headroom`` (a fraction of ``peak``) on top of ``peak`` bytes,
+    rounded up to a whole number of gigabytes.
+
+    """
+    gigabytes = peak * (1 + headroom) / 1024 ** 3
+    return "{}G".format(max(1, int(math.ceil(gigabytes))))
@@ -0,0 +1,451 @@
+"""Aggregate status messages from running pipelines and serve metrics over
+HTTP.
+
+The monitor listens for the UDP messages published by
+:class:`cml_pipelines.hooks.PipelineCallback`, tracks progress for every
+pipeline ID it hears from and serves the result at two endpoints:
+
+* ``/metrics``: Prometheus text exposition format
+* ``/status``: JSON
+
+Run it as a daemon with::
+
+    $ python -m cml_pipelines.monitor --udp-port 50001 --http-port 9150
+
+"""
+
+from argparse import ArgumentParser
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from queue import Queue
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+import time
+from typing import Dict, List, Optional
+
+from .hooks import PipelineStatusListener
+
+logger = logging.getLogger("cml.pipelines.monitor")
+
+#: Default receive buffer size to request for the status listener socket
+DEFAULT_RECV_BUFFER_SIZE = 8 * 1024 ** 2
+
+
+class PipelineStats(object):
+    """Progress statistics for a single pipeline.
+
+    Progress messages carry absolute ``complete`` and ``total`` counts, so the
+    statistics only ever move forward: a lost or reordered datagram can delay
+    an update but never causes completed tasks to be under-counted.
+
+    Parameters
+    ----------
+    pipeline_id
+        Pipeline ID.
+    rate_window
+        Length of the window in seconds used to compute the task rate.
+
+    """
+    def __init__(self, pipeline_id: str, rate_window: float = 30.):
+        self.pipeline_id = pipeline_id
+        self.rate_window = rate_window
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics, e.g., when a new run starts."""
+        self.started = None  # type: Optional[float]
+        self.finished = None  # type: Optional[float]
+        self.errored = False
+        self.complete = 0
+        self.total = 0
+        self.last_update = None  # type: Optional[float]
+        self.messages = {}  # type: Dict[str, int]
+        self._completions = deque()
+
+    def update(self, msg: dict, received: float):
+        """Update the statistics with a single status message."""
+        msg_type = msg.get("type", "unknown")
+        timestamp = msg.get("time", received)
+        self.messages[msg_type] = self.messages.get(msg_type, 0) + 1
+        if self.last_update is None or timestamp > self.last_update:
+            self.last_update = timestamp
+
+        if msg_type == "start":
+            # a pipeline ID may be reused for successive runs
+            if self.finished is not None:
+                self.reset()
+                self.messages[msg_type] = 1
+                self.last_update = timestamp
+            self.started = timestamp
+        elif msg_type == "finish":
+            self.finished = timestamp
+            self.errored = bool(msg.get("errored", False))
+
+        if self.started is None:
+            self.started = timestamp
+
+        progress = msg.get("progress")
+        if progress is not None:
+            self.total = max(self.total, progress.get("total", 0))
+            complete = progress.get("complete", 0)
+            if complete > self.complete:
+                self.complete = complete
+                self._completions.append((timestamp, complete))
+
+        while len(self._completions) > 2 and \
+                self._completions[0][0] < self.last_update - self.rate_window:
+            self._completions.popleft()
+
+    @property
+    def active(self) -> bool:
+        return self.finished is None
+
+    @property
+    def percent_complete(self) -> float:
+        if self.total == 0:
+            return 0.
+        return 100. * self.complete / self.total
+
+    @property
+    def tasks_per_second(self) -> float:
+        """Rate of task completion over the last ``rate_window`` seconds (or
+        since the start when fewer than two completions are known).
+
+        """
+        if not self._completions:
+            return 0.
+        t1, c1 = self._completions[-1]
+        if len(self._completions) > 1:
+            t0, c0 = self._completions[0]
+        else:
+            t0, c0 = self.started, 0
+        if t1 <= t0:
+            return 0.
+        return (c1 - c0) / (t1 - t0)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Estimated seconds remaining or None if it can't be estimated."""
+        if not self.active:
+            return 0.
+        rate = self.tasks_per_second
+        if rate <= 0:
+            return None
+        return (self.total - self.complete) / rate
+
+    def to_dict(self) -> dict:
+        return {
+            "pipeline": self.pipeline_id,
+            "active": self.active,
+            "errored": self.errored,
+            "started": self.started,
+            "finished": self.finished,
+            "last_update": self.last_update,
+            "complete": self.complete,
+            "total": self.total,
+            "percent_complete": self.percent_complete,
+            "tasks_per_second": self.tasks_per_second,
+            "eta": self.eta,
+            "messages": dict(self.messages),
+        }
+
+
+class StatusAggregator(object):
+    """Aggregate status messages across pipelines.
+
+    Parameters
+    ----------
+    rate_window
+        Window in seconds for computing task rates.
+    retention
+        Seconds to keep statistics for a pipeline after it finishes.
+
+    """
+    def __init__(self, rate_window: float = 30., retention: float = 3600.):
+        self.rate_window = rate_window
+        self.retention = retention
+        self.messages_received = 0
+        self._pipelines = {}  # type: Dict[str, PipelineStats]
+        self._lock = Lock()
+
+    def update(self, msg: dict, received: float = None):
+        """Process a single message."""
+        if received is None:
+            received = time.time()
+
+        pipeline_id = msg.get("pipeline")
+        if pipeline_id is None:
+            return
+
+        with self._lock:
+            self.messages_received += 1
+            if pipeline_id not in self._pipelines:
+                self._pipelines[pipeline_id] = PipelineStats(pipeline_id,
+                                                             self.rate_window)
+            self._pipelines[pipeline_id].update(msg, received)
+            self._expire(received)
+
+    def _expire(self, now: float):
+        expired = [
+            pid for pid, stats in self._pipelines.items()
+            if not stats.active and stats.finished < now - self.retention
+        ]
+        for pid in expired:
+            del self._pipelines[pid]
+
+    def snapshot(self) -> List[dict]:
+        """Return the current statistics for all known pipelines."""
+        with self._lock:
+            return [stats.to_dict() for stats in self._pipelines.values()]
+
+    def to_json(self) -> str:
+        """Render the current statistics as JSON."""
+        with self._lock:
+            received = self.messages_received
+        return json.dumps({
+            "messages_received": received,
+            "pipelines": self.snapshot(),
+        })
+
+    def to_prometheus(self) -> str:
+        """Render the current statistics in the Prometheus text exposition
+        format.
+
+        """
+        pipelines = self.snapshot()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                label_str = ",".join(
+                    '{}="{}"'.format(k, _escape_label(v))
+                    for k, v in sorted(labels.items())
+                )
+                lines.append("{}{{{}}} {}".format(name, label_str,
+                                                  _format_value(value)))
+
+        with self._lock:
+            received = self.messages_received
+        lines.append("# HELP cml_pipeline_messages_received_total "
+                     "Total status messages received")
+        lines.append("# TYPE cml_pipeline_messages_received_total counter")
+        lines.append("cml_pipeline_messages_received_total {}".format(received))
+        lines.append("# HELP cml_pipeline_active_pipelines "
+                     "Number of pipelines currently running")
+        lines.append("# TYPE cml_pipeline_active_pipelines gauge")
+        lines.append("cml_pipeline_active_pipelines {}".format(
+            sum(p["active"] for p in pipelines)))
+
+        def samples(key):
+            return [({"pipeline": p["pipeline"]}, p[key]) for p in pipelines
+                    if p[key] is not None]
+
+        metric("cml_pipeline_running", "gauge",
+               "1 if the pipeline is running, 0 otherwise",
+               [({"pipeline": p["pipeline"]}, int(p["active"]))
+                for p in pipelines])
+        metric("cml_pipeline_errored", "gauge",
+               "1 if the pipeline finished with an error, 0 otherwise",
+               [({"pipeline": p["pipeline"]}, int(p["errored"]))
+                for p in pipelines])
+        metric("cml_pipeline_tasks_completed", "gauge",
+               "Number of completed tasks", samples("complete"))
+        metric("cml_pipeline_tasks_total", "gauge",
+               "Total number of tasks", samples("total"))
+        metric("cml_pipeline_completion_percent", "gauge",
+               "Percentage of tasks completed", samples("percent_complete"))
+        metric("cml_pipeline_tasks_per_second", "gauge",
+               "Recent task completion rate", samples("tasks_per_second"))
+        metric("cml_pipeline_eta_seconds", "gauge",
+               "Estimated time remaining", samples("eta"))
+        metric("cml_pipeline_status_messages_total", "counter",
+               "Status messages received by type",
+               [({"pipeline": p["pipeline"], "type": msg_type}, count)
+                for p in pipelines
+                for msg_type, count in sorted(p["messages"].items())])
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MonitorDaemon(object):
+    """Listen for pipeline status messages and serve aggregated metrics over
+    HTTP. Use as a context manager or call :meth:`serve_forever`::
+
+        with MonitorDaemon(http_port=9150) as monitor:
+            pipeline.run()
+
+    Incoming datagrams are only queued by the listener thread; a separate
+    consumer thread does the aggregation so that bursts from many concurrent
+    pipelines are absorbed by the queue rather than overflowing the socket
+    buffer.
+
+    Parameters
+    ----------
+    udp_port
+        Port to listen for status messages on.
+    http_host
+        Host to bind the HTTP server to.
+    http_port
+        Port for the HTTP server (0 picks a free port).
+    recv_buffer_size
+        Receive buffer size to request for the UDP socket.
+    rate_window
+        Window in seconds for computing task rates.
+    retention
+        Seconds to keep statistics for finished pipelines.
+
+    """
+    def __init__(self, udp_port: int = 50001, http_host: str = "127.0.0.1",
+                 http_port: int = 9150,
+                 recv_buffer_size: int = DEFAULT_RECV_BUFFER_SIZE,
+                 rate_window: float = 30., retention: float = 3600.):
+        self.aggregator = StatusAggregator(rate_window, retention)
+        self.http_host = http_host
+        self.http_port = http_port
+        self._queue = Queue()
+        self._listener = PipelineStatusListener(
+            lambda msg: self._queue.put((msg, time.time())),
+            port=udp_port,
+            recv_buffer_size=recv_buffer_size,
+        )
+        self._http_server = None  # type: HTTPServer
+        self._threads = []  # type: List[Thread]
+
+    @property
+    def url(self) -> str:
+        host, port = self._http_server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self.aggregator.update(*item)
+            except Exception:  # pragma: nocover
+                logger.exception("Error processing message %r", item[0])
+            finally:
+                self._queue.task_done()
+
+    def _make_handler(self):
+        aggregator = self.aggregator
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/metrics":
+                    body = aggregator.to_prometheus()
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif path in ("/status", ""):
+                    body = aggregator.to_json()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+    def drain(self, timeout: float = 5.):
+        """Wait until all queued messages have been processed."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def start(self):
+        """Start the listener, consumer and HTTP server threads."""
+        self._http_server = _ThreadingHTTPServer(
+            (self.http_host, self.http_port), self._make_handler())
+        self._threads = [
+            Thread(target=self._consume, daemon=True),
+            Thread(target=self._http_server.serve_forever, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._listener.__enter__()
+        logger.info("Serving metrics at %s/metrics", self.url)
+
+    def stop(self):
+        """Stop all threads."""
+        self._listener.__exit__(None, None, None)
+        self._queue.put(None)
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def serve_forever(self):
+        """Run until interrupted."""
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def make_parser() -> ArgumentParser:
+    """Setup command-line argument parsing."""
+    parser = ArgumentParser(description="Pipeline status monitor")
+    parser.add_argument("--udp-port", type=int, default=50001,
+                        help="port to listen for status messages on")
+    parser.add_argument("--http-host", default="127.0.0.1",
+                        help="host to serve metrics on")
+    parser.add_argument("--http-port", type=int, default=9150,
+                        help="port to serve metrics on")
+    parser.add_argument("--rate-window", type=float, default=30.,
+                        help="window in seconds for computing task rates")
+    parser.add_argument("--retention", type=float, default=3600.,
+                        help="seconds to keep finished pipelines")
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    MonitorDaemon(udp_port=args.udp_port, http_host=args.http_host,
+                  http_port=args.http_port, rate_window=args.rate_window,
+                  retention=args.retention).serve_forever()
+
+
+if __name__ == "__main__":  # pragma: nocover
+    main()
@@ -1,10 +1,38 @@
 from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import copy
 from getpass import getuser
+import logging
 import os
-from typing import Any, List, Union
+from typing import (
+    TYPE_CHECKING, Any, ContextManager, Dict, Hashable, Iterable, List,
+    Optional, Tuple, Union
+)
 
+import dask
 from dask.delayed import Delayed, delayed
 
+from .codec import CodecRecorder
+from .estimate import Estimate, estimate, format_estimate
+from .files import FileDeps, FileStampRecorder, expand_paths, prune_up_to_date
+from .graph import is_task, task_graph, task_name, to_delayed, wrap_tasks
+from .history import HistoryRecorder, TaskHistory
+from .hooks import PipelineCallback, StatusTask
+from .locality import LocalityPlacement, locality_hints
+from .memory import memory_request
+from .profiling import Profiler
+from .retry import RetryingTask, RetryPolicy
+from .scheduling import (
+    KeyLookup, PriorityCallback, priorities, task_costs, upward_ranks
+)
+from .speculative import SpeculativeExecutor
+
+if TYPE_CHECKING:
+    from .codec import ResultCodec
+    from .plugins import WorkerSetup
+
+logger = logging.getLogger("cml.pipelines")
+
 CLUSTER_DEFAULTS = {
     "queue": "RAM.q",
     "memory": "8G",
@@ -13,9 +41,81 @@ CLUSTER_DEFAULTS = {
     "local_directory": os.path.join("/", "scratch", getuser(), "dask")
 }
 
+# seconds to wait for cluster workers to connect before asking them which
+# input files they hold
+LOCALITY_WORKER_TIMEOUT = 120.
+
+# attributes holding the options and per-task state of a run
+_RUN_STATE = ("_run_options", "_task_cost_hints", "_task_retry_policies",
+              "_task_files", "_task_locality")
+
+
+def _default_client():
+    """Return the default distributed client or None if there isn't one."""
+    try:
+        from distributed import default_client
+        return default_client()
+    except (ImportError, ValueError):
+        return None
+
+
+def _get_history(
+        history: Union[TaskHistory, str, bool, None]) -> Optional[TaskHistory]:
+    """Convert the ``history`` argument of :meth:`Pipeline.run` to a
+    :class:`TaskHistory` instance or None.
+
+    """
+    if history is True:
+        return TaskHistory()
+    elif isinstance(history, str):
+        return TaskHistory(history)
+    return history or None
+
 
 class Pipeline(object):
-    """Base class for building pipelines."""
+    """Base class for building pipelines.
+
+    Attributes
+    ----------
+    cost_hints
+        Expected cost in seconds of task functions by name. These take
+        precedence over recorded history when prioritizing tasks (see the
+        ``prioritize`` option of :meth:`run`). Costs of individual tasks can
+        be given with :meth:`hint_cost`.
+    retry_policies
+        :class:`RetryPolicy` to apply to task functions by name. Policies for
+        individual tasks can be given with :meth:`retry_task`.
+    preload_modules
+        Names of modules which workers should import when they start rather
+        than when running their first task (see :meth:`worker_plugin`).
+    result_codec
+        A :class:`cml_pipelines.codec.ResultCodec` to encode large task
+        results with so that less data is transferred between workers and
+        spilled to disk. Compression ratios and throughput are logged when
+        a run finishes.
+
+    """
+    cost_hints = {}  # type: Dict[str, float]
+    retry_policies = {}  # type: Dict[str, RetryPolicy]
+    preload_modules = []  # type: List[str]
+    result_codec = None  # type: Optional[ResultCodec]
+
+    # options for the current call to run
+    _run_options = {}  # type: dict
+
+    # costs of individual tasks by key set with hint_cost
+    _task_cost_hints = {}  # type: Dict[Hashable, float]
+
+    # retry policies of individual tasks by key set with retry_task
+    _task_retry_policies = {}  # type: Dict[Hashable, RetryPolicy]
+
+    # files of individual tasks by key set with declare_files
+    _task_files = {}  # type: Dict[Hashable, FileDeps]
+
+    # input files and preferred workers of tasks by key set with
+    # hint_locality
+    _task_locality = {}  # type: Dict[Hashable, Tuple[List[str], List[str]]]
+
     def build(self) -> Delayed:
         """Override this method to define a pipeline. This method must return a
         :class:`Delayed` instance. This is most easily accomplished by returning
@@ -69,23 +169,490 @@ class Pipeline(object):
         if return_all:
             return results
 
-    def _run_async(self):
+    def hint_cost(self, task: Delayed, cost: float) -> Delayed:
+        """Give the expected cost in seconds of a single task. Call this from
+        :meth:`build` when costs vary between tasks of the same function, e.g.,
+        with the length of a subject's recording:
+
+        .. code:: python
+
+            def build(self):
+                spectra = [
+                    self.hint_cost(self.morlet(eeg), n_events * 0.5)
+                    for eeg, n_events in zip(eegs, self.event_counts)
+                ]
+
+        Only the relative magnitude of costs matters.
+
+        Returns
+        -------
+        The task (to allow chaining).
+
+        """
+        if "_task_cost_hints" not in self.__dict__:
+            self._task_cost_hints = {}
+        self._task_cost_hints[task.key] = cost
+        return task
+
+    def retry_task(self, task: Delayed, policy: RetryPolicy) -> Delayed:
+        """Retry a single task according to ``policy`` if it fails. Call this
+        from :meth:`build`. This takes precedence over
+        :attr:`retry_policies`.
+
+        Returns
+        -------
+        The task (to allow chaining).
+
+        """
+        if "_task_retry_policies" not in self.__dict__:
+            self._task_retry_policies = {}
+        self._task_retry_policies[task.key] = policy
+        return task
+
+    def declare_files(self, task: Delayed, outputs: Any, inputs: Any = (),
+                      result: Any = None) -> Delayed:
+        """Declare the files a task writes and reads. Call this from
+        :meth:`build`. When running, tasks whose outputs are all newer than
+        their inputs are skipped along with any upstream tasks which are only
+        needed by them (see :mod:`cml_pipelines.files`):
+
+        .. code:: python
+
+            def build(self):
+                ...
+                npy_paths = [self.tempdir.joinpath(subject + ".npy")
+                             for subject in self.subjects]
+                saved = [
+                    self.declare_files(self.save(subject, pow), path)
+                    for subject, pow, path in zip(self.subjects, powers,
+                                                  npy_paths)
+                ]
+                return self.declare_files(self.combine(saved),
+                                          self.output_filename,
+                                          inputs=npy_paths)
+
+        Parameters
+        ----------
+        task
+            The task.
+        outputs
+            Path, :class:`FilePaths` instance or a list of either giving the
+            files written by the task.
+        inputs
+            Files read by the task in the same form as ``outputs``. Inputs
+            which don't exist yet are expected to be written by upstream
+            tasks.
+        result
+            Result to use in place of running the task when it is up to date.
+            Defaults to ``outputs``.
+
+        Returns
+        -------
+        The task (to allow chaining).
+
+        """
+        if "_task_files" not in self.__dict__:
+            self._task_files = {}
+        self._task_files[task.key] = FileDeps(
+            expand_paths(inputs), expand_paths(outputs),
+            outputs if result is None else result
+        )
+        return task
+
+    def hint_locality(self, task: Delayed, paths: Any = (),
+                      workers: Iterable[str] = ()) -> Delayed:
+        """Give files a task reads or workers it should preferably run on.
+        Call this from :meth:`build`. With the ``locality`` option of
+        :meth:`run`, tasks are placed on workers which hold the most of their
+        input files (these and any declared with :meth:`declare_files`) on a
+        local file system, e.g., after staging them to local scratch:
+
+        .. code:: python
+
+            def build(self):
+                eegs = [self.hint_locality(self.load_eeg(path), path)
+                        for path in self.staged_paths]
+                ...
+
+        Parameters
+        ----------
+        task
+            The task.
+        paths
+            Path, :class:`FilePaths` instance or a list of either giving the
+            files read by the task.
+        workers
+            Addresses or hostnames of workers to prefer regardless of files.
+
+        Returns
+        -------
+        The task (to allow chaining).
+
+        """
+        if "_task_locality" not in self.__dict__:
+            self._task_locality = {}
+        self._task_locality[task.key] = (expand_paths(paths), list(workers))
+        return task
+
+    def _locality_placement(self, collection: Delayed
+                            ) -> Optional[LocalityPlacement]:
+        """Determine the preferred workers of tasks to run them on."""
+        client = _default_client()
+        if client is None:
+            logger.warning("Locality-aware placement requires a distributed "
+                           "cluster; running normally")
+            return None
+
+        # workers requested from the cluster may still be starting up
+        from distributed import TimeoutError as WaitTimeout
+
+        n_workers = self._run_options.get("workers") or 1
+        try:
+            client.wait_for_workers(n_workers,
+                                    timeout=LOCALITY_WORKER_TIMEOUT)
+        except WaitTimeout:
+            logger.warning(
+                "Only %d of %d workers connected after %.0f s; placing tasks "
+                "on connected workers only",
+                len(client.scheduler_info(n_workers=-1)["workers"]),
+                n_workers, LOCALITY_WORKER_TIMEOUT)
+
+        dsk = task_graph(collection)
+        task_paths = {key: list(deps.inputs)
+                      for key, deps in self._task_files.items()}
+        task_workers = {}
+        for key, (paths, workers) in self._task_locality.items():
+            task_paths[key] = task_paths.get(key, []) + paths
+            if workers:
+                task_workers[key] = workers
+
+        hints = locality_hints(
+            client,
+            {key: paths for key, paths in task_paths.items() if key in dsk},
+            {key: w for key, w in task_workers.items() if key in dsk})
+        if not hints:
+            logger.warning("No preferred workers found for any task; "
+                           "running without locality-aware placement")
+            return None
+        logger.info("Found preferred workers for %d of %d tasks", len(hints),
+                    len(dsk))
+        return LocalityPlacement(client, hints)
+
+    def _skip_up_to_date(self, collection: Delayed,
+                         history: Optional[TaskHistory]) -> Delayed:
+        """Remove up-to-date tasks with declared files from the graph."""
+        stamps = {}
+        if history is not None:
+            stamps = history.file_stamps(
+                path for deps in self._task_files.values()
+                for path in deps.outputs)
+
+        dsk, skipped = prune_up_to_date(task_graph(collection), collection.key,
+                                        self._task_files, stamps)
+        if skipped:
+            logger.info("Skipping %d of %d tasks with up-to-date outputs",
+                        len(skipped), len(self._task_files))
+        for key in skipped:
+            del self._task_files[key]
+        return to_delayed(dsk, collection.key)
+
+    def _wrap_retry(self, key: Hashable, func):
+        policy = self._task_retry_policies.get(
+            key, self.retry_policies.get(task_name(key)))
+        if policy is None:
+            return func
+        return RetryingTask(key, func, policy,
+                            self._run_options.get("publisher"))
+
+    def publish(self, msg_type: str, **kwargs):
+        """Publish a status message from within a task through the
+        :class:`PipelineCallback` passed to :meth:`run`. This works from
+        worker processes as well. Does nothing when no callback was given.
+
+        """
+        publisher = self._run_options.get("publisher")
+        if publisher is not None:
+            publisher.publish(msg_type, **kwargs)
+
+    def setup_worker(self):
+        """Override this method to prepare each worker before it runs any
+        tasks, e.g., to load lookup tables shared by tasks or to warm file
+        caches. When running locally, this is called once per call to
+        :meth:`run`. It may be called more than once per worker so it should
+        be idempotent.
+
+        """
+
+    def worker_plugin(self) -> "WorkerSetup":
+        """Return a worker plugin which imports :attr:`preload_modules` and
+        calls :meth:`setup_worker` when a worker starts. This is registered
+        automatically when running with ``cluster=True``. To use it with your
+        own cluster, register it before starting workers:
+
+        .. code:: python
+
+            client.register_plugin(pipeline.worker_plugin())
+
+        """
+        from .plugins import WorkerSetup
+
+        hooks = []
+        if type(self).setup_worker is not Pipeline.setup_worker:
+            hooks.append(self.setup_worker)
+        return WorkerSetup(self.preload_modules, hooks,
+                           name="cml-pipelines-setup-" + type(self).__name__)
+
+    def task_costs(self, dsk: Dict[Hashable, Any]) -> Dict[Hashable, float]:
+        """Determine the expected cost of each task in a graph built by this
+        pipeline using (in order of precedence) per-task hints,
+        :attr:`cost_hints` and the task history passed to :meth:`run`.
+
+        """
+        history = self._run_options.get("history")
+        durations = {}
+        if history is not None:
+            durations = history.mean_durations(pipeline=type(self).__name__)
+        return task_costs(dsk, durations, self.cost_hints,
+                          self._task_cost_hints)
+
+    def estimate(self, workers: int = 8,
+                 history: Union[TaskHistory, str, bool] = None,
+                 force: bool = False) -> Estimate:
+        """Build and optimize the graph without running it and estimate the
+        resources needed to run it. This can be used to choose ``workers`` and
+        ``cluster_kwargs`` for :meth:`run`.
+
+        Parameters
+        ----------
+        workers
+            Number of workers to estimate the wall-clock time for.
+        history
+            Task history to take expected durations and memory use from (see
+            :meth:`run`). Costs given with :meth:`hint_cost` and
+            :attr:`cost_hints` take precedence.
+        force
+            Include tasks whose declared output files are up to date (see
+            :meth:`declare_files`).
+
+        Returns
+        -------
+        Task counts by function, graph depth and width and estimated
+        wall-clock time and memory use (see
+        :class:`cml_pipelines.estimate.Estimate`).
+
+        """
+        history = _get_history(history)
+
+        # build a copy so that the state of a run in progress is left alone
+        pipeline = copy.copy(self)
+        pipeline._run_options = {"history": history}
+        pipeline._task_cost_hints = {}
+        pipeline._task_retry_policies = {}
+        pipeline._task_files = {}
+        pipeline._task_locality = {}
+        collection = pipeline.build()
+        if pipeline._task_files and not force:
+            collection = pipeline._skip_up_to_date(collection, history)
+        collection, = dask.optimize(collection)
+        dsk = task_graph(collection)
+        costs = pipeline.task_costs(dsk)
+
+        summary = {}
+        if history is not None:
+            summary = history.summary(pipeline=type(self).__name__)
+        memory = {key: summary[task_name(key)].max_peak_memory
+                  for key, node in dsk.items()
+                  if is_task(node) and task_name(key) in summary and
+                  summary[task_name(key)].max_peak_memory is not None}
+
+        known = set(summary) | set(self.cost_hints) | {
+            task_name(key) for key in pipeline._task_cost_hints}
+        unknown = {task_name(key) for key, node in dsk.items()
+                   if is_task(node)} - known
+
+        return estimate(dsk, costs, workers, memory, unknown)
+
+    def worker_memory(self, history: Union[TaskHistory, str, bool] = True,
+                      headroom: float = 0.25) -> Optional[str]:
+        """Determine how much memory to request for each cluster worker from
+        the highest peak memory recorded for any task of this pipeline.
+
+        Parameters
+        ----------
+        history
+            Task history to use (see :meth:`run`).
+        headroom
+            Fraction of the recorded peak memory to add.
+
+        Returns
+        -------
+        A memory request such as ``"12G"`` or None if no task memory use has
+        been recorded.
+
+        """
+        history = _get_history(history)
+        if history is None:
+            return None
+
+        summary = history.summary(pipeline=type(self).__name__)
+        peaks = [s.max_peak_memory for s in summary.values()
+                 if s.max_peak_memory is not None]
+        if not peaks:
+            return None
+        return memory_request(max(peaks), headroom)
+
+    @contextmanager
+    def _run_state(self, options: dict):
+        """Set the options of a run, restoring the options and per-task state
+        of any other run on exit.
+
+        """
+        saved = {name: self.__dict__[name] for name in _RUN_STATE
+                 if name in self.__dict__}
+        self._run_options = options
+        try:
+            yield
+        finally:
+            for name in _RUN_STATE:
+                if name in saved:
+                    setattr(self, name, saved[name])
+                else:
+                    self.__dict__.pop(name, None)
+
+    def _prepare(self) -> Tuple[Delayed, List[ContextManager]]:
+        """Build the pipeline and apply any transformations requested by the
+        options passed to :meth:`run`.
+
+        Returns
+        -------
+        collection
+            The collection to compute.
+        contexts
+            Context managers to enter while computing.
+
+        """
+        self._task_cost_hints = {}
+        self._task_retry_policies = {}
+        self._task_files = {}
+        self._task_locality = {}
+        collection = self.build()
+        contexts = []
+        history = self._run_options.get("history")
+
+        if self._task_files:
+            if not self._run_options.get("force"):
+                collection = self._skip_up_to_date(collection, history)
+            if history is not None:
+                contexts.append(FileStampRecorder(history,
+                                                  dict(self._task_files)))
+
+        if self._run_options.get("locality"):
+            placement = self._locality_placement(collection)
+            if placement is not None:
+                contexts.append(placement)
+
+        if self.retry_policies or self._task_retry_policies:
+            dsk = wrap_tasks(task_graph(collection), self._wrap_retry)
+            collection = to_delayed(dsk, collection.key)
+
+        if self.result_codec is not None:
+            codec_recorder = CodecRecorder(self.result_codec)
+            collection = codec_recorder.instrument(collection)
+            contexts.append(codec_recorder)
+
+        if self._run_options.get("prioritize"):
+            dsk = task_graph(collection)
+            ranks = upward_ranks(dsk, self.task_costs(dsk))
+            prios = priorities(ranks)
+            contexts.append(PriorityCallback(prios))
+            contexts.append(dask.annotate(priority=KeyLookup(prios)))
+
+        if history is not None:
+            recorder = HistoryRecorder(history, type(self).__name__)
+            collection = recorder.instrument(collection)
+            contexts.append(recorder)
+
+        profile = self._run_options.get("profile")
+        if profile is not None:
+            if isinstance(profile, dict):
+                profiler = Profiler(**profile)
+            else:
+                profiler = Profiler(profile)
+            collection = profiler.instrument(collection)
+            contexts.append(profiler)
+
+        return collection, contexts
+
+    def _compute(self, collection: Delayed, contexts: List[ContextManager],
+                 **kwargs) -> Any:
+        with ExitStack() as stack:
+            for context in contexts:
+                stack.enter_context(context)
+
+            speculative = self._run_options.get("speculative")
+            if speculative and "scheduler" not in kwargs:
+                client = _default_client()
+                if client is not None:
+                    options = speculative if isinstance(speculative, dict) else {}
+                    executor = SpeculativeExecutor(client,
+                                                   task_graph(collection),
+                                                   collection.key, **options)
+                    return executor.run()
+                logger.warning("Speculative execution requires a "
+                               "distributed cluster; running normally")
+
+            return collection.compute(**kwargs)
+
+    def _add_callback(self, collection: Delayed,
+                      contexts: List[ContextManager], callback,
+                      debug: bool = False) -> Delayed:
+        """Publish the status of computing ``collection`` with ``callback``.
+        Dask callbacks aren't called by the distributed scheduler so tasks
+        publish their own progress which is relayed through the client.
+
+        """
+        client = None if debug else _default_client()
+        if client is None:
+            contexts.append(callback)
+            return collection
+
+        publisher = self._run_options["publisher"]
+        dsk = wrap_tasks(task_graph(collection),
+                         lambda key, func: StatusTask(key, func, publisher))
+        contexts.append(callback.relay(client, dsk, publisher))
+        return to_delayed(dsk, collection.key)
+
+    def _run_async(self, callback=None):
         with ThreadPoolExecutor(max_workers=1) as executor:
-            pipeline = self.build()
-            future = executor.submit(pipeline.compute)
+            pipeline, contexts = self._prepare()
+            if callback is not None:
+                pipeline = self._add_callback(pipeline, contexts, callback)
+            future = executor.submit(self._compute, pipeline, contexts)
             return future
 
-    def _run_sync(self, debug: bool):
-        pipeline = self.build()
+    def _run_sync(self, debug: bool, callback=None):
+        pipeline, contexts = self._prepare()
+        if callback is not None:
+            pipeline = self._add_callback(pipeline, contexts, callback,
+                                          debug)
         kwargs = {"scheduler": "single-threaded"} if debug else {}
-        result = pipeline.compute(**kwargs)
+        result = self._compute(pipeline, contexts, **kwargs)
         return result
 
     def run(self, block: bool = True,
             cluster: bool = False,
             cluster_kwargs: dict = None,
             workers: int = 8,
-            debug: bool = False) -> Union[Future, Any]:
+            debug: bool = False,
+            history: Union[TaskHistory, str, bool] = None,
+            prioritize: bool = False,
+            speculative: Union[bool, dict] = False,
+            profile: Union[str, dict] = None,
+            auto_memory: Union[bool, float] = False,
+            locality: bool = False,
+            force: bool = False,
+            dry_run: bool = False,
+            callback: PipelineCallback = None) -> Union[Future, Estimate, Any]:
         """Run the pipeline.
 
         Parameters
@@ -94,7 +661,9 @@ class Pipeline(object):
             When True (the default), block until completion. Otherwise, return
             a :class:`Future`.
         cluster
-            When True, run on rhino's SGE cluster (default: False).
+            When True, run on rhino's SGE cluster (default: False). Workers
+            import :attr:`preload_modules` and call :meth:`setup_worker`
+            when they start.
         cluster_kwargs
             A dict of keyword arguments to pass to :class:`SGECluster`. See
             ``CLUSTER_DEFAULTS`` for default values.
@@ -104,6 +673,56 @@ class Pipeline(object):
         debug
             When True, disable the cluster and use the single-threaded dask
             scheduler for debugging.
+        history
+            When given, record the duration, input size and memory use of
+            every task in a :class:`TaskHistory`. This can be a
+            :class:`TaskHistory` instance, a path to the database file or
+            True to use the default location. Task functions which run
+            significantly slower than in previous runs are logged as warnings.
+        prioritize
+            When True, start tasks on the longest chains of expected work
+            first. Expected costs come from :meth:`hint_cost`,
+            :attr:`cost_hints` and ``history`` (see :meth:`task_costs`).
+        speculative
+            When running on the cluster, start a duplicate of any task marked
+            with the :func:`cml_pipelines.speculative.idempotent` decorator
+            which runs much longer than other tasks of the same function and
+            use whichever copy finishes first. A dict of options for
+            :class:`cml_pipelines.speculative.SpeculativeExecutor` can be
+            given instead of True.
+        profile
+            When given, sample the call stacks of all running tasks and write
+            a flame graph compatible file of stacks for each task function to
+            this directory. A dict of options for
+            :class:`cml_pipelines.profiling.Profiler` can be given instead,
+            e.g., ``{"output_dir": "profiles", "deterministic": True}`` to
+            also profile each task with :mod:`cProfile`.
+        auto_memory
+            When running on the cluster, request as much memory for each
+            worker as the highest peak memory recorded in ``history`` for any
+            task of this pipeline plus 25% (or the given fraction) rather
+            than the ``memory`` in ``cluster_kwargs``. Has no effect if no
+            memory use has been recorded.
+        locality
+            When running on a cluster, run tasks on workers which hold their
+            input files on a local file system (see :meth:`hint_locality`).
+            A task may still run on another worker when none of its
+            preferred workers is connected or by work stealing when they are
+            busy. Workers are only considered if they connect within
+            ``LOCALITY_WORKER_TIMEOUT`` seconds of the run starting.
+        force
+            Run all tasks, including those whose declared output files are up
+            to date (see :meth:`declare_files`).
+        dry_run
+            When True, log and return an estimate of the resources needed to
+            run the pipeline on ``workers`` workers instead of running it (see
+            :meth:`estimate`). No cluster is started.
+        callback
+            A :class:`PipelineCallback` to publish status messages with.
+            Messages published by tasks, e.g., retries (see :meth:`publish`),
+            are relayed through the client when running on a distributed
+            cluster so the listener only needs to be reachable from this
+            host.
 
         Returns
         -------
@@ -112,6 +731,15 @@ class Pipeline(object):
         is complete.
 
         """
+        history = _get_history(history)
+        n_workers = None
+
+        if dry_run:
+            result = self.estimate(workers, history, force)
+            logger.info("Estimate for %s:\n%s", type(self).__name__,
+                        format_estimate(result))
+            return result
+
         if cluster and not debug:
             from dask_jobqueue import SGECluster
             from dask.distributed import Client
@@ -122,11 +750,49 @@ class Pipeline(object):
                 kwargs = CLUSTER_DEFAULTS.copy()
                 kwargs.update(cluster_kwargs)
 
+            if auto_memory:
+                headroom = 0.25 if auto_memory is True else auto_memory
+                memory = self.worker_memory(history, headroom)
+                if memory is None:
+                    logger.warning("No recorded memory use for %s; "
+                                   "requesting %s per worker",
+                                   type(self).__name__, kwargs["memory"])
+                else:
+                    logger.info("Requesting %s per worker from recorded "
+                                "memory use", memory)
+                    kwargs = dict(kwargs, memory=memory)
+
             cluster = SGECluster(**kwargs)
+            client = Client(cluster)
+            client.register_plugin(self.worker_plugin())
             cluster.scale(workers)
-            _ = Client(cluster)
+            n_workers = workers
+        elif _default_client() is None or debug:
+            self.worker_plugin().setup()
+
+        options = {
+            "history": history,
+            "prioritize": prioritize,
+            "speculative": speculative,
+            "profile": profile,
+            "locality": locality,
+            "workers": n_workers,
+            "force": force,
+            "publisher": callback.publisher() if callback is not None
+            else None,
+        }
 
         if not block and not debug:
-            return self._run_async()
+            # keep the state of this run until it completes
+            state = ExitStack()
+            state.enter_context(self._run_state(options))
+            try:
+                future = self._run_async(callback)
+            except BaseException:
+                state.close()
+                raise
+            future.add_done_callback(lambda _: state.close())
+            return future
         else:
-            return self._run_sync(debug)
+            with self._run_state(options):
+                return self._run_sync(debug, callback)
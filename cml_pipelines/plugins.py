@@ -0,0 +1,81 @@
+"""Distributed plugins used by pipelines.
+
+This module imports :mod:`distributed` so it is only imported when setting up
+a run on a distributed cluster (see :meth:`Pipeline.worker_plugin`), keeping
+it out of ``import cml_pipelines``.
+
+"""
+
+import importlib
+import logging
+import time
+from typing import Callable, Iterable
+
+from distributed import WorkerPlugin
+
+from .preload import WorkerStartup
+
+logger = logging.getLogger("cml.pipelines")
+
+
+class WorkerSetup(WorkerPlugin):
+    """Worker plugin which imports modules and runs setup hooks when a
+    worker starts. Register it with a distributed client before starting
+    workers:
+
+    .. code:: python
+
+        client.register_plugin(WorkerSetup(["scipy.signal"]))
+        cluster.scale(8)
+
+    Parameters
+    ----------
+    modules
+        Names of modules to import.
+    hooks
+        Functions to call with no arguments after importing modules. Since
+        hooks run again if the plugin is registered again, they should be
+        idempotent.
+    name
+        Plugin name. Registering a plugin with the same name replaces it.
+
+    """
+    def __init__(self, modules: Iterable[str] = (),
+                 hooks: Iterable[Callable[[], None]] = (),
+                 name: str = "cml-pipelines-setup"):
+        self.modules = list(modules)
+        self.hooks = list(hooks)
+        self.name = name
+
+        self.started = None
+        self.setup_duration = None
+        self._task_started = None
+        self.first_task = None
+        self.time_to_first_task = None
+
+    def setup(self, worker=None):
+        self.started = time.time()
+        for module in self.modules:
+            importlib.import_module(module)
+        for hook in self.hooks:
+            hook()
+        self.setup_duration = time.time() - self.started
+
+        if self.modules or self.hooks:
+            logger.debug("Worker setup took %.2f s", self.setup_duration)
+
+    def transition(self, key, start, finish, **kwargs):
+        if self.time_to_first_task is not None:
+            return
+
+        now = time.time()
+        if finish == "executing":
+            self._task_started = now
+        elif start == "executing" and self._task_started is not None:
+            self.first_task = now - self._task_started
+            self.time_to_first_task = now - self.started
+
+    def startup(self) -> WorkerStartup:
+        """Return the startup times recorded on this worker."""
+        return WorkerStartup(self.started, self.setup_duration,
+                             self.first_task, self.time_to_first_task)
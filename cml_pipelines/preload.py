@@ -0,0 +1,55 @@
+"""Preparing workers before they run their first task.
+
+Workers started on the cluster import the modules used by tasks lazily when
+running their first task. With large packages on a network file system this
+can take tens of seconds and delays every worker's first result. A
+:class:`cml_pipelines.plugins.WorkerSetup` plugin imports modules and runs
+setup hooks (e.g., to load shared lookup tables or warm file caches) as soon
+as a worker starts and records how long it takes each worker to finish its
+first task. The times are collected with :func:`worker_startup_times`.
+
+"""
+
+from collections import namedtuple
+from typing import Dict
+
+WorkerStartup = namedtuple("WorkerStartup", "started,setup,first_task,"
+                                            "time_to_first_task")
+WorkerStartup.__doc__ = """Startup times of a worker in seconds.
+
+``started`` is the time (since the epoch) the worker started setup, ``setup``
+is the time spent importing modules and running setup hooks,
+``first_task`` the duration of the first task and ``time_to_first_task`` the
+time from the worker starting setup to finishing its first task. The last
+two are None if the worker has not finished a task yet.
+
+"""
+
+
+def _worker_startup(name: str, dask_worker=None) -> WorkerStartup:
+    plugin = dask_worker.plugins.get(name)
+    if plugin is None:
+        return None
+    return plugin.startup()
+
+
+def worker_startup_times(
+        client, name: str = "cml-pipelines-setup") -> Dict[str, WorkerStartup]:
+    """Collect the startup times recorded by a
+    :class:`cml_pipelines.plugins.WorkerSetup` plugin on every worker.
+
+    Parameters
+    ----------
+    client
+        Distributed client.
+    name
+        Name the plugin was registered with.
+
+    Returns
+    -------
+    :class:`WorkerStartup` by worker address (None for workers without the
+    plugin).
+
+    """
+    return client.run(_worker_startup, name)
+
@@ -0,0 +1,334 @@
+"""Profiling tasks wherever they run.
+
+When profiling, every task is wrapped so that while it runs a sampling thread
+in the same process periodically records the task's call stack. Optionally,
+each task is also run under :mod:`cProfile`. Samples and profiles are
+buffered per process (on the workers when running on the cluster), gathered
+when the run finishes and merged by task function.
+
+Sampled stacks are written in the "folded" format used by Brendan Gregg's
+``flamegraph.pl``, speedscope and similar tools (one ``frame;frame;frame
+count`` line per distinct stack) and deterministic profiles as
+:mod:`pstats` files (which can be viewed with snakeviz or converted with
+flameprof).
+
+"""
+
+from collections import Counter, defaultdict
+import cProfile
+import logging
+import os
+import pstats
+import sys
+from threading import Event, Lock, Thread, get_ident
+from typing import Dict, Hashable, List, Optional, Tuple
+from uuid import uuid4
+
+from dask.delayed import Delayed
+
+from .graph import TaskWrapper, task_graph, task_name, to_delayed, wrap_tasks
+
+logger = logging.getLogger("cml.pipelines")
+
+# thread ID -> (run ID, task name) of tasks currently running in this process
+_active = {}  # type: Dict[int, Tuple[str, str]]
+
+# run ID -> task name -> folded stack -> number of samples
+_samples = defaultdict(lambda: defaultdict(Counter))
+
+# run ID -> task name -> raw cProfile statistics of each task
+_profiles = defaultdict(lambda: defaultdict(list))
+
+# run ID -> task name -> number of tasks which couldn't run under cProfile
+_unprofiled = defaultdict(Counter)
+
+_lock = Lock()
+_sampler = None  # type: Optional[_Sampler]
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def _folded_stack(frame, name: str) -> str:
+    """Return the stack of ``frame`` up to the enclosing
+    :class:`ProfilingTask` as a folded stack rooted at the task name.
+
+    """
+    stack = []
+    while frame is not None and frame.f_code is not _CALL_CODE:
+        if frame.f_code is not _CALL_PROFILED_CODE:
+            stack.append(_format_frame(frame))
+        frame = frame.f_back
+    stack.append(name)
+    return ";".join(reversed(stack))
+
+
+class _Sampler(Thread):
+    """Thread which samples the stacks of running tasks in this process
+    until there are none left.
+
+    """
+    def __init__(self, interval: float):
+        super(_Sampler, self).__init__(name="cml-pipelines-profiler",
+                                       daemon=True)
+        self.interval = interval
+        self._stopped = Event()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with _lock:
+            for ident, (run_id, name) in _active.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = _folded_stack(frame, name)
+                    _samples[run_id][name][stack] += 1
+
+    def run(self):
+        global _sampler
+
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            with _lock:
+                if not _active:
+                    _sampler = None
+                    return
+
+
+def _start_sampler(interval: float):
+    global _sampler
+
+    with _lock:
+        if _sampler is None:
+            _sampler = _Sampler(interval)
+            _sampler.start()
+
+
+class _RawStats(object):
+    """Adapter to load raw statistics into :class:`pstats.Stats`."""
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class ProfilingTask(TaskWrapper):
+    """Wrap a task function to profile it.
+
+    Parameters
+    ----------
+    run_id
+        Unique ID of the current run.
+    key
+        Task key.
+    func
+        The task function.
+    interval
+        Seconds between stack samples.
+    deterministic
+        When True, also run the task under :mod:`cProfile`.
+
+    """
+    def __init__(self, run_id: str, key: Hashable, func,
+                 interval: float = 0.01, deterministic: bool = False):
+        super(ProfilingTask, self).__init__(key, func)
+        self.run_id = run_id
+        self.name = task_name(key)
+        self.interval = interval
+        self.deterministic = deterministic
+
+    def _call_profiled(self, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this thread or process so the
+            # task is only sampled
+            with _lock:
+                _unprofiled[self.run_id][self.name] += 1
+            return self.func(*args, **kwargs)
+
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            profile.disable()
+            profile.create_stats()
+            with _lock:
+                _profiles[self.run_id][self.name].append(profile.stats)
+
+    def __call__(self, *args, **kwargs):
+        ident = get_ident()
+        with _lock:
+            _active[ident] = (self.run_id, self.name)
+        _start_sampler(self.interval)
+
+        try:
+            if self.deterministic:
+                return self._call_profiled(*args, **kwargs)
+            return self.func(*args, **kwargs)
+        finally:
+            with _lock:
+                del _active[ident]
+
+
+_CALL_CODE = ProfilingTask.__call__.__code__
+_CALL_PROFILED_CODE = ProfilingTask._call_profiled.__code__
+
+
+def drain_profiles(run_id: str) -> Tuple[Dict[str, Counter],
+                                         Dict[str, List[dict]], Counter]:
+    """Remove and return the stack samples, deterministic profiles and
+    number of tasks which couldn't be profiled deterministically by task
+    function for the given run from this process' buffers.
+
+    """
+    with _lock:
+        samples = _samples.pop(run_id, {})
+        profiles = _profiles.pop(run_id, {})
+        unprofiled = _unprofiled.pop(run_id, Counter())
+    return ({name: Counter(stacks) for name, stacks in samples.items()},
+            {name: list(stats) for name, stats in profiles.items()},
+            unprofiled)
+
+
+def collect_profiles(run_id: str) -> Tuple[Dict[str, Counter],
+                                           Dict[str, pstats.Stats]]:
+    """Collect stack samples and deterministic profiles for a run from this
+    process and, if a distributed client is active, from all of its workers.
+
+    Returns
+    -------
+    samples
+        Number of samples of each folded stack by task function name.
+    stats
+        Merged deterministic profiles by task function name.
+
+    """
+    samples, stats, _ = _collect(run_id)
+    return samples, stats
+
+
+def _collect(run_id: str) -> Tuple[Dict[str, Counter],
+                                   Dict[str, pstats.Stats], Counter]:
+    results = [drain_profiles(run_id)]
+
+    try:
+        from distributed import default_client
+        client = default_client()
+    except (ImportError, ValueError):
+        pass
+    else:
+        results.extend(client.run(drain_profiles, run_id).values())
+
+    samples = defaultdict(Counter)
+    stats = {}
+    unprofiled = Counter()
+    for process_samples, process_profiles, process_unprofiled in results:
+        unprofiled.update(process_unprofiled)
+        for name, stacks in process_samples.items():
+            samples[name].update(stacks)
+        for name, raw_stats in process_profiles.items():
+            for raw in raw_stats:
+                if name in stats:
+                    stats[name].add(_RawStats(raw))
+                else:
+                    stats[name] = pstats.Stats(_RawStats(raw))
+
+    return dict(samples), stats, unprofiled
+
+
+def write_folded(samples: Counter, path: str):
+    """Write stack samples in the folded format read by ``flamegraph.pl``."""
+    with open(path, "w") as f:
+        for stack, count in sorted(samples.items()):
+            f.write("{} {}\n".format(stack, count))
+
+
+class Profiler(object):
+    """Profile every task of a pipeline run. Use as a context manager around
+    computing the instrumented collection::
+
+        profiler = Profiler("profiles")
+        collection = profiler.instrument(pipeline.build())
+        with profiler:
+            collection.compute()
+
+    When the run finishes, the ``output_dir`` contains a ``<name>.folded``
+    file of sampled stacks for every task function and, if ``deterministic``
+    is set, a ``<name>.prof`` file of merged :mod:`cProfile` statistics.
+
+    Parameters
+    ----------
+    output_dir
+        Directory to write profiles to. When not given, profiles are only
+        available from the :attr:`samples` and :attr:`stats` attributes.
+    interval
+        Seconds between stack samples.
+    deterministic
+        When True, also run each task under :mod:`cProfile`. This adds
+        overhead to every function call within tasks.
+
+    Attributes
+    ----------
+    samples
+        Number of samples of each folded stack by task function name.
+    stats
+        Merged :class:`pstats.Stats` by task function name.
+    unprofiled
+        Number of tasks by task function name which only had their stacks
+        sampled because another profiler was active when ``deterministic``
+        is set.
+
+    """
+    def __init__(self, output_dir: str = None, interval: float = 0.01,
+                 deterministic: bool = False):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.deterministic = deterministic
+        self.run_id = uuid4().hex
+
+        self.samples = {}  # type: Dict[str, Counter]
+        self.stats = {}  # type: Dict[str, pstats.Stats]
+        self.unprofiled = Counter()  # type: Counter
+
+    def instrument(self, collection: Delayed) -> Delayed:
+        """Return a copy of ``collection`` with every task wrapped in a
+        :class:`ProfilingTask`.
+
+        """
+        dsk = wrap_tasks(
+            task_graph(collection),
+            lambda key, func: ProfilingTask(self.run_id, key, func,
+                                            self.interval, self.deterministic)
+        )
+        return to_delayed(dsk, collection.key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.samples, self.stats, self.unprofiled = _collect(self.run_id)
+        if self.unprofiled:
+            logger.warning(
+                "%d tasks weren't profiled with cProfile because another "
+                "profiler was active; only their stacks were sampled: %s",
+                sum(self.unprofiled.values()),
+                ", ".join("{} ({})".format(name, n)
+                          for name, n in sorted(self.unprofiled.items())))
+
+        if self.output_dir is None:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        for name, samples in self.samples.items():
+            write_folded(samples,
+                         os.path.join(self.output_dir, name + ".folded"))
+        for name, stats in self.stats.items():
+            stats.dump_stats(os.path.join(self.output_dir, name + ".prof"))
+
+        logger.info("Wrote profiles of %d task functions to %s",
+                    len(set(self.samples) | set(self.stats)), self.output_dir)
@@ -0,0 +1,175 @@
+"""Retrying tasks which fail with transient errors.
+
+Retries happen inside the task itself so a retried task reuses the inputs it
+was already given: nothing upstream is recomputed. Policies can be applied to
+all tasks of a function with :attr:`Pipeline.retry_policies`, to individual
+tasks with :meth:`Pipeline.retry_task` or to any function with the
+:func:`retry` decorator.
+
+Note that the loss of a worker on the cluster is handled separately by the
+distributed scheduler which reschedules the tasks of lost workers (see the
+``distributed.scheduler.allowed-failures`` configuration option).
+
+"""
+
+import functools
+import logging
+import random
+import time
+from typing import Hashable, Tuple, Type
+
+from .graph import TaskWrapper
+
+logger = logging.getLogger("cml.pipelines")
+
+
+class RetryPolicy(object):
+    """Describes when and how often to retry a failed task.
+
+    Parameters
+    ----------
+    max_attempts
+        Maximum number of times to run the task (including the first).
+    backoff
+        Seconds to wait before the first retry.
+    factor
+        Multiply the wait by this factor after each retry.
+    max_backoff
+        Maximum number of seconds to wait between attempts.
+    jitter
+        Randomly vary each wait by up to this fraction to avoid many tasks
+        retrying in lockstep.
+    exceptions
+        Only retry when an instance of one of these exception types is raised.
+
+    """
+    def __init__(self, max_attempts: int = 3, backoff: float = 1.,
+                 factor: float = 2., max_backoff: float = 60.,
+                 jitter: float = 0.1,
+                 exceptions: Tuple[Type[BaseException], ...] = (OSError,)):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.exceptions = tuple(exceptions)
+
+    def __repr__(self):
+        return ("RetryPolicy(max_attempts={}, backoff={}, factor={}, "
+                "exceptions={})".format(self.max_attempts, self.backoff,
+                                        self.factor, self.exceptions))
+
+    def should_retry(self, exc: BaseException, attempt: int) -> bool:
+        """Check if a task should be retried after failing on the given
+        attempt (counting from 1).
+
+        """
+        return attempt < self.max_attempts and isinstance(exc, self.exceptions)
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the given failed attempt."""
+        delay = min(self.backoff * self.factor ** (attempt - 1),
+                    self.max_backoff)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0.)
+
+
+def _notify(publisher, msg_type: str, **kwargs):
+    if publisher is not None:
+        publisher.publish(msg_type, **kwargs)
+
+
+def call_with_retries(func, policy: RetryPolicy, key: Hashable, *args,
+                      **kwargs):
+    """Call ``func(*args, **kwargs)`` retrying according to ``policy``.
+
+    Each failed attempt is logged. When giving up, the last exception is
+    raised. Use :attr:`Pipeline.retry_policies` or :meth:`Pipeline.retry_task`
+    to also publish ``retry`` and ``task-failed`` messages with the
+    :class:`PipelineCallback` passed to :meth:`Pipeline.run`.
+
+    """
+    return _call_with_retries(func, policy, key, None, args, kwargs)
+
+
+def _call_with_retries(func, policy: RetryPolicy, key: Hashable, publisher,
+                       args: tuple, kwargs: dict):
+    attempt = 1
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as exc:
+            task = str(key)
+            if not policy.should_retry(exc, attempt):
+                _notify(publisher, "task-failed", task=task, attempt=attempt,
+                        error=repr(exc))
+                raise
+
+            delay = policy.delay(attempt)
+            logger.warning("Task %s failed on attempt %d of %d (%r); "
+                           "retrying in %.1f s", task, attempt,
+                           policy.max_attempts, exc, delay)
+            _notify(publisher, "retry", task=task, attempt=attempt,
+                    max_attempts=policy.max_attempts, error=repr(exc),
+                    delay=delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+class RetryingTask(TaskWrapper):
+    """Wrap a task function to retry it according to a policy.
+
+    Parameters
+    ----------
+    key
+        Task key.
+    func
+        Task function.
+    policy
+        Retry policy.
+    publisher
+        :class:`StatusPublisher` of the pipeline the task belongs to. When
+        not given, failed attempts are only logged.
+
+    """
+    def __init__(self, key: Hashable, func, policy: RetryPolicy,
+                 publisher=None):
+        super(RetryingTask, self).__init__(key, func)
+        self.policy = policy
+        self.publisher = publisher
+
+    def __call__(self, *args, **kwargs):
+        return _call_with_retries(self.func, self.policy, self.key,
+                                  self.publisher, args, kwargs)
+
+
+def retry(max_attempts: int = 3, **kwargs):
+    """Decorator to retry a function according to a :class:`RetryPolicy`.
+    Keyword arguments are passed to :class:`RetryPolicy`. Apply it below the
+    ``delayed`` decorator:
+
+    .. code:: python
+
+        class MyPipeline(Pipeline):
+            @delayed
+            @retry(max_attempts=5, exceptions=(OSError,))
+            def load_eeg(self, subject):
+                ...
+
+    """
+    policy = RetryPolicy(max_attempts, **kwargs)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call_with_retries(func, policy, func.__name__, *args,
+                                     **kwargs)
+
+        wrapper.retry_policy = policy
+        return wrapper
+
+    return decorator
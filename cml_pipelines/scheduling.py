@@ -0,0 +1,164 @@
+"""Task prioritization based on expected task costs.
+
+By default, dask orders tasks to minimize memory use without any knowledge of
+how long each task will take. When task durations are very uneven (e.g., a
+cohort with a few subjects with much longer recordings than the rest) this
+can result in the most expensive chain of tasks starting last. The functions
+here compute the *upward rank* of each task (its expected cost plus the
+largest upward rank of any task depending on it, i.e., the length of the
+critical path from the task to the end of the graph) and pass it to the
+scheduler so that the longest chains are started first.
+
+"""
+
+from typing import Any, Dict, Hashable, Mapping
+
+from dask.callbacks import Callback
+
+from .graph import dependencies, is_task, task_name
+
+
+class KeyLookup(dict):
+    """A dict which can be called with a key to look up a value, returning a
+    default for unknown keys. This is used to pass per-key annotations to the
+    distributed scheduler.
+
+    """
+    def __init__(self, values: Mapping, default: Any = 0):
+        super(KeyLookup, self).__init__(values)
+        self.default = default
+
+    def __call__(self, key: Hashable) -> Any:
+        return self.get(key, self.default)
+
+    def __reduce__(self):
+        return type(self), (dict(self), self.default)
+
+
+def task_costs(dsk: Dict[Hashable, Any], durations: Mapping[str, float] = None,
+               cost_hints: Mapping[str, float] = None,
+               task_cost_hints: Mapping[Hashable, float] = None,
+               default: float = None) -> Dict[Hashable, float]:
+    """Determine the expected cost of each task in a graph.
+
+    Costs are looked up in order of precedence from ``task_cost_hints`` (by
+    key), ``cost_hints`` (by task function name) and ``durations`` (by task
+    function name). Tasks with no known cost are assigned ``default``.
+
+    Parameters
+    ----------
+    dsk
+        Task graph.
+    durations
+        Historical mean durations by task function name (see
+        :meth:`TaskHistory.mean_durations`).
+    cost_hints
+        User-supplied costs by task function name.
+    task_cost_hints
+        User-supplied costs by task key.
+    default
+        Cost for tasks with no other information. Defaults to the mean of
+        all known costs or 1 if no costs are known.
+
+    Returns
+    -------
+    Expected cost of each key. Keys which are not function calls have zero
+    cost.
+
+    """
+    durations = durations or {}
+    cost_hints = cost_hints or {}
+    task_cost_hints = task_cost_hints or {}
+
+    costs = {}
+    unknown = []
+
+    for key, node in dsk.items():
+        name = task_name(key)
+        if not is_task(node):
+            costs[key] = 0.
+        elif key in task_cost_hints:
+            costs[key] = float(task_cost_hints[key])
+        elif name in cost_hints:
+            costs[key] = float(cost_hints[name])
+        elif name in durations:
+            costs[key] = float(durations[name])
+        else:
+            unknown.append(key)
+
+    if default is None:
+        known = [cost for cost in costs.values() if cost > 0]
+        default = sum(known) / len(known) if known else 1.
+
+    for key in unknown:
+        costs[key] = default
+
+    return costs
+
+
+def upward_ranks(dsk: Dict[Hashable, Any],
+                 costs: Mapping[Hashable, float]) -> Dict[Hashable, float]:
+    """Compute the upward rank of every task: its cost plus the maximum upward
+    rank of its dependents. This is the length of the longest (critical) path
+    from a task to any output of the graph.
+
+    """
+    deps = dependencies(dsk)
+    dependents = {key: [] for key in dsk}
+    for key, key_deps in deps.items():
+        for dep in key_deps:
+            dependents[dep].append(key)
+
+    ranks = {}
+    waiting = {key: len(dependents[key]) for key in dsk}
+    stack = [key for key, count in waiting.items() if count == 0]
+
+    while stack:
+        key = stack.pop()
+        ranks[key] = costs.get(key, 0.) + max(
+            (ranks[dependent] for dependent in dependents[key]), default=0.
+        )
+        for dep in deps[key]:
+            waiting[dep] -= 1
+            if waiting[dep] == 0:
+                stack.append(dep)
+
+    return ranks
+
+
+def priorities(ranks: Mapping[Hashable, float]) -> Dict[Hashable, int]:
+    """Convert ranks into integer priorities where higher values should run
+    first. Equal ranks get equal priorities.
+
+    """
+    distinct = sorted(set(ranks.values()))
+    index = {rank: i for i, rank in enumerate(distinct)}
+    return {key: index[rank] for key, rank in ranks.items()}
+
+
+class PriorityCallback(Callback):
+    """Make dask's local schedulers run ready tasks with the highest priority
+    first.
+
+    The local schedulers pop the next task to run from the end of the list of
+    ready tasks. This callback reorders that list whenever tasks become ready.
+    Ties keep the order chosen by dask.
+
+    Parameters
+    ----------
+    priorities
+        Priority of each key (higher runs first).
+
+    """
+    def __init__(self, priorities: Mapping[Hashable, int]):
+        super(PriorityCallback, self).__init__()
+        self.priorities = priorities
+
+    def _sort(self, state):
+        state['ready'].sort(key=lambda key: self.priorities.get(key, 0))
+
+    def _start_state(self, dsk, state):
+        self._sort(state)
+
+    def _posttask(self, key, result, dsk, state, id):
+        self._sort(state)
@@ -0,0 +1,264 @@
+"""Spectral decomposition of EEG split into chunks.
+
+Decomposing the full multichannel EEG of a subject in a single task limits
+parallelism to the number of subjects and needs memory for the power at
+every frequency, event, channel and time point at once. The
+:class:`SpectralDecomposition` stage instead splits the EEG along channels or
+events and runs line-noise filtering, Morlet decomposition and reduction to
+mean log-power as separate tasks for each chunk before reassembling the
+reduced chunks, so the memory needed by each task is bounded by the chunk
+size.
+
+The default filters are numpy/scipy stand-ins for the PTSA filters used by
+the z-scored powers pipeline in ``examples/cluster.py``.
+
+"""
+
+from typing import Any, Callable, List, Sequence, Union
+
+from dask.delayed import Delayed, delayed
+import numpy as np
+from scipy.signal import butter, fftconvolve, filtfilt
+
+# Default frequencies to use for the Morlet wavelet filter
+DEFAULT_FREQUENCIES = np.logspace(np.log10(6), np.log10(180), 8)
+
+# order of dimensions of plain arrays of EEG
+DIMS = ("events", "channels", "time")
+
+# names of the event, channel and time dimensions of PTSA time series (as
+# returned by cmlreaders)
+PTSA_DIMS = ("event", "channel", "time")
+
+
+def add_mirror_buffer(data: np.ndarray, n_samples: int) -> np.ndarray:
+    """Add mirrored buffers of ``n_samples`` to both ends of the time axis."""
+    if n_samples == 0:
+        return data
+    left = data[..., n_samples:0:-1]
+    right = data[..., -2:-n_samples - 2:-1]
+    return np.concatenate([left, data, right], axis=-1)
+
+
+def remove_buffer(data: np.ndarray, n_samples: int) -> np.ndarray:
+    """Remove buffers of ``n_samples`` from both ends of the time axis."""
+    if n_samples == 0:
+        return data
+    return data[..., n_samples:-n_samples]
+
+
+def line_filter(data: np.ndarray, sample_rate: float,
+                freq_range: Sequence[float] = (58., 62.),
+                order: int = 4) -> np.ndarray:
+    """Remove line noise with a Butterworth band-stop filter applied along the
+    time axis.
+
+    """
+    nyquist = sample_rate / 2.
+    b, a = butter(order, [f / nyquist for f in freq_range], btype="bandstop")
+    return filtfilt(b, a, data, axis=-1)
+
+
+def morlet_power(data: np.ndarray, sample_rate: float,
+                 freqs: np.ndarray = DEFAULT_FREQUENCIES,
+                 width: int = 5) -> np.ndarray:
+    """Compute power with a Morlet wavelet decomposition.
+
+    Parameters
+    ----------
+    data
+        Input data with time as the last axis.
+    sample_rate
+        Sample rate in Hz.
+    freqs
+        Frequencies to compute power at.
+    width
+        Width of the wavelets in cycles.
+
+    Returns
+    -------
+    powers
+        Array with shape ``(len(freqs),) + data.shape``.
+
+    """
+    powers = np.empty((len(freqs),) + data.shape)
+    extra_dims = (1,) * (data.ndim - 1)
+
+    for i, freq in enumerate(freqs):
+        sigma = width / (2 * np.pi * freq)
+        t = np.arange(-3.5 * sigma, 3.5 * sigma, 1. / sample_rate)
+        wavelet = np.exp(2j * np.pi * freq * t) * np.exp(-t ** 2 / (2 * sigma ** 2))
+        wavelet /= np.sqrt(0.5 * np.sum(np.abs(wavelet) ** 2))
+        convolved = fftconvolve(data, wavelet.reshape(extra_dims + (-1,)),
+                                mode="same", axes=-1)
+        powers[i] = np.abs(convolved) ** 2
+
+    return powers
+
+
+def chunk_slices(n: int, n_chunks: int) -> List[slice]:
+    """Split ``range(n)`` into ``n_chunks`` contiguous slices of nearly equal
+    length. Some slices are empty if ``n_chunks > n``.
+
+    """
+    bounds = np.linspace(0, n, n_chunks + 1).round().astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class SpectralDecomposition(object):
+    """Pipeline stage which computes the mean log-power of EEG in chunks.
+
+    Calling the stage with a :class:`Delayed` EEG creates a ``split`` task
+    which is the only task to receive the full EEG, ``n_chunks`` chains of
+    ``filter_chunk`` → ``decompose_chunk`` → ``reduce_chunk`` tasks on its
+    pieces and a ``reassemble`` task which returns mean log-powers with shape
+    ``(frequencies, events, channels)``:
+
+    .. code:: python
+
+        class MyPipeline(Pipeline):
+            def build(self):
+                stage = SpectralDecomposition(n_chunks=8, dim="channels")
+                zscores = [self.zscore(stage(self.load_eeg(subject)))
+                           for subject in self.subjects]
+
+    EEG can be a numpy array with dimensions ``(events, channels, time)`` or
+    an xarray-based object (such as a PTSA ``TimeSeries``) whose event,
+    channel and time dimensions are named by ``dims``. Override
+    :meth:`filter_chunk` and :meth:`decompose_chunk` to use other filters
+    (e.g., PTSA's).
+
+    Parameters
+    ----------
+    sample_rate
+        Sample rate in Hz. When not given, it is read from the
+        ``samplerate`` attribute of the EEG.
+    freqs
+        Morlet wavelet frequencies.
+    n_chunks
+        Number of chunks to split the EEG into.
+    dim
+        Dimension to split along: ``"channels"`` or ``"events"``.
+    buffer
+        Mirror buffer duration in ms added before filtering and removed after
+        the Morlet decomposition.
+    freq_range
+        Band to remove with the line-noise filter in Hz.
+    width
+        Width of the Morlet wavelets in cycles.
+    dims
+        Names of the event, channel and time dimensions of xarray-based EEG,
+        e.g., ``("event", "bipolar_pair", "time")`` for bipolar EEG. Defaults
+        to the names used by PTSA time series.
+
+    """
+    def __init__(self, sample_rate: float = None,
+                 freqs: np.ndarray = DEFAULT_FREQUENCIES, n_chunks: int = 4,
+                 dim: str = "channels", buffer: float = 0.,
+                 freq_range: Sequence[float] = (58., 62.), width: int = 5,
+                 dims: Sequence[str] = PTSA_DIMS):
+        if dim not in ("channels", "events"):
+            raise ValueError("dim must be 'channels' or 'events'")
+        if len(dims) != len(DIMS):
+            raise ValueError("dims must name the event, channel and time "
+                             "dimensions")
+
+        self.sample_rate = sample_rate
+        self.freqs = freqs
+        self.n_chunks = n_chunks
+        self.dim = dim
+        self.buffer = buffer
+        self.freq_range = freq_range
+        self.width = width
+        self.dims = tuple(dims)
+
+    def _sample_rate(self, eeg: Any) -> float:
+        if self.sample_rate is not None:
+            return self.sample_rate
+        return float(eeg.samplerate)
+
+    def _n_buffer(self, sample_rate: float) -> int:
+        return int(sample_rate * self.buffer / 1000.)
+
+    def select_chunk(self, eeg: Any, index: int) -> np.ndarray:
+        """Return chunk ``index`` of the EEG as an array with dimensions
+        ``(events, channels, time)``.
+
+        """
+        axis = DIMS.index(self.dim)
+        if hasattr(eeg, "dims"):
+            eeg = eeg.transpose(*self.dims)
+            chunk = chunk_slices(eeg.shape[axis], self.n_chunks)[index]
+            return np.asarray(eeg.isel({self.dims[axis]: chunk}).values)
+
+        chunk = chunk_slices(eeg.shape[axis], self.n_chunks)[index]
+        return np.asarray(eeg[(slice(None),) * axis + (chunk,)])
+
+    def split(self, eeg: Any) -> List[np.ndarray]:
+        """Split the EEG into ``n_chunks`` arrays (see :meth:`select_chunk`).
+        The chunks are copies so that the full EEG can be released.
+
+        """
+        return [np.array(self.select_chunk(eeg, index))
+                for index in range(self.n_chunks)]
+
+    def filter_chunk(self, chunk: np.ndarray,
+                     sample_rate: float) -> np.ndarray:
+        """Add mirror buffers and remove line noise."""
+        data = add_mirror_buffer(chunk, self._n_buffer(sample_rate))
+        return line_filter(data, sample_rate, self.freq_range)
+
+    def decompose_chunk(self, chunk: np.ndarray,
+                        sample_rate: float) -> np.ndarray:
+        """Compute Morlet powers and remove mirror buffers."""
+        if chunk.size == 0:
+            # more chunks than channels or events
+            powers = np.empty((len(self.freqs),) + chunk.shape)
+        else:
+            powers = morlet_power(chunk, sample_rate, self.freqs, self.width)
+        return remove_buffer(powers, self._n_buffer(sample_rate))
+
+    def reduce_chunk(self, powers: np.ndarray) -> np.ndarray:
+        """Average powers over time and take the log."""
+        return np.log10(powers.mean(axis=-1))
+
+    def reassemble(self, chunks: List[np.ndarray]) -> np.ndarray:
+        """Concatenate reduced chunks."""
+        return np.concatenate(chunks, axis=1 + DIMS.index(self.dim))
+
+    def __call__(self, eeg: Union[Delayed, Any],
+                 sample_rate: Union[Delayed, float] = None,
+                 decorate: Callable[[Delayed], Delayed] = None) -> Delayed:
+        """Create the tasks to compute the mean log-power of ``eeg``.
+
+        Parameters
+        ----------
+        eeg
+            EEG (usually the result of a task).
+        sample_rate
+            Overrides the sample rate given when creating the stage.
+        decorate
+            Called with each ``decompose_chunk`` task, e.g., to hint its cost
+            with :meth:`Pipeline.hint_cost`.
+
+        Returns
+        -------
+        The ``reassemble`` task.
+
+        """
+        if sample_rate is None:
+            if self.sample_rate is None:
+                sample_rate = delayed(self._sample_rate)(eeg)
+            else:
+                sample_rate = self.sample_rate
+
+        chunks = delayed(self.split, nout=self.n_chunks)(eeg)
+        reduced = []
+        for chunk in chunks:
+            filtered = delayed(self.filter_chunk)(chunk, sample_rate)
+            powers = delayed(self.decompose_chunk)(filtered, sample_rate)
+            if decorate is not None:
+                powers = decorate(powers)
+            reduced.append(delayed(self.reduce_chunk)(powers))
+
+        return delayed(self.reassemble)(reduced)
@@ -0,0 +1,236 @@
+"""Speculative re-execution of straggler tasks on the cluster.
+
+A single slow or overloaded node can hold up a whole run while the other
+workers sit idle. In speculative mode, the graph is driven from the client:
+each task is submitted once all of its dependencies are done, the time each
+task has been running is monitored and when a task has been running for much
+longer than completed tasks of the same function, a duplicate is started on
+an idle worker. Whichever copy finishes first is used and the other one is
+cancelled.
+
+Since a task may run more than once, only tasks whose functions are marked
+with the :func:`idempotent` decorator are duplicated.
+
+"""
+
+from collections import defaultdict
+import logging
+from statistics import median
+import time
+from typing import Any, Dict, Hashable, List
+
+from .graph import (
+    NodeBox, dependencies, is_task, run_node, task_name, unwrap
+)
+
+logger = logging.getLogger("cml.pipelines")
+
+
+def idempotent(func):
+    """Mark a task function as safe to run more than once (e.g., it has no
+    side effects or always writes the same output), allowing it to be
+    speculatively re-executed. Apply it below the ``delayed`` decorator:
+
+    .. code:: python
+
+        class MyPipeline(Pipeline):
+            @delayed
+            @idempotent
+            def timeseries_to_spectrum(self, eeg):
+                ...
+
+    """
+    func.idempotent = True
+    return func
+
+
+def is_idempotent(node: Any) -> bool:
+    """Check if a graph node is a task marked as idempotent."""
+    return is_task(node) and getattr(unwrap(node.func), "idempotent", False)
+
+
+class SpeculativeExecutor(object):
+    """Run a graph on a distributed cluster, duplicating straggling tasks.
+
+    Parameters
+    ----------
+    client
+        Distributed client.
+    dsk
+        Task graph (see :func:`cml_pipelines.graph.task_graph`).
+    key
+        Key of the result to return.
+    slowdown
+        Duplicate a task once it has been running this many times longer than
+        the median duration of completed tasks of the same function.
+    min_samples
+        Minimum number of completed tasks of the same function before a task
+        can be considered a straggler.
+    min_duration
+        Never duplicate tasks which have been running for less than this many
+        seconds.
+    interval
+        Seconds between checks for stragglers.
+
+    Attributes
+    ----------
+    duplicated
+        Keys of tasks which were duplicated.
+    duplicates_won
+        Keys of tasks for which the duplicate finished first.
+
+    """
+    def __init__(self, client, dsk: Dict[Hashable, Any], key: Hashable,
+                 slowdown: float = 2., min_samples: int = 2,
+                 min_duration: float = 1., interval: float = 1.):
+        self.client = client
+        self.dsk = dsk
+        self.key = key
+        self.slowdown = slowdown
+        self.min_samples = min_samples
+        self.min_duration = min_duration
+        self.interval = interval
+
+        self.duplicated = set()
+        self.duplicates_won = set()
+
+        self._deps = dependencies(dsk)
+        self._dependents = defaultdict(set)
+        for k, deps in self._deps.items():
+            for dep in deps:
+                self._dependents[dep].add(k)
+        self._waiting = {k: set(deps) for k, deps in self._deps.items()}
+
+        self._copies = defaultdict(list)  # key -> running futures
+        self._future_keys = {}  # future key -> task key
+        self._winners = {}  # key -> finished future
+        self._finished = set()
+        self._submitted = {}  # key -> time submitted
+        self._started = {}  # key -> time first seen processing
+        self._workers = {}  # future key -> worker first seen processing on
+        self._durations = defaultdict(list)  # task name -> durations
+
+    def _submit(self, key: Hashable, **kwargs):
+        values = {dep: self._winners[dep] for dep in self._deps[key]}
+        copy = len(self._copies[key])
+        future_key = key if copy == 0 else "{}-speculative-{}".format(key, copy)
+        future = self.client.submit(run_node, NodeBox(self.dsk[key]), values,
+                                    key=future_key, pure=False, **kwargs)
+        self._copies[key].append(future)
+        self._future_keys[future.key] = key
+        self._submitted.setdefault(key, time.time())
+        return future
+
+    def _running_futures(self) -> List:
+        return [f for futures in self._copies.values() for f in futures]
+
+    def _handle_done(self, future, now: float):
+        key = self._future_keys[future.key]
+        if key in self._finished:
+            return
+
+        self._copies[key].remove(future)
+        if future.status != "finished":
+            if self._copies[key]:
+                # another copy is still running
+                return
+            future.result()  # raise the error
+
+        self._finished.add(key)
+        self._winners[key] = future
+        if future.key != key:
+            self.duplicates_won.add(key)
+            logger.info("Speculative copy of %s finished first", key)
+
+        for other in self._copies.pop(key):
+            other.cancel()
+
+        start = self._started.get(key, self._submitted[key])
+        self._durations[task_name(key)].append(now - start)
+
+        for dependent in self._dependents[key]:
+            self._waiting[dependent].discard(key)
+            if not self._waiting[dependent]:
+                self._submit(dependent)
+
+        # release inputs which are no longer needed
+        for dep in self._deps[key]:
+            if dep != self.key and self._dependents[dep] <= self._finished:
+                self._winners.pop(dep, None)
+
+    def _update_processing(self, now: float) -> Dict[str, int]:
+        """Record when tasks start running and return the number of tasks
+        running on each worker.
+
+        """
+        processing = self.client.processing()
+        for worker, future_keys in processing.items():
+            for future_key in future_keys:
+                key = self._future_keys.get(future_key)
+                if key is None:
+                    continue
+                self._started.setdefault(key, now)
+                self._workers.setdefault(future_key, worker)
+        return {worker: len(keys) for worker, keys in processing.items()}
+
+    def _speculate(self, now: float, busy: Dict[str, int]):
+        nthreads = self.client.nthreads()
+        idle = [w for w, n in nthreads.items() if busy.get(w, 0) < n]
+
+        for key, copies in list(self._copies.items()):
+            if not idle:
+                break
+            if len(copies) != 1 or key not in self._started or \
+                    key in self.duplicated or not is_idempotent(self.dsk[key]):
+                continue
+
+            samples = self._durations[task_name(key)]
+            if len(samples) < self.min_samples:
+                continue
+
+            elapsed = now - self._started[key]
+            threshold = max(self.slowdown * median(samples), self.min_duration)
+            if elapsed < threshold:
+                continue
+
+            original_worker = self._workers.get(copies[0].key)
+            candidates = [w for w in idle if w != original_worker]
+            if not candidates:
+                continue
+
+            worker = candidates[0]
+            idle.remove(worker)
+            logger.info("Task %s has been running for %.1f s (typical: "
+                        "%.1f s); starting a copy on %s", key, elapsed,
+                        median(samples), worker)
+            self._submit(key, workers=[worker], allow_other_workers=False)
+            self.duplicated.add(key)
+
+    def run(self) -> Any:
+        """Compute the graph and return the result for ``key``."""
+        from distributed import TimeoutError as WaitTimeout, wait
+
+        for key, waiting in self._waiting.items():
+            if not waiting:
+                self._submit(key)
+
+        try:
+            while self.key not in self._finished:
+                try:
+                    done = wait(self._running_futures(), timeout=self.interval,
+                                return_when="FIRST_COMPLETED").done
+                except WaitTimeout:
+                    done = set()
+
+                now = time.time()
+                for future in done:
+                    self._handle_done(future, now)
+
+                if self.key not in self._finished:
+                    busy = self._update_processing(now)
+                    self._speculate(now, busy)
+
+            return self._winners[self.key].result()
+        finally:
+            for future in self._running_futures():
+                future.cancel()
@@ -0,0 +1,260 @@
+"""Synthetic EEG workloads for benchmarking pipelines without access to RHINO.
+
+Together with the numpy/scipy stand-ins for the PTSA filters in
+:mod:`cml_pipelines.spectral`, this allows running the same filter → Morlet →
+z-score → save chain as the z-scored powers pipeline in
+``examples/cluster.py`` on any machine.
+
+"""
+
+from collections import namedtuple
+import os
+from typing import List
+from zlib import crc32
+
+from dask.delayed import Delayed, delayed
+import numpy as np
+from scipy.stats import zscore
+
+from .pipeline import Pipeline
+from .spectral import (
+    DEFAULT_FREQUENCIES, SpectralDecomposition, add_mirror_buffer,
+    line_filter, morlet_power, remove_buffer
+)
+
+SyntheticSubject = namedtuple("SyntheticSubject",
+                              "subject,n_events,n_channels,sample_rate")
+
+
+def make_subjects(n_subjects: int, n_events: int = 300, n_channels: int = 100,
+                  sample_rate: float = 1000.,
+                  skew: float = 0.) -> List[SyntheticSubject]:
+    """Generate specifications for a cohort of synthetic subjects.
+
+    Parameters
+    ----------
+    n_subjects
+        Number of subjects.
+    n_events
+        Number of events per subject.
+    n_channels
+        Number of channels per subject.
+    sample_rate
+        Sample rate in Hz.
+    skew
+        When non-zero, the number of events is scaled by a factor which grows
+        linearly from 1 for the first subject to ``1 + skew`` for the last one.
+        This is useful for simulating cohorts with very different recording
+        lengths.
+
+    """
+    subjects = []
+    for i in range(n_subjects):
+        scale = 1 + skew * i / max(n_subjects - 1, 1)
+        subjects.append(SyntheticSubject("R{:04d}S".format(i),
+                                         int(round(n_events * scale)),
+                                         n_channels, sample_rate))
+    return subjects
+
+
+def synthetic_eeg(n_events: int, n_channels: int, n_samples: int,
+                  sample_rate: float, line_freq: float = 60.,
+                  seed: int = None) -> np.ndarray:
+    """Generate synthetic EEG with a 1/f background, a few oscillations and
+    line noise.
+
+    Parameters
+    ----------
+    n_events
+        Number of events.
+    n_channels
+        Number of channels.
+    n_samples
+        Number of samples per event.
+    sample_rate
+        Sample rate in Hz.
+    line_freq
+        Frequency of line noise in Hz.
+    seed
+        Random seed.
+
+    Returns
+    -------
+    data
+        Array with shape ``(n_events, n_channels, n_samples)``.
+
+    """
+    rng = np.random.RandomState(seed)
+    shape = (n_events, n_channels, n_samples)
+
+    # pink noise by shaping white noise in the frequency domain
+    spectrum = np.fft.rfft(rng.standard_normal(shape), axis=-1)
+    freqs = np.fft.rfftfreq(n_samples, 1. / sample_rate)
+    freqs[0] = freqs[1] if n_samples > 1 else 1.
+    spectrum /= np.sqrt(freqs)
+    data = np.fft.irfft(spectrum, n=n_samples, axis=-1)
+
+    t = np.arange(n_samples) / sample_rate
+    for freq in (8., 40.):
+        phase = rng.uniform(0, 2 * np.pi, size=shape[:-1] + (1,))
+        amplitude = rng.uniform(0.5, 1.5, size=shape[:-1] + (1,))
+        data += amplitude * np.sin(2 * np.pi * freq * t + phase)
+    data += 0.5 * np.sin(2 * np.pi * line_freq * t)
+
+    return data
+
+
+def zscore_powers(powers: np.ndarray) -> np.ndarray:
+    """Compute z-scored log mean powers over events.
+
+    Parameters
+    ----------
+    powers
+        Powers with shape ``(frequencies, events, channels, time)``.
+
+    Returns
+    -------
+    zscores
+        Array with shape ``(frequencies, events, channels)``.
+
+    """
+    return zscore_log_powers(np.log10(powers.mean(axis=-1)))
+
+
+def zscore_log_powers(log_powers: np.ndarray) -> np.ndarray:
+    """Z-score mean log-powers with shape ``(frequencies, events, channels)``
+    over events.
+
+    """
+    return zscore(log_powers, axis=1, ddof=1)
+
+
+class SyntheticPowersPipeline(Pipeline):
+    """Offline equivalent of the z-scored powers pipeline in
+    ``examples/cluster.py`` that generates EEG instead of loading it.
+
+    Parameters
+    ----------
+    subjects
+        Subject specifications (see :func:`make_subjects`).
+    output_dir
+        Directory to write results to.
+    duration
+        Duration of each event in ms.
+    buffer
+        Mirror buffer duration in ms.
+    freqs
+        Morlet wavelet frequencies.
+    n_chunks
+        When given, split each subject's EEG into this many chunks of
+        channels and compute the spectrum of each chunk in separate tasks
+        (see :class:`cml_pipelines.spectral.SpectralDecomposition`).
+
+    """
+    preload_modules = ["cml_pipelines.synthetic"]
+
+    def __init__(self, subjects: List[SyntheticSubject], output_dir: str,
+                 duration: float = 1600., buffer: float = 1000.,
+                 freqs: np.ndarray = DEFAULT_FREQUENCIES,
+                 n_chunks: int = None):
+        super().__init__()
+        self.subjects = subjects
+        self.output_dir = output_dir
+        self.duration = duration
+        self.buffer = buffer
+        self.freqs = freqs
+        self.n_chunks = n_chunks
+
+    @delayed
+    def load_eeg(self, spec: SyntheticSubject) -> np.ndarray:
+        """Generate EEG for a single subject."""
+        n_samples = int(spec.sample_rate * self.duration / 1000.)
+        seed = crc32(spec.subject.encode())
+        return synthetic_eeg(spec.n_events, spec.n_channels, n_samples,
+                             spec.sample_rate, seed=seed)
+
+    @delayed
+    def timeseries_to_spectrum(self, spec: SyntheticSubject,
+                               eeg: np.ndarray) -> np.ndarray:
+        """Remove line noise and compute Morlet powers."""
+        n_buffer = int(spec.sample_rate * self.buffer / 1000.)
+        data = add_mirror_buffer(eeg, n_buffer)
+        data = line_filter(data, spec.sample_rate)
+        powers = morlet_power(data, spec.sample_rate, self.freqs)
+        return remove_buffer(powers, n_buffer)
+
+    @delayed
+    def spectrum_to_powers(self, powers: np.ndarray) -> np.ndarray:
+        """Convert the spectrum to z-scored mean powers."""
+        return zscore_powers(powers)
+
+    @delayed
+    def log_powers_to_zscores(self, log_powers: np.ndarray) -> np.ndarray:
+        """Convert mean log-powers computed in chunks to z-scores."""
+        return zscore_log_powers(log_powers)
+
+    def output_path(self, subject: str) -> str:
+        """Path to the z-scores of a single subject."""
+        return os.path.join(self.output_dir, "{}.npy".format(subject))
+
+    @delayed
+    def save(self, subject: str, zscores: np.ndarray) -> str:
+        """Write the result of a single z-score calculation to disk."""
+        path = self.output_path(subject)
+        np.save(path, zscores)
+        return path
+
+    @delayed
+    def combine(self, paths: List[str]) -> str:
+        """Combine all per-subject results into a single ``.npz`` file."""
+        arrays = {
+            os.path.basename(path).split(".npy")[0]: np.load(path)
+            for path in paths
+        }
+        output = os.path.join(self.output_dir, "zscores.npz")
+        np.savez(output, **arrays)
+        return output
+
+    def spectrum_cost(self, spec: SyntheticSubject) -> float:
+        """Rough estimate of the time in seconds to compute the spectrum for a
+        subject (only relative values matter for prioritizing tasks).
+
+        """
+        n_samples = spec.sample_rate * (self.duration + 2 * self.buffer) / 1000.
+        return 1e-8 * len(self.freqs) * spec.n_events * spec.n_channels * n_samples
+
+    def chunked_powers(self, spec: SyntheticSubject, eeg: Delayed) -> Delayed:
+        """Compute z-scored powers with the spectrum of each chunk of
+        channels in separate tasks.
+
+        """
+        stage = SpectralDecomposition(spec.sample_rate, self.freqs,
+                                      self.n_chunks, buffer=self.buffer)
+        cost = self.spectrum_cost(spec) / self.n_chunks
+        log_powers = stage(eeg, decorate=lambda task: self.hint_cost(task,
+                                                                     cost))
+        return self.log_powers_to_zscores(log_powers)
+
+    def build(self):
+        eegs = [self.load_eeg(spec) for spec in self.subjects]
+        if self.n_chunks:
+            powers = [self.chunked_powers(spec, eeg)
+                      for spec, eeg in zip(self.subjects, eegs)]
+        else:
+            spectra = [
+                self.hint_cost(self.timeseries_to_spectrum(spec, eeg),
+                               self.spectrum_cost(spec))
+                for spec, eeg in zip(self.subjects, eegs)
+            ]
+            powers = [self.spectrum_to_powers(spectrum)
+                      for spectrum in spectra]
+        paths = [
+            self.declare_files(self.save(spec.subject, pow),
+                               self.output_path(spec.subject))
+            for spec, pow in zip(self.subjects, powers)
+        ]
+        return self.declare_files(
+            self.combine(paths),
+            os.path.join(self.output_dir, "zscores.npz"),
+            inputs=[self.output_path(spec.subject) for spec in self.subjects]
+        )
@@ -0,0 +1,243 @@
+"""End-to-end throughput benchmark using synthetic EEG.
+
+This runs the same filter → Morlet → z-score → save chain as
+``examples/cluster.py`` but generates EEG instead of loading it with
+``cmlreaders`` so that it can be run on any Linux box. Each execution mode is
+run in a fresh process and reports subjects/hour, peak memory (summed over
+the process and any worker processes it starts) and, for the distributed
+mode, the mean time from starting the run until each worker finishes its
+first task (use ``--preload`` to import task modules when workers start) and
+the amount of data transferred between workers (use ``--codec`` to compress
+large results).
+
+Example::
+
+    $ python examples/benchmark.py --subjects 8 --channels 64 --events 100
+
+"""
+
+from argparse import ArgumentParser
+import json
+import multiprocessing
+import os
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+import time
+
+import psutil
+
+from cml_pipelines.codec import ResultCodec
+from cml_pipelines.plugins import WorkerSetup
+from cml_pipelines.preload import worker_startup_times
+
+MODES = ["debug", "threaded", "async", "distributed"]
+
+
+class PeakMemoryMonitor(Thread):
+    """Track the peak resident memory of the current process and all of its
+    children by sampling.
+
+    Parameters
+    ----------
+    interval
+        Sampling interval in seconds.
+
+    """
+    def __init__(self, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stopped = Event()
+
+    def _sample(self) -> int:
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, self._sample())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, self._sample())
+
+
+def run_mode(mode: str, options: dict) -> dict:
+    """Run the synthetic pipeline once with the given execution mode.
+
+    Parameters
+    ----------
+    mode
+        One of ``MODES``.
+    options
+        Parsed command-line options as a dict.
+
+    Returns
+    -------
+    Timing and memory statistics.
+
+    """
+    # imported here so that spawned worker processes (which import this
+    # module) start without the modules used by tasks, as on the cluster
+    from cml_pipelines.synthetic import SyntheticPowersPipeline, make_subjects
+
+    subjects = make_subjects(options["subjects"], options["events"],
+                             options["channels"], options["sample_rate"],
+                             skew=options["skew"])
+
+    with TemporaryDirectory() as output_dir:
+        pipeline = SyntheticPowersPipeline(subjects, output_dir,
+                                           duration=options["duration"],
+                                           n_chunks=options["chunks"])
+        if options["codec"]:
+            pipeline.result_codec = ResultCodec(
+                precision=options["precision"])
+        client = None
+
+        if mode == "distributed":
+            from dask.distributed import Client, LocalCluster
+            cluster = LocalCluster(n_workers=0, threads_per_worker=1,
+                                   dashboard_address=None)
+            client = Client(cluster)
+
+            # always register a plugin to measure time to first task
+            plugin = pipeline.worker_plugin()
+            if not options["preload"]:
+                plugin = WorkerSetup(name=plugin.name)
+            client.register_plugin(plugin)
+            cluster.scale(options["workers"])
+            client.wait_for_workers(options["workers"])
+
+        monitor = PeakMemoryMonitor()
+        monitor.start()
+        start = time.time()
+
+        kwargs = {"prioritize": options["prioritize"]}
+        if mode == "debug":
+            pipeline.run(debug=True, **kwargs)
+        elif mode == "async":
+            pipeline.run(block=False, **kwargs).result()
+        else:
+            pipeline.run(**kwargs)
+
+        elapsed = time.time() - start
+        monitor.stop()
+
+        first_task = None
+        transferred = None
+        if client is not None:
+            transferred = sum(client.run(_transferred_bytes).values())
+            finished = [
+                t.started + t.time_to_first_task - start
+                for t in worker_startup_times(client, plugin.name).values()
+                if t is not None and t.time_to_first_task is not None
+            ]
+            if finished:
+                first_task = sum(finished) / len(finished)
+            client.close()
+            cluster.close()
+
+    return {
+        "mode": mode,
+        "subjects": len(subjects),
+        "elapsed": elapsed,
+        "subjects_per_hour": 3600. * len(subjects) / elapsed,
+        "peak_memory_mb": monitor.peak / 1024. ** 2,
+        "first_task": first_task,
+        "transferred_mb": (None if transferred is None
+                           else transferred / 1024. ** 2),
+    }
+
+
+def _transferred_bytes(dask_worker=None) -> int:
+    return dask_worker.transfer_outgoing_bytes_total
+
+
+def _run_mode_in_child(mode, options, queue):
+    queue.put(run_mode(mode, options))
+
+
+def run_isolated(mode: str, options: dict) -> dict:
+    """Run :func:`run_mode` in a separate process so that memory usage of one
+    mode does not affect the next.
+
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_mode_in_child, args=(mode, options, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def make_parser() -> ArgumentParser:
+    """Setup command-line argument parsing."""
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--subjects", "-s", type=int, default=4,
+                        help="number of subjects")
+    parser.add_argument("--channels", "-c", type=int, default=64,
+                        help="number of channels per subject")
+    parser.add_argument("--events", "-e", type=int, default=100,
+                        help="number of events per subject")
+    parser.add_argument("--sample-rate", "-r", type=float, default=1000.,
+                        help="sample rate in Hz")
+    parser.add_argument("--duration", "-d", type=float, default=1600.,
+                        help="event duration in ms")
+    parser.add_argument("--skew", type=float, default=0.,
+                        help="scale the number of events of the last subject "
+                             "by 1 + skew (linear in between)")
+    parser.add_argument("--workers", "-w", type=int,
+                        default=min(os.cpu_count(), 8),
+                        help="number of workers for the distributed mode")
+    parser.add_argument("--chunks", type=int,
+                        help="split each subject's EEG into this many "
+                             "chunks of channels")
+    parser.add_argument("--prioritize", "-p", action="store_true",
+                        help="start the longest chains of tasks first")
+    parser.add_argument("--preload", action="store_true",
+                        help="import task modules when distributed workers "
+                             "start instead of on their first task")
+    parser.add_argument("--codec", action="store_true",
+                        help="encode and compress large task results")
+    parser.add_argument("--precision", type=int,
+                        help="with --codec, keep this many mantissa bits of "
+                             "floating point results (lossy)")
+    parser.add_argument("--modes", "-m", nargs="+", default=MODES,
+                        choices=MODES, help="execution modes to benchmark")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    options = vars(args)
+
+    results = [run_isolated(mode, options) for mode in args.modes]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<12} {:>10} {:>16} {:>16} {:>12} {:>14}".format(
+            "mode", "elapsed", "subjects/hour", "peak memory", "first task",
+            "transferred"))
+        for result in results:
+            first_task = result["first_task"]
+            transferred = result["transferred_mb"]
+            row = dict(result,
+                       first_task="-" if first_task is None
+                       else "{:.2f}s".format(first_task),
+                       transferred="-" if transferred is None
+                       else "{:.1f} MB".format(transferred))
+            print("{mode:<12} {elapsed:>9.1f}s {subjects_per_hour:>16.1f} "
+                  "{peak_memory_mb:>13.1f} MB {first_task:>12} "
+                  "{transferred:>14}".format(**row))
@@ -15,6 +15,7 @@ from scipy.stats import zscore
 from toolz import pipe
 
 from cml_pipelines import Pipeline
+from cml_pipelines.spectral import SpectralDecomposition
 from cmlreaders import CMLReader
 from ptsa.data.filters import ButterworthFilter, MorletWaveletFilter
 from ptsa.data.timeseries import TimeSeries
@@ -30,19 +31,54 @@ logger.addHandler(stream_handler)
 logger.setLevel(logging.INFO)
 
 
+class PTSASpectralDecomposition(SpectralDecomposition):
+    """Chunked spectral decomposition using the PTSA filters of a
+    :class:`ZScoredPowersPipeline` so that chunked and unchunked runs compute
+    the same powers.
+
+    :param pipeline: pipeline whose filters to use
+    :param kwargs: passed to :class:`SpectralDecomposition`
+
+    """
+    def __init__(self, pipeline: "ZScoredPowersPipeline", **kwargs):
+        super().__init__(freqs=pipeline.morlet_freqs, **kwargs)
+        self.pipeline = pipeline
+
+    def filter_chunk(self, chunk: np.ndarray,
+                     sample_rate: float) -> TimeSeries:
+        """Add mirror buffers and remove line noise."""
+        ts = TimeSeries.create(
+            chunk, sample_rate, dims=self.dims,
+            coords={"time": np.arange(chunk.shape[-1]) / sample_rate})
+        return self.pipeline.line_filter(
+            ts.add_mirror_buffer(self.buffer / 1000.))
+
+    def decompose_chunk(self, chunk: TimeSeries,
+                        sample_rate: float) -> np.ndarray:
+        """Compute Morlet powers and remove mirror buffers."""
+        powers = self.pipeline.morlet_filter(chunk)
+        powers = powers.remove_buffer(self.buffer / 1000.)
+        return np.asarray(powers.transpose("frequency", *self.dims).values)
+
+
 class ZScoredPowersPipeline(Pipeline):
     """Pipeline to compute z-scored powers in parallel on the cluster.
 
     :param subjects: list of subjects to process
+    :param n_chunks: when given, split each subject's EEG into this many
+        chunks of channels which are filtered and decomposed in separate tasks
+        (with the same PTSA filters, see :class:`PTSASpectralDecomposition`)
 
     """
     def __init__(self, subjects: List[str],
                  output_filename: Union[str, Path] = "/scratch/depalati/demo.h5",
-                 morlet_freqs: np.ndarray = DEFAULT_FREQUENCIES):
+                 morlet_freqs: np.ndarray = DEFAULT_FREQUENCIES,
+                 n_chunks: int = None):
         super().__init__()
         self.subjects = subjects
         self.output_filename = Path(output_filename)
         self.morlet_freqs = morlet_freqs
+        self.n_chunks = n_chunks
         self.temp_paths = []  # type: List[Path]
 
     @property
@@ -122,6 +158,22 @@ class ZScoredPowersPipeline(Pipeline):
         zscored = zscore(mean_powers, axis=1, ddof=1)
         return zscored
 
+    @delayed
+    def to_timeseries(self, eeg) -> TimeSeries:
+        """Convert loaded EEG to a PTSA time series."""
+        return eeg.to_ptsa()
+
+    @delayed
+    def log_powers_to_zscores(self, log_powers: np.ndarray) -> np.ndarray:
+        """Z-score mean log-powers computed in chunks over events."""
+        return zscore(log_powers, axis=1, ddof=1)
+
+    def chunked_powers(self, eeg) -> np.ndarray:
+        """Compute z-scored powers in chunks of channels."""
+        stage = PTSASpectralDecomposition(self, n_chunks=self.n_chunks,
+                                          buffer=1000.)
+        return self.log_powers_to_zscores(stage(self.to_timeseries(eeg)))
+
     @delayed
     def save(self, subject: str, zscores: np.ndarray) -> Path:
         """Write the result of a single z-score calculation to disk."""
@@ -155,8 +207,11 @@ class ZScoredPowersPipeline(Pipeline):
     def build(self):
         experiment = "FR1"
         eegs = [self.load_eeg(subject, experiment) for subject in self.subjects]
-        spectra = [self.timeseries_to_spectrum(eeg) for eeg in eegs]
-        powers = [self.spectrum_to_powers(spectrum) for spectrum in spectra]
+        if self.n_chunks:
+            powers = [self.chunked_powers(eeg) for eeg in eegs]
+        else:
+            spectra = [self.timeseries_to_spectrum(eeg) for eeg in eegs]
+            powers = [self.spectrum_to_powers(spectrum) for spectrum in spectra]
         paths = [self.save(subject, pow) for subject, pow in zip(self.subjects, powers)]
         return self.combine(paths)
 
@@ -168,6 +223,12 @@ def make_parser() -> ArgumentParser:
                         help="run locally (not on the cluster)")
     parser.add_argument("--visualize", "-v", action="store_true",
                         help="generate a task graph with graphviz")
+    parser.add_argument("--chunks", "-c", type=int,
+                        help="split each subject's EEG into this many "
+                             "chunks of channels")
+    parser.add_argument("--estimate", "-e", action="store_true",
+                        help="estimate run time and memory use from previous "
+                             "runs instead of running")
     return parser
 
 
@@ -183,6 +244,7 @@ if __name__ == "__main__":
     if args.local:
         cluster_kwargs = {}
     else:
+        # used until memory use has been recorded by a previous run
         cluster_kwargs = {
             "memory": "32G",
         }
@@ -190,13 +252,19 @@ if __name__ == "__main__":
         logger.info("Setting up cluster; stdout logging won't be captured")
 
     # Run the pipeline
-    pipeline = ZScoredPowersPipeline(subjects)
+    pipeline = ZScoredPowersPipeline(subjects, n_chunks=args.chunks)
 
     if args.visualize:
         pipeline.visualize()
 
     workers = min(10, len(subjects))
+
+    if args.estimate:
+        from cml_pipelines.estimate import format_estimate
+        print(format_estimate(pipeline.estimate(workers, history=True)))
+        raise SystemExit
     path = pipeline.run(block=True, cluster=(not args.local),
-                        cluster_kwargs=cluster_kwargs, workers=workers)
+                        cluster_kwargs=cluster_kwargs, workers=workers,
+                        history=True, auto_memory=True)
     logger.info("Wrote HDF5 file to %s", str(path))
     pipeline.cleanup()
@@ -0,0 +1,161 @@
+"""Benchmark sharing a cluster between one large and several small pipelines.
+
+A large pipeline is started first and small pipelines are submitted while it
+is running. Without fair sharing the small pipelines wait for most of the
+large one; with :class:`FairShareScheduler` they get a share of the workers
+right away. Tasks sleep instead of computing so the benchmark is meaningful
+on any machine.
+
+Example::
+
+    $ python examples/fair_share.py --large 200 --small 4 --workers 4
+
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+from dask import delayed
+from dask.distributed import Client, LocalCluster
+
+from cml_pipelines import Pipeline
+from cml_pipelines.fairshare import FairShareScheduler
+
+
+class SleepPipeline(Pipeline):
+    """Pipeline of ``n`` independent tasks which each sleep for
+    ``duration`` seconds followed by a reduction.
+
+    """
+    def __init__(self, n: int, duration: float):
+        self.n = n
+        self.duration = duration
+
+    @delayed
+    def sleep(self, i: int) -> int:
+        time.sleep(self.duration)
+        return i
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.sleep(i) for i in range(self.n)])
+
+
+def _compute_fifo(client, pipeline):
+    # Graphs submitted within ``fifo_timeout`` of each other are treated as
+    # one generation and interleaved by the scheduler. Setting it to zero
+    # reproduces what happens once a large pipeline has been running for
+    # longer than the default of 60 s: older graphs take precedence.
+    return client.compute(pipeline.build(), fifo_timeout=0).result()
+
+
+def run_fifo(client, options: dict) -> dict:
+    """Run all pipelines with the default dask scheduling."""
+    with ThreadPoolExecutor(max_workers=options["small"] + 1) as executor:
+        start = time.time()
+        large = executor.submit(
+            _compute_fifo, client,
+            SleepPipeline(options["large"], options["duration"]))
+        time.sleep(options["delay"])
+
+        small = [
+            executor.submit(_timed, start, _compute_fifo, client,
+                            SleepPipeline(options["small_tasks"],
+                                          options["duration"]))
+            for _ in range(options["small"])
+        ]
+        small_done = [future.result() for future in small]
+        large.result()
+        large_done = time.time() - start
+
+    return _summary("fifo", small_done, large_done, options)
+
+
+def _timed(start, func, *args):
+    func(*args)
+    return time.time() - start
+
+
+def run_fair_share(client, options: dict) -> dict:
+    """Run all pipelines with a :class:`FairShareScheduler`."""
+    with FairShareScheduler(client, interval=0.01) as scheduler:
+        start = time.time()
+        large = scheduler.submit(
+            SleepPipeline(options["large"], options["duration"]),
+            pipeline_id="large", weight=options["large_weight"])
+        time.sleep(options["delay"])
+
+        small = [
+            scheduler.submit(SleepPipeline(options["small_tasks"],
+                                           options["duration"]),
+                             pipeline_id="small-{}".format(i))
+            for i in range(options["small"])
+        ]
+        small_done = []
+        for future in small:
+            future.result()
+            small_done.append(time.time() - start)
+        large.result()
+        large_done = time.time() - start
+
+    return _summary("fair-share", small_done, large_done, options)
+
+
+def _summary(mode, small_done, large_done, options):
+    # latency of each small pipeline from when it was submitted
+    latencies = [done - options["delay"] for done in small_done]
+    return {
+        "mode": mode,
+        "small_mean_latency": sum(latencies) / len(latencies),
+        "small_max_latency": max(latencies),
+        "large_elapsed": large_done,
+    }
+
+
+def make_parser() -> ArgumentParser:
+    """Setup command-line argument parsing."""
+    parser = ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--large", type=int, default=200,
+                        help="number of tasks of the large pipeline")
+    parser.add_argument("--small", type=int, default=4,
+                        help="number of small pipelines")
+    parser.add_argument("--small-tasks", type=int, default=4,
+                        help="number of tasks of each small pipeline")
+    parser.add_argument("--duration", type=float, default=0.05,
+                        help="duration of each task in seconds")
+    parser.add_argument("--delay", type=float, default=0.5,
+                        help="seconds after starting the large pipeline to "
+                             "submit the small ones")
+    parser.add_argument("--large-weight", type=float, default=1.,
+                        help="weight of the large pipeline")
+    parser.add_argument("--workers", "-w", type=int, default=4,
+                        help="number of worker threads")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    options = vars(args)
+
+    with LocalCluster(n_workers=1, threads_per_worker=args.workers,
+                      processes=False, dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            results = [run_fifo(client, options),
+                       run_fair_share(client, options)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<12} {:>14} {:>14} {:>14}".format(
+            "mode", "small mean", "small max", "large"))
+        for result in results:
+            print("{mode:<12} {small_mean_latency:>13.2f}s "
+                  "{small_max_latency:>13.2f}s {large_elapsed:>13.2f}s"
+                  .format(**result))
@@ -20,6 +20,8 @@ setup(
     packages=find_packages(include=['cml_pipelines']),
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.10',
+    install_requires=['dask>=2024.12.0', 'distributed>=2024.12.0'],
     keywords='pipelines',
 )
 
@@ -0,0 +1,52 @@
+import importlib.util
+import os
+
+from dask import delayed
+import numpy as np
+import pytest
+
+from cml_pipelines.spectral import PTSA_DIMS
+from cml_pipelines.synthetic import synthetic_eeg
+
+pytest.importorskip("cmlreaders")
+pytest.importorskip("h5py")
+pytest.importorskip("ptsa")
+
+SAMPLE_RATE = 200.
+
+
+@pytest.fixture(scope="module")
+def cluster():
+    path = os.path.join(os.path.dirname(__file__), os.pardir, "examples",
+                        "cluster.py")
+    spec = importlib.util.spec_from_file_location("cluster_example", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class EEGContainer(object):
+    """Stands in for the EEG loaded by cmlreaders."""
+    def __init__(self, ts):
+        self.ts = ts
+
+    def to_ptsa(self):
+        return self.ts
+
+
+def test_chunked_powers_match_unchunked(cluster, tmpdir):
+    from ptsa.data.timeseries import TimeSeries
+
+    data = synthetic_eeg(6, 5, 600, SAMPLE_RATE, seed=1)
+    ts = TimeSeries.create(
+        data, SAMPLE_RATE, dims=PTSA_DIMS,
+        coords={"time": np.arange(data.shape[-1]) / SAMPLE_RATE})
+    eeg = delayed(EEGContainer(ts))
+    pipeline = cluster.ZScoredPowersPipeline(
+        ["R1001P"], output_filename=str(tmpdir.join("out.h5")),
+        morlet_freqs=np.array([10., 40.]), n_chunks=3)
+
+    unchunked = pipeline.spectrum_to_powers(
+        pipeline.timeseries_to_spectrum(eeg)).compute(scheduler="sync")
+    chunked = pipeline.chunked_powers(eeg).compute(scheduler="sync")
+    np.testing.assert_allclose(chunked, unchunked)
@@ -0,0 +1,164 @@
+import pickle
+
+from dask import delayed
+import numpy as np
+import pytest
+
+from cml_pipelines.codec import (
+    COMPRESSORS, CodecRecorder, CodecStats, EncodedResult, ResultCodec,
+    collect_codec_stats, format_codec_stats, round_mantissa
+)
+from cml_pipelines.pipeline import Pipeline
+
+
+def smooth_signal(n=100000, dtype=np.float64):
+    t = np.linspace(0, 100, n)
+    return np.sin(t).astype(dtype)
+
+
+class ArrayPipeline(Pipeline):
+    result_codec = ResultCodec(min_size=1024)
+
+    @delayed
+    def generate(self, i):
+        return {"signal": smooth_signal() + i, "index": i}
+
+    @delayed
+    def mean(self, generated):
+        # arrays must be writable as when unpickled normally
+        generated["signal"] *= 2
+        return generated["signal"].mean()
+
+    @delayed
+    def total(self, means):
+        return sum(means)
+
+    def build(self):
+        return self.total([self.mean(self.generate(i)) for i in range(3)])
+
+
+@pytest.mark.parametrize("compression", sorted(COMPRESSORS) + [None])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.complex128,
+                                   np.int64])
+def test_roundtrip(compression, dtype):
+    codec = ResultCodec(compression, min_size=0)
+    values = smooth_signal(dtype=dtype).reshape(100, -1)
+    result = {"values": values, "name": "x", "ints": np.arange(10)}
+
+    encoded = codec.encode(result)
+    assert isinstance(encoded, EncodedResult)
+
+    for protocol in (4, 5):
+        decoded = codec.decode(pickle.loads(pickle.dumps(encoded, protocol)))
+        np.testing.assert_array_equal(decoded["values"], values)
+        np.testing.assert_array_equal(decoded["ints"], np.arange(10))
+        assert decoded["name"] == "x"
+        assert decoded["values"].flags.writeable
+
+    compressed = [name is not None for name, _ in encoded.meta]
+    if compression is not None and dtype != np.int64:
+        assert any(compressed)
+        assert encoded.nbytes < encoded.raw_nbytes
+    else:
+        assert not any(compressed)
+
+
+def test_encode_skips_small_and_incompressible():
+    codec = ResultCodec(min_size=1024)
+    assert codec.encode([1, 2, 3]) == [1, 2, 3]
+
+    noise = np.random.RandomState(0).bytes(8 * 10000)
+    encoded = codec.encode(np.frombuffer(noise, np.float64).copy())
+    assert encoded.meta == [(None, 8)]
+
+
+def test_out_of_band_frames():
+    encoded = ResultCodec(min_size=0).encode(smooth_signal())
+    buffers = []
+    pickle.dumps(encoded, protocol=5, buffer_callback=buffers.append)
+    assert len(buffers) == len(encoded.frames) == 1
+
+
+def test_unknown_compressor():
+    with pytest.raises(ValueError):
+        ResultCodec("nope")
+
+
+def test_round_mantissa():
+    values = np.array([1.2345678, -3.3e-10, 0., np.inf, np.nan, 7e300])
+    rounded = round_mantissa(values, 10)
+    assert values[0] == 1.2345678
+    np.testing.assert_allclose(rounded, values, rtol=2 ** -11)
+    assert np.isnan(rounded[4]) and rounded[3] == np.inf
+    assert not np.any(rounded[:3].view(np.uint64) & ((1 << 42) - 1))
+
+    complex_values = np.array([1.2345678 + 2.3456789j])
+    np.testing.assert_allclose(round_mantissa(complex_values, 10),
+                               complex_values, rtol=2 ** -10)
+
+    # nothing to drop
+    np.testing.assert_array_equal(round_mantissa(values, 60), values)
+
+
+def test_precision():
+    noisy = smooth_signal() + np.random.RandomState(0).randn(100000)
+    lossless = ResultCodec(min_size=0).encode(noisy)
+    lossy = ResultCodec(min_size=0, precision=8).encode(noisy)
+    assert lossy.nbytes < lossless.nbytes / 2
+    np.testing.assert_allclose(ResultCodec().decode(lossy), noisy,
+                               rtol=2 ** -8)
+
+
+def test_stats():
+    stats = CodecStats()
+    assert stats.ratio is None and stats.encode_throughput is None
+
+    other = CodecStats()
+    other.encoded, other.raw_bytes, other.encoded_bytes = 1, 100, 25
+    other.encode_time = 0.5
+    stats.update(other)
+    stats.update(other)
+    assert stats.ratio == 4
+    assert stats.encode_throughput == 200
+    assert "4.0x" in format_codec_stats({"task": stats})
+
+
+def test_recorder():
+    @delayed
+    def generate():
+        return smooth_signal()
+
+    @delayed
+    def double(x):
+        return x * 2
+
+    result = double(generate())
+    recorder = CodecRecorder(ResultCodec(min_size=0))
+    with recorder:
+        value = recorder.instrument(result).compute(scheduler="sync")
+
+    # the final result is not encoded
+    np.testing.assert_array_equal(value, smooth_signal() * 2)
+    assert recorder.stats["generate"].encoded == 1
+    assert recorder.stats["generate"].ratio > 1
+    assert recorder.stats["double"].decoded == 1
+    assert recorder.stats["double"].encoded == 0
+    assert collect_codec_stats(recorder.run_id) == {}
+
+
+@pytest.mark.parametrize("distributed", [False, True])
+def test_pipeline(distributed, caplog):
+    caplog.set_level("INFO", logger="cml.pipelines")
+    expected = sum(2 * (smooth_signal() + i).mean() for i in range(3))
+
+    if distributed:
+        from distributed import Client, LocalCluster
+
+        with LocalCluster(n_workers=2, threads_per_worker=1, processes=False,
+                          dashboard_address=None) as cluster:
+            with Client(cluster):
+                assert ArrayPipeline().run() == pytest.approx(expected)
+    else:
+        assert ArrayPipeline().run() == pytest.approx(expected)
+
+    assert "Encoded" in caplog.text
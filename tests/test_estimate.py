@@ -0,0 +1,134 @@
+from dask import delayed
+import pytest
+
+from cml_pipelines.estimate import estimate, format_estimate, simulate
+from cml_pipelines.graph import task_graph, task_name
+from cml_pipelines.history import TaskHistory, TaskRecord
+from cml_pipelines.pipeline import Pipeline
+
+
+class FanPipeline(Pipeline):
+    """Four independent chains of two tasks each followed by a reduction."""
+    cost_hints = {"first": 1., "second": 2., "total": 0.5}
+
+    def __init__(self):
+        self.calls = 0
+
+    @delayed
+    def first(self, i):
+        self.calls += 1
+        return i
+
+    @delayed
+    def second(self, x):
+        return x
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.second(self.first(i)) for i in range(4)])
+
+
+@delayed
+def inc(x):
+    return x + 1
+
+
+def test_simulate():
+    collection = delayed(sum)([inc(i) for i in range(4)])
+    dsk = task_graph(collection)
+    costs = {key: 1. if task_name(key) == "inc" else 0.5 for key in dsk}
+    memory = {key: 10 for key in dsk}
+
+    schedule = simulate(dsk, costs, workers=2, memory=memory)
+    assert schedule.duration == pytest.approx(2.5)
+    assert schedule.max_width == 2
+    assert schedule.peak_memory == 20
+    assert schedule.timeline[0] == (0., 2, 20)
+    assert schedule.timeline[-1] == (2.5, 0, 0)
+
+    unlimited = simulate(dsk, costs)
+    assert unlimited.duration == pytest.approx(1.5)
+    assert unlimited.max_width == 4
+
+
+def test_estimate_graph():
+    collection = delayed(sum)([inc(inc(i)) for i in range(3)])
+    dsk = task_graph(collection)
+    result = estimate(dsk, {key: 1. for key in dsk}, workers=1)
+
+    assert result.tasks == {"inc": 6, "sum": 1}
+    assert result.n_tasks == 7
+    assert result.depth == 3
+    assert result.max_width == 3
+    assert result.wall_time == pytest.approx(7.)
+    assert result.critical_path == pytest.approx(3.)
+    assert result.peak_memory is None
+    assert result.worker_memory is None
+
+
+def test_pipeline_estimate():
+    pipeline = FanPipeline()
+    result = pipeline.estimate(workers=2)
+
+    assert pipeline.calls == 0
+    assert result.tasks == {"first": 4, "second": 4, "total": 1}
+    assert result.depth == 3
+    assert result.max_width == 4
+    assert result.critical_path == pytest.approx(3.5)
+    assert result.wall_time == pytest.approx(6.5)
+    assert result.unknown == []
+
+    report = format_estimate(result)
+    assert "9 tasks" in report
+    assert "wall-clock time on 2 workers: 6.5 s" in report
+
+
+def test_pipeline_estimate_history(tmpdir):
+    history = TaskHistory(str(tmpdir.join("history.sqlite")))
+    records = [
+        TaskRecord("run", "first-{}".format(i), "first", 0., 4., 100, 0, "w")
+        for i in range(4)
+    ]
+    history.add("run", records, "FanPipeline")
+
+    pipeline = FanPipeline()
+    pipeline.cost_hints = {}
+    result = pipeline.estimate(workers=4, history=history)
+
+    assert result.unknown == ["second", "total"]
+    assert result.peak_memory == 400
+    assert result.worker_memory == 100
+    # unknown tasks cost the mean of known costs
+    assert result.critical_path == pytest.approx(12.)
+
+
+def test_run_dry_run(caplog):
+    pipeline = FanPipeline()
+    with caplog.at_level("INFO", logger="cml.pipelines"):
+        result = pipeline.run(dry_run=True, workers=4, cluster=True)
+
+    assert pipeline.calls == 0
+    assert result.workers == 4
+    assert result.wall_time == pytest.approx(3.5)
+    assert "Estimate for FanPipeline" in caplog.text
+
+
+def test_estimate_keeps_run_state():
+    pipeline = FanPipeline()
+    options = {"prioritize": True}
+    with pipeline._run_state(options):
+        collection, _ = pipeline._prepare()
+        pipeline.hint_cost(collection, 3.)
+        hints = pipeline._task_cost_hints
+
+        # e.g., estimating while an asynchronous run is in progress
+        pipeline.estimate()
+        assert pipeline._run_options is options
+        assert pipeline._task_cost_hints is hints
+        assert hints == {collection.key: 3.}
+
+    assert "_run_options" not in vars(pipeline)
+    assert "_task_cost_hints" not in vars(pipeline)
@@ -0,0 +1,139 @@
+import time
+from unittest.mock import patch
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.fairshare import FairShareScheduler
+from cml_pipelines.hooks import PipelineCallback, PipelineStatusListener
+from cml_pipelines.pipeline import Pipeline
+
+
+class SleepPipeline(Pipeline):
+    """Runs ``n`` independent tasks which sleep for a while."""
+    # shared by copies of the pipeline made when serializing
+    log = []
+
+    def __init__(self, name, n, duration=0.05):
+        self.name = name
+        self.n = n
+        self.duration = duration
+
+    @delayed
+    def sleep(self, i):
+        self.log.append(self.name)
+        time.sleep(self.duration)
+        return i
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.sleep(i) for i in range(self.n)])
+
+
+class FailingPipeline(Pipeline):
+    @delayed
+    def fail(self):
+        raise OSError("oops")
+
+    def build(self):
+        return self.fail()
+
+
+@pytest.fixture
+def client():
+    from distributed import Client, LocalCluster
+
+    with LocalCluster(n_workers=1, threads_per_worker=2, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            yield client
+
+
+def test_small_pipeline_is_not_starved(client):
+    SleepPipeline.log.clear()
+    with FairShareScheduler(client, interval=0.01) as scheduler:
+        large = scheduler.submit(SleepPipeline("large", 30))
+        time.sleep(0.2)
+        small = scheduler.submit(SleepPipeline("small", 4))
+
+        assert small.result(timeout=30) == 6
+        assert not large.done()
+        assert large.result(timeout=30) == sum(range(30))
+
+    # the small pipeline ran long before the large one was done
+    last_small = max(i for i, name in enumerate(SleepPipeline.log)
+                     if name == "small")
+    assert last_small < len(SleepPipeline.log) - 10
+
+
+def test_weights(client):
+    SleepPipeline.log.clear()
+    with FairShareScheduler(client, slots=4, interval=0.01) as scheduler:
+        heavy = scheduler.submit(SleepPipeline("heavy", 30), weight=3)
+        light = scheduler.submit(SleepPipeline("light", 30), weight=1)
+        heavy.result(timeout=30)
+        light.result(timeout=30)
+
+    first = SleepPipeline.log[:20]
+    assert first.count("heavy") >= 2 * first.count("light")
+    assert first.count("light") >= 3
+
+
+def test_failure(client):
+    with FairShareScheduler(client, interval=0.01) as scheduler:
+        failing = scheduler.submit(FailingPipeline())
+        ok = scheduler.submit(SleepPipeline("ok", 2))
+        with pytest.raises(OSError):
+            failing.result(timeout=30)
+        assert ok.result(timeout=30) == 1
+
+    with pytest.raises(ValueError):
+        scheduler.submit(SleepPipeline("bad", 1), weight=0)
+
+
+def test_submit_from_done_callback(client):
+    submitted = []
+    with FairShareScheduler(client, interval=0.01) as scheduler:
+        first = scheduler.submit(SleepPipeline("first", 2), "first")
+        first.add_done_callback(lambda f: submitted.append(
+            scheduler.submit(SleepPipeline("second", 3), "second")))
+
+        assert first.result(timeout=30) == 1
+        deadline = time.time() + 30
+        while not submitted and time.time() < deadline:
+            time.sleep(0.01)
+        assert submitted[0].result(timeout=30) == 3
+
+
+def test_status_messages(client):
+    messages = []
+    with PipelineStatusListener(messages.append, port=50004):
+        callback = PipelineCallback("fair", port=50004)
+        with FairShareScheduler(client, interval=0.01) as scheduler:
+            scheduler.submit(SleepPipeline("ok", 2),
+                             callback=callback).result(timeout=30)
+        time.sleep(0.2)
+
+    assert [m["type"] for m in messages][0] == "start"
+    assert messages[-1]["type"] == "finish"
+    assert all(m["pipeline"] == "fair" for m in messages)
+    assert messages[-2]["progress"]["complete"] == 3
+    assert messages[-2]["progress"]["eta"] == 0.
+    posttask = [m for m in messages if m["type"] == "posttask"]
+    assert all(m["progress"]["eta"] is not None for m in posttask)
+
+
+def test_scheduling_error(client):
+    with FairShareScheduler(client, interval=0.01) as scheduler:
+        with patch.object(scheduler, "capacity",
+                          side_effect=OSError("scheduler gone")):
+            future = scheduler.submit(SleepPipeline("error", 2))
+            with pytest.raises(OSError, match="scheduler gone"):
+                future.result(timeout=30)
+
+        # the scheduler keeps running
+        assert scheduler.submit(SleepPipeline("ok", 2)).result(
+            timeout=30) == 1
@@ -0,0 +1,188 @@
+from collections import Counter
+import os
+import time
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.files import (
+    FileDeps, expand_paths, file_digest, is_up_to_date, prune_up_to_date
+)
+from cml_pipelines.graph import task_graph
+from cml_pipelines.history import TaskHistory
+from cml_pipelines.paths import FilePaths
+from cml_pipelines.pipeline import Pipeline
+
+
+def touch(path, content="x", mtime=None):
+    with open(path, "w") as f:
+        f.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class CohortPipeline(Pipeline):
+    """Reads a raw file per subject, writes a processed file per subject and
+    combines them.
+
+    """
+    # shared by copies of the pipeline made when serializing
+    calls = Counter()
+
+    def __init__(self, root, subjects):
+        self.root = root
+        self.subjects = subjects
+
+    def path(self, kind, subject):
+        return os.path.join(self.root, "{}-{}.txt".format(kind, subject))
+
+    @delayed
+    def load(self, subject):
+        self.calls["load"] += 1
+        with open(self.path("raw", subject)) as f:
+            return f.read()
+
+    @delayed
+    def process(self, subject, data):
+        self.calls["process"] += 1
+        path = self.path("processed", subject)
+        touch(path, data.upper())
+        return path
+
+    @delayed
+    def combine(self, paths):
+        self.calls["combine"] += 1
+        output = os.path.join(self.root, "combined.txt")
+        touch(output, ",".join(open(path).read() for path in paths))
+        return output
+
+    def build(self):
+        processed = []
+        for subject in self.subjects:
+            task = self.process(subject, self.load(subject))
+            processed.append(self.declare_files(
+                task, self.path("processed", subject),
+                inputs=self.path("raw", subject)))
+        return self.declare_files(
+            self.combine(processed), os.path.join(self.root, "combined.txt"),
+            inputs=[self.path("processed", s) for s in self.subjects])
+
+
+@pytest.fixture
+def cohort(tmpdir):
+    root = str(tmpdir)
+    for subject in ["a", "b"]:
+        touch(os.path.join(root, "raw-{}.txt".format(subject)), subject,
+              mtime=time.time() - 100)
+    CohortPipeline.calls.clear()
+    return root
+
+
+def test_expand_paths(tmpdir):
+    paths = FilePaths(str(tmpdir), a="a.txt", b="/b/")
+    assert expand_paths(paths) == [str(tmpdir.join("a.txt")),
+                                   str(tmpdir.join("b"))]
+    assert expand_paths([str(tmpdir), [tmpdir.join("c")]]) == [
+        str(tmpdir), str(tmpdir.join("c"))]
+    assert expand_paths(None) == []
+
+
+def test_is_up_to_date(tmpdir):
+    source, target = str(tmpdir.join("in")), str(tmpdir.join("out"))
+    deps = FileDeps([source], [target], target)
+    assert not is_up_to_date(deps)
+
+    now = time.time()
+    touch(source, mtime=now - 10)
+    assert not is_up_to_date(deps)
+
+    touch(target, mtime=now)
+    assert is_up_to_date(deps)
+    assert not is_up_to_date(FileDeps([source], [], None))
+
+    # a newer input with unchanged content is up to date given stamps
+    touch(source, mtime=now + 10)
+    assert not is_up_to_date(deps)
+    stamps = {(target, source): file_digest(source)}
+    assert is_up_to_date(deps, stamps)
+
+    touch(source, "changed", mtime=now + 10)
+    assert not is_up_to_date(deps, stamps)
+
+
+def test_prune_up_to_date(tmpdir):
+    source, target = str(tmpdir.join("in")), str(tmpdir.join("out"))
+    touch(source, mtime=time.time() - 10)
+    touch(target)
+
+    @delayed
+    def load():
+        return 1
+
+    @delayed
+    def write(x):
+        return target
+
+    written = write(load())
+    collection = delayed(list)([written])
+    files = {written.key: FileDeps([source], [target], "result")}
+
+    dsk, skipped = prune_up_to_date(task_graph(collection), collection.key,
+                                    files)
+    assert skipped == {written.key}
+    assert set(dsk) == {collection.key, written.key}
+    assert dsk[written.key]() == "result"
+
+
+def test_run_skips_up_to_date(cohort):
+    pipeline = CohortPipeline(cohort, ["a", "b"])
+    result = pipeline.run()
+    assert result == os.path.join(cohort, "combined.txt")
+    assert CohortPipeline.calls == Counter(load=2, process=2, combine=1)
+
+    CohortPipeline.calls.clear()
+    assert pipeline.run() == result
+    assert CohortPipeline.calls == Counter()
+
+    # only the new subject is processed
+    touch(os.path.join(cohort, "raw-c.txt"), "c", mtime=time.time() - 100)
+    pipeline = CohortPipeline(cohort, ["a", "b", "c"])
+    pipeline.run()
+    assert CohortPipeline.calls == Counter(load=1, process=1, combine=1)
+    with open(result) as f:
+        assert f.read() == "A,B,C"
+
+    CohortPipeline.calls.clear()
+    pipeline.run(force=True)
+    assert CohortPipeline.calls == Counter(load=3, process=3, combine=1)
+
+
+def test_run_modified_input(cohort):
+    pipeline = CohortPipeline(cohort, ["a", "b"])
+    pipeline.run()
+    CohortPipeline.calls.clear()
+
+    touch(os.path.join(cohort, "raw-a.txt"), "A", mtime=time.time() + 10)
+    pipeline.run()
+    assert CohortPipeline.calls == Counter(load=1, process=1, combine=1)
+
+
+def test_run_content_stamps(cohort):
+    history = TaskHistory(os.path.join(cohort, "history.sqlite"))
+    pipeline = CohortPipeline(cohort, ["a", "b"])
+    pipeline.run(history=history)
+    CohortPipeline.calls.clear()
+
+    # touching an input without changing it doesn't rerun anything
+    raw = os.path.join(cohort, "raw-a.txt")
+    os.utime(raw, (time.time() + 10, time.time() + 10))
+    pipeline.run(history=history)
+    assert CohortPipeline.calls == Counter()
+
+
+def test_estimate_skips_up_to_date(cohort):
+    pipeline = CohortPipeline(cohort, ["a", "b"])
+    assert pipeline.estimate().n_tasks == 5
+    pipeline.run()
+    assert pipeline.estimate().n_tasks == 0
+    assert pipeline.estimate(force=True).n_tasks == 5
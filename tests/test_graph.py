@@ -0,0 +1,44 @@
+from dask import delayed
+
+from cml_pipelines.graph import (
+    dependencies, is_task, task_graph, task_name, to_delayed, wrap_tasks
+)
+
+
+@delayed
+def inc(x):
+    return x + 1
+
+
+@delayed
+def add(a, b):
+    return a + b
+
+
+def test_graph():
+    collection = add(inc(1), inc(2))
+    dsk = task_graph(collection)
+
+    assert len(dsk) == 3
+    assert all(is_task(node) for node in dsk.values())
+    assert sorted(task_name(key) for key in dsk) == ["add", "inc", "inc"]
+
+    deps = dependencies(dsk)
+    assert len(deps[collection.key]) == 2
+    assert all(not deps[key] for key in dsk if key != collection.key)
+
+
+def test_wrap_tasks():
+    calls = []
+
+    def wrapper(key, func):
+        def wrapped(*args, **kwargs):
+            calls.append(task_name(key))
+            return func(*args, **kwargs) * 10
+        return wrapped
+
+    collection = add(inc(1), inc(2))
+    dsk = wrap_tasks(task_graph(collection), wrapper)
+
+    assert to_delayed(dsk, collection.key).compute() == 500
+    assert sorted(calls) == ["add", "inc", "inc"]
@@ -0,0 +1,108 @@
+import time
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.history import (
+    HistoryRecorder, RecordingTask, TaskHistory, TaskRecord, collect_records,
+    drain_records
+)
+from cml_pipelines.pipeline import Pipeline
+
+
+class SleepPipeline(Pipeline):
+    def __init__(self, delay=0.):
+        self.delay = delay
+
+    @delayed
+    def sleep(self, x):
+        time.sleep(self.delay)
+        return x
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.sleep(i) for i in range(4)])
+
+
+@pytest.fixture
+def history(tmpdir):
+    return TaskHistory(str(tmpdir.join("history.sqlite")))
+
+
+def make_records(run_id, name, durations, start=0.):
+    return [
+        TaskRecord(run_id, "{}-{}".format(name, i), name, start + i,
+                   duration, 100, 10, "host:1")
+        for i, duration in enumerate(durations)
+    ]
+
+
+def test_recording_task():
+    task = RecordingTask("run", "add-1", "add", lambda a, b: a + b)
+    assert task(1, b=2) == 3
+
+    records = collect_records("run")
+    assert len(records) == 1
+    record = records[0]
+    assert record.key == "add-1"
+    assert record.name == "add"
+    assert record.duration >= 0
+    assert record.input_size > 0
+    assert record.peak_memory > 0
+    assert drain_records("run") == []
+
+
+class TestTaskHistory:
+    def test_add(self, history):
+        history.add("a", make_records("a", "load", [1., 3.]), "P")
+        history.add("b", make_records("b", "load", [5.], start=10.), "Q")
+
+        assert history.runs() == ["a", "b"]
+        assert history.runs("P") == ["a"]
+        assert len(history.records("a")) == 2
+
+        summary = history.summary()["load"]
+        assert summary.count == 3
+        assert summary.mean_duration == pytest.approx(3.)
+        assert summary.max_duration == 5.
+        assert summary.max_peak_memory == 100
+
+        assert history.mean_durations(pipeline="P") == {"load": 2.}
+        assert history.mean_durations(last_runs=1) == {"load": 5.}
+
+    def test_regressions(self, history):
+        for i in range(3):
+            run_id = "run{}".format(i)
+            history.add(run_id, make_records(run_id, "load", [1.], start=i) +
+                        make_records(run_id, "save", [1.], start=i), "P")
+        history.add("slow", make_records("slow", "load", [3.], start=10) +
+                    make_records("slow", "save", [1.1], start=10), "P")
+
+        regressions = history.regressions("slow", threshold=1.5)
+        assert len(regressions) == 1
+        assert regressions[0].name == "load"
+        assert regressions[0].ratio == pytest.approx(3.)
+
+
+def test_recorder(history):
+    recorder = HistoryRecorder(history, "SleepPipeline")
+    collection = recorder.instrument(SleepPipeline().build())
+    with recorder:
+        assert collection.compute() == 6
+
+    records = history.records(recorder.run_id)
+    assert sorted(r.name for r in records) == ["sleep"] * 4 + ["total"]
+
+
+def test_run_with_history(history, caplog):
+    assert SleepPipeline().run(history=history) == 6
+    assert SleepPipeline(0.1).run(history=history.path) == 6
+
+    first, second = history.runs("SleepPipeline")
+    assert len(history.records(first)) == 5
+
+    # the second run should be flagged as a regression
+    assert "sleep took" in caplog.text
@@ -1,8 +1,13 @@
 from threading import Lock
+import time
+from unittest.mock import patch
 
 from dask import delayed
+import pytest
 
+from cml_pipelines.graph import task_graph
 from cml_pipelines.hooks import PipelineCallback, PipelineStatusListener
+from cml_pipelines.pipeline import Pipeline
 
 
 class Counter:
@@ -32,3 +37,108 @@ def test_pipeline_callback():
         with PipelineCallback('name'):
             my_task().compute()
             assert len(results)
+
+
+def test_pipeline_callback_eta(tmpdir):
+    from cml_pipelines.history import TaskHistory, TaskRecord
+
+    history = TaskHistory(str(tmpdir.join("history.sqlite")))
+    history.add("run", [
+        TaskRecord("run", "slow-1", "slow", 0, 0.05, 0, 0, "host"),
+        TaskRecord("run", "fast-1", "fast", 0, 0.001, 0, 0, "host"),
+    ])
+
+    @delayed
+    def slow(x):
+        return x
+
+    @delayed
+    def fast(x):
+        return x
+
+    results = []
+    with PipelineStatusListener(results.append, port=50002):
+        with PipelineCallback('eta', port=50002, history=history):
+            delayed(list)([slow(fast(i)) for i in range(5)]).compute(
+                scheduler="single-threaded")
+        time.sleep(0.1)
+
+    posttask = [msg for msg in results if msg['type'] == 'posttask']
+    assert posttask
+    assert all('eta' in msg['progress'] for msg in posttask)
+    assert all(msg['duration'] >= 0 for msg in posttask)
+    assert posttask[-1]['progress']['eta'] == 0
+
+
+def test_pipeline_callback_eta_weights():
+    class History(object):
+        def mean_durations(self):
+            return {"slow": 3.}
+
+    @delayed
+    def slow(x):
+        return x
+
+    @delayed
+    def fast(x):
+        return x
+
+    dsk = task_graph(delayed(list)([slow(1), slow(2), fast(1), fast(2)]))
+    keys = {key.split("-")[0]: key for key in dsk}
+    callback = PipelineCallback("weights", history=History())
+    state = {"finished": [], "dependencies": dsk}
+
+    with patch.object(callback, "_publish"), patch("time.time") as now:
+        now.return_value = 0.
+        callback._start(dsk)
+        # one slow task is done, the other and two fast tasks and the list
+        # are weighted by the mean known duration
+        now.return_value = 6.
+        callback._posttask(keys["slow"], None, dsk, state, 0)
+        assert callback._eta() == 6. * (3. + 3. * 3.) / 3.
+
+        # fast tasks are weighted by their observed duration and the list
+        # by the mean of all known durations
+        callback._task_started[keys["fast"]] = 5.
+        callback._posttask(keys["fast"], None, dsk, state, 0)
+        assert callback._eta() == pytest.approx(
+            6. * (3. + 1. + 7. / 3.) / (3. + 1.))
+
+
+class PublishingPipeline(Pipeline):
+    @delayed
+    def square(self, x):
+        self.publish("squared", value=x * x)
+        return x * x
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.square(i) for i in range(3)])
+
+
+def test_pipeline_callback_distributed():
+    from distributed import Client, LocalCluster
+
+    results = []
+    with LocalCluster(n_workers=1, threads_per_worker=2, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster):
+            with PipelineStatusListener(results.append, port=50005):
+                callback = PipelineCallback("relayed", port=50005)
+                assert PublishingPipeline().run(callback=callback) == 5
+                time.sleep(0.1)
+
+    types = [msg["type"] for msg in results]
+    assert types[0] == "start"
+    assert types[-1] == "finish"
+    assert types.count("pretask") == types.count("posttask") == 4
+    assert sorted(msg["value"] for msg in results
+                  if msg["type"] == "squared") == [0, 1, 4]
+    assert all(msg["pipeline"] == "relayed" for msg in results)
+
+    progress = [msg["progress"] for msg in results
+                if msg["type"] == "posttask"]
+    assert progress[-1] == {"complete": 4, "total": 4, "eta": 0.}
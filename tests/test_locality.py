@@ -0,0 +1,170 @@
+import os
+from threading import Timer
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.locality import (
+    LocalityPlacement, filesystem_type, local_files, locate_files,
+    locality_hints, mount_points, preferred_workers
+)
+from cml_pipelines.pipeline import Pipeline
+
+
+@delayed
+def worker_address(i):
+    from distributed import get_worker
+    return get_worker().address
+
+
+class WorkerPipeline(Pipeline):
+    """Reports the worker each task ran on."""
+    def __init__(self, n, workers=(), paths=()):
+        self.n = n
+        self.workers = workers
+        self.paths = paths
+
+    @delayed
+    def gather(self, addresses):
+        return addresses
+
+    def build(self):
+        return self.gather([
+            self.hint_locality(worker_address(i), self.paths, self.workers)
+            for i in range(self.n)
+        ])
+
+
+@pytest.fixture
+def client():
+    from distributed import Client, LocalCluster
+
+    with LocalCluster(n_workers=2, threads_per_worker=1, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            client.wait_for_workers(2)
+            yield client
+
+
+def test_filesystem_type(tmp_path):
+    root = os.path.realpath(str(tmp_path))
+    shared = os.path.join(root, "shared")
+    mounts = {"/": "ext4", shared: "nfs"}
+
+    assert filesystem_type(os.path.join(root, "a.npy"), mounts) == "ext4"
+    assert filesystem_type(os.path.join(shared, "a.npy"), mounts) == "nfs"
+    assert filesystem_type("/a.npy", {}) is None
+
+    with open(str(tmp_path.joinpath("mounts")), "w") as f:
+        f.write("server:/data /mnt/my\\040data nfs4 rw 0 0\n")
+    assert mount_points(str(tmp_path.joinpath("mounts"))) == {
+        "/mnt/my data": "nfs4"}
+    assert mount_points(str(tmp_path.joinpath("missing"))) == {}
+
+
+def test_local_files(tmp_path):
+    os.makedirs(str(tmp_path.joinpath("shared")))
+    local = str(tmp_path.joinpath("local.npy"))
+    shared = str(tmp_path.joinpath("shared", "shared.npy"))
+    for path in (local, shared):
+        with open(path, "wb") as f:
+            f.write(b"abc")
+
+    mounts = {"/": "ext4",
+              os.path.realpath(str(tmp_path.joinpath("shared"))): "nfs"}
+    missing = str(tmp_path.joinpath("missing.npy"))
+    assert local_files([local, shared, missing], mounts) == {local: 3}
+
+
+def test_preferred_workers():
+    located = {
+        "a.npy": {"w1": 100, "w2": 100},
+        "b.npy": {"w2": 10},
+        "empty.npy": {"w3": 0},
+    }
+    workers = ["w1", "w2", "w3"]
+
+    assert preferred_workers(["a.npy"], located, workers) == ["w1", "w2"]
+    assert preferred_workers(["a.npy", "b.npy"], located, workers) == ["w2"]
+    assert preferred_workers(["empty.npy"], located, workers) == ["w3"]
+    assert preferred_workers(["c.npy"], located, workers) == []
+    assert preferred_workers([], located, workers) == []
+
+    # no preference when every worker holds the same
+    assert preferred_workers(["a.npy"], located, ["w1", "w2"]) == []
+
+
+def test_locate_files(client, tmp_path):
+    path = str(tmp_path.joinpath("a.npy"))
+    with open(path, "wb") as f:
+        f.write(b"abc")
+
+    workers = set(client.scheduler_info()["workers"])
+    located = locate_files(client, [path, str(tmp_path.joinpath("b.npy"))])
+    assert located == {path: {worker: 3 for worker in workers}}
+
+    # both workers hold the file (they share this machine)
+    assert locality_hints(client, {"task": [path]}) == {}
+    assert locality_hints(client, {"task": [path]},
+                          {"task": ["w1"]}) == {"task": ["w1"]}
+
+
+def test_run_on_preferred_worker(client):
+    worker = sorted(client.scheduler_info()["workers"])[1]
+    addresses = WorkerPipeline(4, [worker]).run(locality=True)
+    assert addresses == [worker] * 4
+
+
+def test_fallback(client):
+    missing = "tcp://127.0.0.1:1"
+    tasks = [worker_address(i) for i in range(2)]
+    hints = {task.key: [missing] for task in tasks}
+    with LocalityPlacement(client, hints):
+        addresses = delayed(list)(tasks).compute()
+
+    assert set(addresses) <= set(client.scheduler_info()["workers"])
+
+
+def test_strict(client):
+    worker = sorted(client.scheduler_info()["workers"])[0]
+    tasks = [worker_address(i) for i in range(8)]
+    hints = {task.key: [worker] for task in tasks}
+    with LocalityPlacement(client, hints, strict=True):
+        addresses = delayed(list)(tasks).compute()
+
+    assert addresses == [worker] * 8
+
+
+def test_run_without_cluster(caplog):
+    assert WorkerPipeline(0).run(locality=True) == []
+    assert "requires a distributed cluster" in caplog.text
+
+
+def test_wait_for_workers(monkeypatch, tmp_path, caplog):
+    from distributed import Client, LocalCluster
+    import cml_pipelines.pipeline
+
+    path = str(tmp_path.joinpath("a.npy"))
+    with open(path, "wb") as f:
+        f.write(b"abc")
+
+    with LocalCluster(n_workers=0, threads_per_worker=1, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster):
+            # the only worker connects after placement gave up waiting
+            monkeypatch.setattr(cml_pipelines.pipeline,
+                                "LOCALITY_WORKER_TIMEOUT", 0.2)
+            timer = Timer(1., cluster.scale, [1])
+            timer.start()
+            assert WorkerPipeline(1, paths=[path]).run(locality=True)
+            timer.join()
+
+            assert "Only 0 of 1 workers connected" in caplog.text
+            assert "No preferred workers found" in caplog.text
+
+            # waits for the worker
+            caplog.clear()
+            monkeypatch.setattr(cml_pipelines.pipeline,
+                                "LOCALITY_WORKER_TIMEOUT", 30.)
+            assert WorkerPipeline(1, paths=[path]).run(locality=True)
+            assert "workers connected" not in caplog.text
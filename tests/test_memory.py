@@ -0,0 +1,99 @@
+import time
+from unittest.mock import patch
+
+from dask import delayed
+import numpy as np
+import pytest
+
+from cml_pipelines.history import TaskHistory, TaskRecord
+from cml_pipelines.memory import (
+    PeakMemory, current_rss, max_rss, memory_request
+)
+from cml_pipelines.pipeline import Pipeline
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+
+class AllocatingPipeline(Pipeline):
+    @delayed
+    def allocate(self, n_bytes):
+        data = np.ones(n_bytes // 8)
+        return float(data.sum())
+
+    def build(self):
+        return self.allocate(200 * MB)
+
+
+def test_current_rss():
+    assert current_rss() > 0
+
+
+@pytest.mark.parametrize("platform,expected", [("linux", 2048 * 1024),
+                                               ("darwin", 2048)])
+def test_max_rss_units(platform, expected):
+    with patch("resource.getrusage") as getrusage, \
+            patch("sys.platform", platform):
+        getrusage.return_value.ru_maxrss = 2048
+        assert max_rss() == expected
+
+
+def test_peak_memory():
+    with PeakMemory() as memory:
+        data = np.ones(100 * MB // 8)
+        time.sleep(0.2)
+        del data
+
+    assert memory.peak - memory.start >= 90 * MB
+    # the peak is kept after memory is freed
+    assert memory.peak > current_rss()
+
+
+@pytest.mark.parametrize("peak,headroom,expected", [
+    (8 * GB, 0.25, "10G"),
+    (8 * GB, 0., "8G"),
+    (int(1.1 * GB), 0., "2G"),
+    (0, 0.25, "1G"),
+])
+def test_memory_request(peak, headroom, expected):
+    assert memory_request(peak, headroom) == expected
+
+
+def test_history_records_peak_memory(tmpdir):
+    history = TaskHistory(str(tmpdir.join("history.sqlite")))
+    AllocatingPipeline().run(history=history)
+
+    summary = history.summary(pipeline="AllocatingPipeline")["allocate"]
+    assert summary.max_peak_memory >= 200 * MB
+
+
+def _add_run(history, peak):
+    record = TaskRecord("run", "allocate-1", "allocate", 0., 1., peak, 0, "w")
+    history.add("run", [record], "AllocatingPipeline")
+
+
+def test_worker_memory(tmpdir):
+    history = TaskHistory(str(tmpdir.join("history.sqlite")))
+    pipeline = AllocatingPipeline()
+    assert pipeline.worker_memory(history) is None
+    assert pipeline.worker_memory(None) is None
+
+    _add_run(history, 8 * GB)
+    assert pipeline.worker_memory(history) == "10G"
+    assert pipeline.worker_memory(history, headroom=0.5) == "12G"
+
+
+@pytest.mark.parametrize("recorded", [True, False])
+def test_run_auto_memory(tmpdir, recorded):
+    history = TaskHistory(str(tmpdir.join("history.sqlite")))
+    if recorded:
+        _add_run(history, 8 * GB)
+
+    with patch("dask_jobqueue.SGECluster") as MockCluster:
+        with patch("dask.distributed.Client"):
+            AllocatingPipeline().run(cluster=True, history=history,
+                                     auto_memory=True,
+                                     cluster_kwargs={"memory": "4G"})
+
+    memory = MockCluster.call_args[1]["memory"]
+    assert memory == ("10G" if recorded else "4G")
@@ -0,0 +1,134 @@
+import json
+import random
+import time
+from urllib.request import urlopen
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.hooks import PipelineCallback
+from cml_pipelines.monitor import MonitorDaemon, StatusAggregator
+
+
+def make_messages(pipeline_id, total, start=1000., dt=0.5):
+    msgs = [{"pipeline": pipeline_id, "type": "start", "time": start}]
+    for i in range(total):
+        msgs.append({
+            "pipeline": pipeline_id,
+            "type": "posttask",
+            "time": start + (i + 1) * dt,
+            "progress": {"complete": i + 1, "total": total},
+            "task": "task-{}".format(i),
+        })
+    return msgs
+
+
+class TestStatusAggregator:
+    def test_progress(self):
+        aggregator = StatusAggregator(rate_window=100.)
+        for msg in make_messages("a", 10)[:6]:
+            aggregator.update(msg)
+
+        stats, = aggregator.snapshot()
+        assert stats["pipeline"] == "a"
+        assert stats["active"]
+        assert stats["complete"] == 5
+        assert stats["total"] == 10
+        assert stats["percent_complete"] == 50.
+        assert stats["tasks_per_second"] == pytest.approx(2.)
+        assert stats["eta"] == pytest.approx(2.5)
+
+    def test_finish(self):
+        aggregator = StatusAggregator()
+        msgs = make_messages("a", 3)
+        msgs.append({"pipeline": "a", "type": "finish", "time": 1010.,
+                     "errored": True})
+        for msg in msgs:
+            aggregator.update(msg, received=msg["time"])
+
+        stats, = aggregator.snapshot()
+        assert not stats["active"]
+        assert stats["errored"]
+        assert stats["eta"] == 0
+
+    def test_restart_and_zero_timestamps(self):
+        aggregator = StatusAggregator()
+        for msg in make_messages("a", 2, start=0.):
+            aggregator.update(msg, received=5.)
+        aggregator.update({"pipeline": "a", "type": "finish", "time": 1.5},
+                          received=5.)
+        stats, = aggregator.snapshot()
+        assert stats["complete"] == 2
+
+        # a new run with the same ID starts from scratch
+        aggregator.update({"pipeline": "a", "type": "start", "time": 0.},
+                          received=5.)
+        stats, = aggregator.snapshot()
+        assert stats["active"]
+        assert stats["complete"] == 0
+
+    def test_retention(self):
+        aggregator = StatusAggregator(retention=10.)
+        aggregator.update({"pipeline": "a", "type": "finish", "time": 0},
+                          received=0)
+        assert len(aggregator.snapshot()) == 1
+        aggregator.update({"pipeline": "b", "type": "start", "time": 20},
+                          received=20)
+        assert [p["pipeline"] for p in aggregator.snapshot()] == ["b"]
+
+    def test_out_of_order_and_dropped(self):
+        """Shuffled and partially dropped messages never reduce counts."""
+        aggregator = StatusAggregator()
+        msgs = make_messages("a", 100)[1:]
+        random.seed(0)
+        random.shuffle(msgs)
+        for msg in msgs[::2] + [m for m in msgs if m["progress"]["complete"] == 100]:
+            aggregator.update(msg)
+
+        stats, = aggregator.snapshot()
+        assert stats["complete"] == 100
+        assert stats["total"] == 100
+
+    def test_prometheus(self):
+        aggregator = StatusAggregator()
+        for pid in ["a", 'b"c']:
+            for msg in make_messages(pid, 4):
+                aggregator.update(msg)
+
+        text = aggregator.to_prometheus()
+        assert "cml_pipeline_active_pipelines 2" in text
+        assert 'cml_pipeline_tasks_completed{pipeline="a"} 4' in text
+        assert 'cml_pipeline_tasks_total{pipeline="b\\"c"} 4' in text
+        assert 'cml_pipeline_status_messages_total{pipeline="a",type="posttask"} 4' in text
+
+        data = json.loads(aggregator.to_json())
+        assert data["messages_received"] == 10
+        assert len(data["pipelines"]) == 2
+
+
+def test_monitor_daemon():
+    @delayed
+    def inc(x):
+        return x + 1
+
+    with MonitorDaemon(udp_port=50011, http_port=0) as monitor:
+        for pipeline_id in ["first", "second"]:
+            with PipelineCallback(pipeline_id, port=50011):
+                delayed(sum)([inc(i) for i in range(10)]).compute()
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            monitor.drain()
+            status = json.loads(urlopen(monitor.url + "/status").read())
+            if all(not p["active"] for p in status["pipelines"]) and \
+                    len(status["pipelines"]) == 2:
+                break
+            time.sleep(0.05)
+
+        pipelines = {p["pipeline"]: p for p in status["pipelines"]}
+        assert set(pipelines) == {"first", "second"}
+        for stats in pipelines.values():
+            assert stats["complete"] == stats["total"] == 11
+
+        metrics = urlopen(monitor.url + "/metrics").read().decode()
+        assert 'cml_pipeline_completion_percent{pipeline="first"} 100.0' in metrics
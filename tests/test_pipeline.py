@@ -81,7 +81,7 @@ class TestPipeline:
         with patch.object(MyPipeline, "_run_sync") as run_sync:
             pipeline = MyPipeline()
             pipeline.run(debug=debug)
-            run_sync.assert_called_with(debug)
+            run_sync.assert_called_with(debug, None)
 
     def test_visualize(self):
         pipeline = MyPipeline()
@@ -0,0 +1,103 @@
+from collections import Counter
+import pickle
+import subprocess
+import sys
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.pipeline import Pipeline
+from cml_pipelines.plugins import WorkerSetup
+from cml_pipelines.preload import worker_startup_times
+
+
+class SetupPipeline(Pipeline):
+    preload_modules = ["json"]
+
+    # shared by copies of the pipeline made when serializing
+    setups = Counter()
+
+    def setup_worker(self):
+        self.setups["setup"] += 1
+
+    @delayed
+    def add(self, a, b):
+        return a + b
+
+    def build(self):
+        return self.add(1, 2)
+
+
+def test_worker_setup():
+    hooks = []
+    plugin = WorkerSetup(["json"], [lambda: hooks.append(1)])
+    plugin.setup()
+    assert hooks == [1]
+    assert plugin.startup().setup >= 0
+    assert plugin.startup().time_to_first_task is None
+
+    plugin.transition("a", "ready", "executing")
+    plugin.transition("a", "executing", "memory")
+    startup = plugin.startup()
+    assert startup.first_task >= 0
+    assert startup.time_to_first_task >= startup.first_task
+
+    # only the first task is recorded
+    plugin.transition("b", "ready", "executing")
+    assert plugin.startup() == startup
+
+
+def test_import_without_distributed():
+    # plugin classes are only imported when setting up a distributed run
+    code = "import sys, cml_pipelines; assert 'distributed' not in sys.modules"
+    subprocess.check_call([sys.executable, "-c", code])
+
+    from distributed import WorkerPlugin
+    plugin = pickle.loads(pickle.dumps(WorkerSetup(["json"])))
+    assert type(plugin) is WorkerSetup
+    assert isinstance(plugin, WorkerPlugin)
+
+
+def test_worker_plugin():
+    plugin = SetupPipeline().worker_plugin()
+    assert plugin.modules == ["json"]
+    assert len(plugin.hooks) == 1
+    assert plugin.name == "cml-pipelines-setup-SetupPipeline"
+
+    class NoSetupPipeline(Pipeline):
+        pass
+
+    assert NoSetupPipeline().worker_plugin().hooks == []
+
+
+@pytest.mark.parametrize("debug", [True, False])
+def test_run_local(debug):
+    SetupPipeline.setups.clear()
+    assert SetupPipeline().run(debug=debug) == 3
+    assert SetupPipeline.setups["setup"] == 1
+
+
+def test_run_distributed():
+    from distributed import Client, LocalCluster
+
+    SetupPipeline.setups.clear()
+    pipeline = SetupPipeline()
+    plugin = pipeline.worker_plugin()
+
+    with LocalCluster(n_workers=0, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            client.register_plugin(plugin)
+            cluster.scale(2)
+            client.wait_for_workers(2)
+            assert SetupPipeline.setups["setup"] == 2
+
+            assert pipeline.run() == 3
+            assert SetupPipeline.setups["setup"] == 2
+
+            times = worker_startup_times(client, plugin.name)
+            assert len(times) == 2
+            finished = [t for t in times.values()
+                        if t.time_to_first_task is not None]
+            assert len(finished) == 1
+            assert finished[0].setup >= 0
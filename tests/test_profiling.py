@@ -0,0 +1,117 @@
+from collections import Counter
+import cProfile
+import os
+import pstats
+import time
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.pipeline import Pipeline
+from cml_pipelines.profiling import (
+    Profiler, ProfilingTask, collect_profiles, write_folded
+)
+
+
+def busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class SlowPipeline(Pipeline):
+    @delayed
+    def slow(self, i):
+        busy_wait(0.1)
+        return i
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        return self.total([self.slow(i) for i in range(2)])
+
+
+def test_profiling_task():
+    task = ProfilingTask("run", "slow-1", busy_wait, interval=0.005,
+                         deterministic=True)
+    task(0.1)
+
+    samples, stats = collect_profiles("run")
+    assert list(samples) == ["slow"]
+    stacks = samples["slow"]
+    assert sum(stacks.values()) > 5
+    # stacks start at the task name and don't include the wrapper
+    assert all(stack.startswith("slow;busy_wait (test_profiling.py:")
+               for stack in stacks)
+    assert all("_call_profiled" not in stack for stack in stacks)
+
+    assert isinstance(stats["slow"], pstats.Stats)
+    functions = [func[2] for func in stats["slow"].stats]
+    assert "busy_wait" in functions
+
+    # buffers are drained
+    assert collect_profiles("run") == ({}, {})
+
+
+def test_write_folded(tmpdir):
+    path = str(tmpdir.join("slow.folded"))
+    write_folded(Counter({"a;b": 2, "a": 1}), path)
+    with open(path) as f:
+        assert f.read() == "a 1\na;b 2\n"
+
+
+@pytest.mark.parametrize("deterministic", [True, False])
+def test_run_profile(tmpdir, deterministic):
+    output_dir = str(tmpdir.join("profiles"))
+    result = SlowPipeline().run(profile={"output_dir": output_dir,
+                                         "deterministic": deterministic,
+                                         "interval": 0.005})
+    assert result == 1
+
+    files = sorted(os.listdir(output_dir))
+    if deterministic:
+        assert files == ["slow.folded", "slow.prof", "total.prof"]
+    else:
+        assert files == ["slow.folded"]
+
+    with open(os.path.join(output_dir, "slow.folded")) as f:
+        lines = f.read().splitlines()
+    assert all(line.startswith("slow;") for line in lines)
+    assert any("busy_wait" in line for line in lines)
+
+
+def test_run_profile_distributed(tmpdir):
+    from distributed import Client, LocalCluster
+
+    with LocalCluster(n_workers=2, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster):
+            profiler = Profiler(interval=0.005)
+            collection = profiler.instrument(SlowPipeline().build())
+            with profiler:
+                assert collection.compute() == 1
+
+    assert "slow" in profiler.samples
+    assert profiler.stats == {}
+
+
+class _ActiveProfile(cProfile.Profile):
+    def enable(self, *args, **kwargs):
+        raise ValueError("Another profiling tool is already active")
+
+
+def test_run_profile_unavailable(monkeypatch, caplog):
+    monkeypatch.setattr(cProfile, "Profile", _ActiveProfile)
+
+    profiler = Profiler(interval=0.005, deterministic=True)
+    collection = profiler.instrument(SlowPipeline().build())
+    with profiler:
+        assert collection.compute() == 1
+
+    # tasks are still sampled
+    assert "slow" in profiler.samples
+    assert profiler.stats == {}
+    assert profiler.unprofiled == {"slow": 2, "total": 1}
+    assert caplog.text.count("weren't profiled with cProfile") == 1
@@ -0,0 +1,161 @@
+from collections import Counter
+import time
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.hooks import PipelineCallback, PipelineStatusListener
+from cml_pipelines.pipeline import Pipeline
+from cml_pipelines.retry import RetryPolicy, retry
+
+# call counts shared by all copies of the pipelines below
+calls = Counter()
+
+
+class FlakyPipeline(Pipeline):
+    retry_policies = {"save": RetryPolicy(3, backoff=0.)}
+
+    def __init__(self, failures=2, per_task=False):
+        self.failures = failures
+        self.per_task = per_task
+
+    @delayed
+    def load(self, x):
+        calls["load"] += 1
+        return x
+
+    @delayed
+    def save(self, x):
+        calls["save"] += 1
+        if calls["save"] <= self.failures:
+            raise IOError("NFS hiccup")
+        return x * 2
+
+    @delayed
+    def flaky(self, x):
+        calls["flaky"] += 1
+        if calls["flaky"] == 1:
+            raise IOError("NFS hiccup")
+        return x
+
+    def build(self):
+        saved = self.save(self.load(1))
+        flaky = self.flaky(saved)
+        if self.per_task:
+            self.retry_task(flaky, RetryPolicy(2, backoff=0.))
+        return flaky
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    calls.clear()
+
+
+class TestRetryPolicy:
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            RetryPolicy(0)
+
+    def test_should_retry(self):
+        policy = RetryPolicy(2, exceptions=(OSError,))
+        assert policy.should_retry(OSError(), 1)
+        assert not policy.should_retry(OSError(), 2)
+        assert not policy.should_retry(ValueError(), 1)
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1., factor=2., max_backoff=3., jitter=0)
+        assert [policy.delay(i) for i in range(1, 5)] == [1., 2., 3., 3.]
+
+        policy = RetryPolicy(backoff=1., jitter=0.5)
+        assert all(0.5 <= policy.delay(1) <= 1.5 for _ in range(20))
+
+
+def test_retry_decorator():
+    @retry(3, backoff=0., exceptions=(IOError,))
+    def func(x):
+        calls["func"] += 1
+        if calls["func"] < 3:
+            raise IOError()
+        return x
+
+    assert func.__name__ == "func"
+    assert func(1) == 1
+    assert calls["func"] == 3
+
+    calls.clear()
+    with pytest.raises(IOError):
+        retry(2, backoff=0.)(func.__wrapped__)(1)
+    assert calls["func"] == 2
+
+
+def test_retry_ignores_other_exceptions():
+    @retry(3, backoff=0., exceptions=(IOError,))
+    def func():
+        calls["func"] += 1
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        func()
+    assert calls["func"] == 1
+
+
+def test_retry_policies():
+    with pytest.raises(IOError):
+        FlakyPipeline().run()
+
+    calls.clear()
+    assert FlakyPipeline(per_task=True).run() == 2
+
+    # upstream work is not recomputed
+    assert calls["load"] == 1
+    assert calls["save"] == 3
+    assert calls["flaky"] == 2
+
+
+def test_retry_too_many_failures():
+    with pytest.raises(IOError):
+        FlakyPipeline(failures=3, per_task=True).run()
+    assert calls["save"] == 3
+
+
+def test_retry_messages():
+    results = []
+    with PipelineStatusListener(results.append, port=50003):
+        callback = PipelineCallback("retries", port=50003)
+        with pytest.raises(IOError):
+            FlakyPipeline(failures=5).run(callback=callback)
+        time.sleep(0.1)
+
+    types = [msg["type"] for msg in results]
+    assert types.count("retry") == 2
+    assert types.count("task-failed") == 1
+
+    retry_msg = [msg for msg in results if msg["type"] == "retry"][0]
+    assert retry_msg["attempt"] == 1
+    assert retry_msg["max_attempts"] == 3
+    assert "NFS hiccup" in retry_msg["error"]
+    assert retry_msg["task"].startswith("save")
+
+
+def test_retry_messages_distributed():
+    from distributed import Client, LocalCluster
+
+    results = []
+    callbacks = [PipelineCallback("first", port=50004),
+                 PipelineCallback("second", port=50004)]
+
+    with LocalCluster(n_workers=2, threads_per_worker=1, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster):
+            with PipelineStatusListener(results.append, port=50004):
+                with pytest.raises(IOError):
+                    FlakyPipeline(failures=5).run(callback=callbacks[0])
+                calls.clear()
+                assert FlakyPipeline(failures=1, per_task=True).run(
+                    callback=callbacks[1]) == 2
+                time.sleep(0.1)
+
+    retries = Counter((msg["pipeline"], msg["type"]) for msg in results
+                      if msg["type"] in ("retry", "task-failed"))
+    assert retries == {("first", "retry"): 2, ("first", "task-failed"): 1,
+                       ("second", "retry"): 2}
@@ -0,0 +1,159 @@
+import time
+
+import dask
+from dask import delayed
+import pytest
+
+from cml_pipelines.graph import task_graph, task_name
+from cml_pipelines.pipeline import Pipeline
+from cml_pipelines.scheduling import (
+    KeyLookup, PriorityCallback, priorities, task_costs, upward_ranks
+)
+
+
+class OrderPipeline(Pipeline):
+    """A pipeline with several short tasks and one long task. The long task
+    is hinted and should start first when prioritizing.
+
+    """
+    cost_hints = {"short": 0.01}
+
+    # module-level so that it is shared by copies of the pipeline made when
+    # serializing the graph
+    order = []
+
+    def _log(self, name):
+        self.order.append(name)
+
+    @delayed
+    def short(self, i):
+        self._log("short")
+        return i
+
+    @delayed
+    def long(self):
+        self._log("long")
+        time.sleep(0.05)
+        return 100
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        shorts = [self.short(i) for i in range(5)]
+        return self.total(shorts + [self.hint_cost(self.long(), 10.)])
+
+
+@delayed
+def a(x):
+    return x
+
+
+@delayed
+def b(x):
+    return x
+
+
+def test_task_costs():
+    collection = delayed(list)([a(1), b(2), b(3)])
+    dsk = task_graph(collection)
+    b_key = [key for key in dsk if task_name(key) == "b"][0]
+
+    costs = task_costs(dsk, durations={"a": 3., "b": 5.},
+                       cost_hints={"b": 2.}, task_cost_hints={b_key: 7.})
+    by_name = sorted((task_name(key), cost) for key, cost in costs.items())
+    assert by_name == [("a", 3.), ("b", 2.), ("b", 7.), ("list", 4.)]
+
+    # unknown costs default to 1 with no other information
+    assert set(task_costs(dsk).values()) == {1.}
+
+
+def test_upward_ranks():
+    x = a(1)
+    y = b(x)
+    z = delayed(list)([y, b(2)])
+    dsk = task_graph(z)
+    costs = {x.key: 1., y.key: 2., z.key: 4.}
+    ranks = upward_ranks(dsk, costs)
+
+    assert ranks[z.key] == 4.
+    assert ranks[y.key] == 6.
+    assert ranks[x.key] == 7.
+
+    prios = priorities(ranks)
+    assert prios[x.key] > prios[y.key] > prios[z.key]
+
+
+def test_key_lookup():
+    lookup = KeyLookup({"a": 1}, default=-1)
+    assert lookup("a") == 1
+    assert lookup("b") == -1
+
+    import pickle
+    assert pickle.loads(pickle.dumps(lookup))("b") == -1
+
+
+def test_priority_callback():
+    order = []
+
+    @delayed
+    def task(name):
+        order.append(name)
+        return name
+
+    tasks = [task("t{}".format(i)) for i in range(5)]
+    collection = delayed(list)(tasks)
+    prios = {tasks[3].key: 10, tasks[1].key: 5}
+
+    with PriorityCallback(prios):
+        collection.compute(scheduler="single-threaded")
+
+    assert order[:2] == ["t3", "t1"]
+
+
+@pytest.mark.parametrize("prioritize", [True, False])
+def test_run_prioritize(prioritize):
+    pipeline = OrderPipeline()
+    del pipeline.order[:]
+    with dask.config.set(num_workers=1):
+        assert pipeline.run(prioritize=prioritize) == 110
+
+    if prioritize:
+        assert pipeline.order[0] == "long"
+    else:
+        assert pipeline.order[-1] == "long"
+
+
+@pytest.mark.parametrize("prioritize", [True, False])
+def test_run_prioritize_distributed(prioritize):
+    from distributed import Client, LocalCluster
+    from distributed.diagnostics.plugin import SchedulerPlugin
+
+    class PriorityRecorder(SchedulerPlugin):
+        """Records the user priority the scheduler assigned to each task."""
+        name = "priority-recorder"
+
+        def __init__(self):
+            self.recorded = {}
+
+        def update_graph(self, scheduler, *args, **kwargs):
+            for key, ts in scheduler.tasks.items():
+                self.recorded[task_name(key)] = ts.priority[0]
+
+    def get_recorded(dask_scheduler):
+        return dask_scheduler.plugins[PriorityRecorder.name].recorded
+
+    with LocalCluster(n_workers=1, threads_per_worker=1, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            client.register_plugin(PriorityRecorder())
+            assert OrderPipeline().run(prioritize=prioritize) == 110
+            recorded = client.run_on_scheduler(get_recorded)
+
+    # higher priorities are negated so that they sort first; by upward rank
+    # the long task comes first, then the short ones, then the total
+    if prioritize:
+        assert recorded == {"long": -2, "short": -1, "total": 0}
+    else:
+        assert recorded == {"long": 0, "short": 0, "total": 0}
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from dask import delayed
+
+from cml_pipelines.graph import dependencies, task_graph, task_name
+from cml_pipelines.spectral import (
+    SpectralDecomposition, add_mirror_buffer, chunk_slices, line_filter,
+    morlet_power, remove_buffer
+)
+from cml_pipelines.synthetic import synthetic_eeg
+
+SAMPLE_RATE = 200.
+FREQS = np.array([10., 40.])
+
+
+@pytest.fixture(scope="module")
+def eeg():
+    return synthetic_eeg(6, 5, 100, SAMPLE_RATE, seed=1)
+
+
+def unchunked(eeg, n_buffer):
+    data = line_filter(add_mirror_buffer(eeg, n_buffer), SAMPLE_RATE)
+    powers = remove_buffer(morlet_power(data, SAMPLE_RATE, FREQS), n_buffer)
+    return np.log10(powers.mean(axis=-1))
+
+
+@pytest.mark.parametrize("n,n_chunks,expected", [
+    (10, 3, [(0, 3), (3, 7), (7, 10)]),
+    (4, 1, [(0, 4)]),
+    (2, 3, [(0, 1), (1, 1), (1, 2)]),
+])
+def test_chunk_slices(n, n_chunks, expected):
+    slices = chunk_slices(n, n_chunks)
+    assert [(s.start, s.stop) for s in slices] == expected
+
+
+@pytest.mark.parametrize("dim", ["channels", "events"])
+@pytest.mark.parametrize("n_chunks", [1, 2, 8])
+def test_spectral_decomposition(eeg, dim, n_chunks):
+    stage = SpectralDecomposition(SAMPLE_RATE, FREQS, n_chunks, dim=dim,
+                                  buffer=50.)
+    decorated = []
+    eeg_task = delayed(eeg)
+    result = stage(eeg_task, decorate=lambda t: decorated.append(t) or t)
+
+    dsk = task_graph(result)
+    counts = {}
+    for key in dsk:
+        counts[task_name(key)] = counts.get(task_name(key), 0) + 1
+    for name in ["filter_chunk", "decompose_chunk", "reduce_chunk"]:
+        assert counts[name] == n_chunks
+    assert counts["split"] == counts["reassemble"] == 1
+
+    # only the split task receives the full EEG
+    assert [task_name(key) for key, deps in dependencies(dsk).items()
+            if eeg_task.key in deps] == ["split"]
+    assert len(decorated) == n_chunks
+
+    expected = unchunked(eeg, 10)
+    log_powers = result.compute()
+    assert log_powers.shape == (len(FREQS), 6, 5)
+    np.testing.assert_allclose(log_powers, expected)
+
+
+def test_sample_rate_from_eeg(eeg):
+    class TimeSeries(np.ndarray):
+        samplerate = SAMPLE_RATE
+
+    stage = SpectralDecomposition(freqs=FREQS, n_chunks=2)
+    result = stage(delayed(eeg.view(TimeSeries))).compute()
+    np.testing.assert_allclose(result, unchunked(eeg, 0))
+
+
+class LabelledArray(object):
+    """Minimal stand-in for an xarray DataArray."""
+    def __init__(self, values, dims):
+        self.values = values
+        self.dims = tuple(dims)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def transpose(self, *dims):
+        axes = [self.dims.index(dim) for dim in dims]
+        return LabelledArray(self.values.transpose(axes), dims)
+
+    def isel(self, indexers):
+        index = tuple(indexers.get(dim, slice(None)) for dim in self.dims)
+        return LabelledArray(self.values[index], self.dims)
+
+
+@pytest.mark.parametrize("dims", [("event", "channel", "time"),
+                                  ("event", "bipolar_pair", "time")])
+@pytest.mark.parametrize("dim", ["channels", "events"])
+def test_labelled_eeg(eeg, dims, dim):
+    # stored in a different order than the stage uses
+    labelled = LabelledArray(eeg.transpose(1, 2, 0),
+                             [dims[1], dims[2], dims[0]])
+    stage = SpectralDecomposition(SAMPLE_RATE, FREQS, 2, dim=dim, dims=dims)
+    chunk = stage.select_chunk(labelled, 1)
+    axis = 1 if dim == "channels" else 0
+    assert chunk.shape[axis] == eeg.shape[axis] - eeg.shape[axis] // 2
+
+    result = stage(delayed(labelled)).compute()
+    np.testing.assert_allclose(result, unchunked(eeg, 0))
+
+
+def test_invalid_dim():
+    with pytest.raises(ValueError):
+        SpectralDecomposition(dim="time")
+    with pytest.raises(ValueError):
+        SpectralDecomposition(dims=("event", "time"))
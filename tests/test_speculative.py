@@ -0,0 +1,110 @@
+from collections import Counter
+import time
+
+from dask import delayed
+import pytest
+
+from cml_pipelines.graph import task_graph
+from cml_pipelines.pipeline import Pipeline
+from cml_pipelines.speculative import (
+    SpeculativeExecutor, idempotent, is_idempotent
+)
+
+class StragglerPipeline(Pipeline):
+    """One task in the pipeline is very slow the first time it runs."""
+    # call counts shared by all copies of the pipeline made when serializing
+    # the graph
+    calls = Counter()
+
+    def __init__(self, mark_idempotent=True):
+        self.mark_idempotent = mark_idempotent
+
+    @delayed
+    @idempotent
+    def work(self, i):
+        self.calls[i] += 1
+        if i == 3 and self.calls[i] == 1:
+            time.sleep(1.5)
+        else:
+            time.sleep(0.02)
+        return i
+
+    @delayed
+    def unsafe_work(self, i):
+        return self.work.__wrapped__(self, i)
+
+    @delayed
+    def total(self, values):
+        return sum(values)
+
+    def build(self):
+        func = self.work if self.mark_idempotent else self.unsafe_work
+        return self.total([func(i) for i in range(4)])
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    StragglerPipeline.calls.clear()
+
+
+@pytest.fixture
+def client():
+    from distributed import Client, LocalCluster
+
+    with LocalCluster(n_workers=2, threads_per_worker=1, processes=False,
+                      dashboard_address=None) as cluster:
+        with Client(cluster) as client:
+            yield client
+
+
+def test_is_idempotent():
+    pipeline = StragglerPipeline()
+    dsk = task_graph(pipeline.build())
+    marked = sorted(key.split("-")[0] for key, node in dsk.items()
+                    if is_idempotent(node))
+    assert marked == ["work"] * 4
+
+
+@pytest.mark.parametrize("mark_idempotent", [True, False])
+def test_speculative_executor(client, mark_idempotent):
+    collection = StragglerPipeline(mark_idempotent).build()
+    executor = SpeculativeExecutor(client, task_graph(collection),
+                                   collection.key, min_duration=0.1,
+                                   interval=0.02)
+
+    start = time.time()
+    assert executor.run() == 6
+    elapsed = time.time() - start
+
+    if mark_idempotent:
+        assert len(executor.duplicated) == 1
+        assert executor.duplicates_won == executor.duplicated
+        assert StragglerPipeline.calls[3] == 2
+        assert elapsed < 1.5
+    else:
+        assert not executor.duplicated
+        assert elapsed >= 1.5
+
+
+def test_speculative_executor_error(client):
+    @delayed
+    def fail():
+        raise ValueError("oops")
+
+    collection = delayed(list)([fail()])
+    executor = SpeculativeExecutor(client, task_graph(collection),
+                                   collection.key, interval=0.02)
+    with pytest.raises(ValueError):
+        executor.run()
+
+
+def test_run_speculative(client):
+    pipeline = StragglerPipeline()
+    result = pipeline.run(speculative={"min_duration": 0.1, "interval": 0.02})
+    assert result == 6
+    assert StragglerPipeline.calls[3] == 2
+
+
+def test_run_speculative_local(caplog):
+    assert StragglerPipeline().run(speculative=True) == 6
+    assert "requires a distributed cluster" in caplog.text
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from cml_pipelines.synthetic import (
+    add_mirror_buffer, line_filter, make_subjects, morlet_power, remove_buffer,
+    synthetic_eeg, zscore_powers, SyntheticPowersPipeline
+)
+
+
+def test_make_subjects():
+    subjects = make_subjects(3, n_events=10, n_channels=4, skew=1.)
+    assert len(subjects) == 3
+    assert len(set(s.subject for s in subjects)) == 3
+    assert [s.n_events for s in subjects] == [10, 15, 20]
+    assert all(s.n_channels == 4 for s in subjects)
+
+
+def test_synthetic_eeg():
+    data = synthetic_eeg(5, 3, 200, 100., seed=1)
+    assert data.shape == (5, 3, 200)
+    np.testing.assert_equal(data, synthetic_eeg(5, 3, 200, 100., seed=1))
+
+
+@pytest.mark.parametrize("n_samples", [0, 10])
+def test_mirror_buffer(n_samples):
+    data = np.random.random((2, 3, 50))
+    buffered = add_mirror_buffer(data, n_samples)
+    assert buffered.shape == (2, 3, 50 + 2 * n_samples)
+    np.testing.assert_equal(remove_buffer(buffered, n_samples), data)
+
+
+def test_line_filter():
+    sample_rate = 1000.
+    t = np.arange(2000) / sample_rate
+    data = np.sin(2 * np.pi * 60 * t)[None, None, :]
+    filtered = line_filter(data, sample_rate)
+    assert filtered.shape == data.shape
+    assert np.abs(filtered[..., 500:-500]).max() < 0.05
+
+
+def test_morlet_and_zscore():
+    data = synthetic_eeg(6, 2, 100, 100., seed=2)
+    freqs = np.array([5., 10.])
+    powers = morlet_power(data, 100., freqs)
+    assert powers.shape == (2, 6, 2, 100)
+    assert (powers >= 0).all()
+
+    zscores = zscore_powers(powers)
+    assert zscores.shape == (2, 6, 2)
+    np.testing.assert_allclose(zscores.mean(axis=1), 0, atol=1e-10)
+
+
+def test_pipeline(tmpdir):
+    subjects = make_subjects(2, n_events=4, n_channels=2, sample_rate=200.)
+    pipeline = SyntheticPowersPipeline(subjects, str(tmpdir), duration=500.,
+                                       buffer=100.)
+    path = pipeline.run(debug=True)
+
+    assert os.path.exists(path)
+    with np.load(path) as data:
+        assert sorted(data.keys()) == sorted(s.subject for s in subjects)
+        for s in subjects:
+            assert data[s.subject].shape == (len(pipeline.freqs), 4, 2)
+
+    # adding a subject only processes the new subject and recombines
+    more = make_subjects(3, n_events=4, n_channels=2, sample_rate=200.)
+    pipeline = SyntheticPowersPipeline(more, str(tmpdir), duration=500.,
+                                       buffer=100.)
+    assert pipeline.estimate().tasks == {
+        "load_eeg": 1, "timeseries_to_spectrum": 1, "spectrum_to_powers": 1,
+        "save": 1, "combine": 1,
+    }
+    pipeline.run(debug=True)
+    with np.load(path) as data:
+        assert len(data.keys()) == 3
+
+
+def test_pipeline_chunked(tmpdir):
+    subjects = make_subjects(1, n_events=4, n_channels=3, sample_rate=200.)
+    results = []
+    for n_chunks in [None, 2]:
+        output_dir = tmpdir.mkdir("chunks-{}".format(n_chunks))
+        pipeline = SyntheticPowersPipeline(subjects, str(output_dir),
+                                           duration=500., buffer=100.,
+                                           n_chunks=n_chunks)
+        with np.load(pipeline.run()) as data:
+            results.append(data[subjects[0].subject])
+
+    np.testing.assert_allclose(results[0], results[1])